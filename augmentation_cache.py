@@ -0,0 +1,289 @@
+import os
+import gzip
+import json
+import shutil
+import socket
+import hashlib
+import augmentation_utils
+from batch_runner import parse_memory_size
+from file_handler2 import augmented_output_path, label_file_index, linked_labels
+from instrumentation import count
+from work_claims import read_json, write_json_atomic
+
+# Name of the manifest kept in the output directory
+MANIFEST_NAME = 'augmentation_manifest.json'
+
+# Bump to recompute every output after a change to the augmentation code that the parameters below do not capture
+CACHE_VERSION = 1
+
+# Parameters each augmentation depends on, in the order process_volume_and_label_batched returns them
+# Taken from the defaults in augmentation_utils, so changing one there only recomputes that augmentation
+AUGMENTATION_PARAMETERS = [
+    {'name': 'normalized', 'size': list(augmentation_utils.NORMALIZED_SIZE)},
+    {'name': 'rotated', 'angle': augmentation_utils.ROTATION_ANGLE, 'scale': augmentation_utils.ROTATION_SCALE},
+    {'name': 'flipped', 'flip_code': augmentation_utils.FLIP_CODE},
+    {'name': 'zoomed', 'crop': list(augmentation_utils.ZOOM_CROP)},
+    {'name': 'contrast', 'alpha': augmentation_utils.CONTRAST_ALPHA, 'beta': augmentation_utils.CONTRAST_BETA},
+    {'name': 'denoised', 'kernel': list(augmentation_utils.DENOISE_KERNEL), 'sigma': augmentation_utils.DENOISE_SIGMA},
+]
+
+# Function to load the manifest of an output directory, or start an empty one
+def load_manifest(output_dir):
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == CACHE_VERSION:
+                return manifest
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable manifest {manifest_path}: {e}")
+    return {'version': CACHE_VERSION, 'inputs': {}, 'outputs': {}}
+
+# Function to write the manifest atomically, so a crash never leaves it half written
+def save_manifest(output_dir, manifest):
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+# Function to give the SHA-256 of a file's contents
+# Hashes are remembered in the manifest by path, size and mtime, so unchanged inputs are not read again on a rerun
+def input_hash(manifest, file_path, chunk_size=1024 * 1024):
+    stat = os.stat(file_path)
+    known = manifest['inputs'].get(os.path.abspath(file_path))
+    if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+        return known['sha256']
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    manifest['inputs'][os.path.abspath(file_path)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                                      'sha256': digest.hexdigest()}
+    return digest.hexdigest()
+
+# Function to compute the cache key of each of the six augmentations of a volume and label pair
+# A key covers the input contents, the run-wide parameters (e.g. output dtype) and that augmentation's own parameters.
+# Intensity windows are written with the normalized volume, so they are part of its key, and contrast_alpha (the
+# contrast_alpha augment option, when given) replaces the default contrast factor in the key of the contrast augmentation
+def augmentation_keys(volume_hash, label_hash, parameters, windows=None, contrast_alpha=None):
+    keys = []
+    for i, augmentation in enumerate(AUGMENTATION_PARAMETERS):
+        if i == 0 and windows:
+            augmentation = dict(augmentation, windows=windows)
+        if i == 4 and contrast_alpha is not None:
+            augmentation = dict(augmentation, alpha=contrast_alpha)
+        description = {'version': CACHE_VERSION, 'volume': volume_hash, 'label': label_hash,
+                       'parameters': parameters, 'augmentation': augmentation}
+        keys.append(hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest())
+    return keys
+
+# Function to list the (kind, path) of the output files of augmentation i
+# A label shared between augmentations (see file_handler2.LABEL_SOURCES) belongs to the augmentation it comes from,
+# together with its hard links, so it is only rewritten, and its links only remade, when that augmentation is.
+# Intensity windows (named by windows) likewise belong to the normalized volume they are computed from
+def augmentation_paths(output_dir, prefix, i, compressed=True, label_files='shared', windows=()):
+    paths = [('volume', augmented_output_path(output_dir, prefix, 'volume', i, compressed))]
+    if i == 0:
+        paths += [(f'window-{name}', augmented_output_path(output_dir, prefix, 'window', name, compressed)) for name in windows]
+    if label_file_index(i, label_files) == i:
+        paths += [('label', augmented_output_path(output_dir, prefix, 'label', j, compressed))
+                  for j in [i] + linked_labels(i, label_files)]
+    return paths
+
+# Function to list the (cache key, path) of the output files of augmentation i with key
+def augmentation_files(output_dir, prefix, i, key, compressed=True, label_files='shared', windows=()):
+    return [(f'{key}-{kind}', file_path)
+            for kind, file_path in augmentation_paths(output_dir, prefix, i, compressed, label_files, windows)]
+
+# Function to check whether an output file is the one the manifest recorded for key
+def output_up_to_date(manifest, file_path, key):
+    entry = manifest['outputs'].get(os.path.basename(file_path))
+    return entry is not None and entry['key'] == key and os.path.exists(file_path) and \
+        os.path.getsize(file_path) == entry['size']
+
+# Function to list the augmentations of a volume whose outputs are missing or outdated
+# Outputs found in the cache are restored instead of being listed, and recorded in the manifest
+def outdated_augmentations(manifest, output_dir, prefix, keys, compressed=True, cache=None, label_files='shared', windows=()):
+    outdated = []
+    for i, key in enumerate(keys):
+        for file_key, file_path in augmentation_files(output_dir, prefix, i, key, compressed, label_files, windows):
+            if output_up_to_date(manifest, file_path, file_key):
+                continue
+            if cache is not None and cache.restore(file_key, file_path):
+                record_output(manifest, file_path, file_key)
+                continue
+            outdated.append(i)
+            break
+    return outdated
+
+# Function to remove the outputs of augmentations about to be recomputed
+# Writers then create new files, instead of overwriting files that may be hardlinked into the cache. Recomputing the
+# normalized volume also removes the recorded windows of this prefix that are no longer asked for
+def remove_augmentation_outputs(manifest, output_dir, prefix, indices, compressed=True, label_files='shared', windows=()):
+    for i in indices:
+        paths = augmentation_paths(output_dir, prefix, i, compressed, label_files, windows)
+        if i == 0:
+            window_prefix = os.path.basename(augmented_output_path(output_dir, prefix, 'window', '', compressed)).split('.')[0]
+            paths += [(None, os.path.join(output_dir, name)) for name in list(manifest['outputs'])
+                      if name.startswith(window_prefix) and os.path.join(output_dir, name) not in {path for _, path in paths}]
+        for _, file_path in paths:
+            manifest['outputs'].pop(os.path.basename(file_path), None)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+# Function to record an output file under its key in the manifest
+def record_output(manifest, file_path, key):
+    manifest['outputs'][os.path.basename(file_path)] = {'key': key, 'size': os.path.getsize(file_path)}
+
+# Function to record freshly computed augmentations in the manifest and add them to the cache
+def record_augmentations(manifest, output_dir, prefix, keys, indices, compressed=True, cache=None, label_files='shared',
+                         windows=()):
+    for i in indices:
+        for file_key, file_path in augmentation_files(output_dir, prefix, i, keys[i], compressed, label_files, windows):
+            record_output(manifest, file_path, file_key)
+            if cache is not None:
+                cache.store(file_key, file_path)
+
+# Function to place a file at destination as a hardlink, or a copy across file systems, replacing it atomically
+# The temporary name is unique to the process, so machines sharing the cache can store the same key at once
+def link_or_copy(source, destination):
+    temporary_path = f'{destination}.{socket.gethostname()}-{os.getpid()}.tmp'
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    try:
+        os.link(source, temporary_path)
+    except OSError:
+        shutil.copyfile(source, temporary_path)
+    os.replace(temporary_path, destination)
+
+# Class for a content-addressed store of augmented outputs, shared between output directories and reruns
+# Files are stored under their cache key. Using a file refreshes its mtime, and evict() removes the least recently
+# used files until the cache fits into max_size (a byte count or a size such as '200G'; None for no limit)
+class OutputCache:
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = parse_memory_size(max_size)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Function to give the cache path of a key, keeping the file extension of the output
+    def path(self, key, file_path):
+        extension = '.nii.gz' if file_path.endswith('.nii.gz') else os.path.splitext(file_path)[1]
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    # Function to copy the cached file for key to file_path, returning False when it is not cached
+    def restore(self, key, file_path):
+        cached_path = self.path(key, file_path)
+        if not os.path.exists(cached_path):
+            return False
+        link_or_copy(cached_path, file_path)
+        os.utime(cached_path)
+        return True
+
+    # Function to add an output file to the cache under key
+    def store(self, key, file_path):
+        cached_path = self.path(key, file_path)
+        if os.path.exists(cached_path):
+            os.utime(cached_path)
+            return
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        link_or_copy(file_path, cached_path)
+
+    # Function to remove least recently used files until the cache fits into max_size, returning the removed paths
+    def evict(self):
+        if self.max_size is None:
+            return []
+        entries = []
+        # Files live in subdirectories named by the first two characters of their key
+        for directory in os.scandir(self.cache_dir):
+            if directory.is_dir() and len(directory.name) == 2:
+                for entry in os.scandir(directory.path):
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        removed = []
+        for _, size, cached_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(cached_path)
+            except FileNotFoundError:
+                # Another machine sharing the cache evicted it first
+                pass
+            total_size -= size
+            removed.append(cached_path)
+        return removed
+
+# Class for a local cache of decompressed copies of .nii.gz inputs, so repeated runs skip gzip decompression
+# The first read of an input stores it decompressed as a .nii file under the SHA-256 of the compressed file; later
+# reads open that copy, which nibabel memory-maps, so reruns and worker processes reading the same input share its
+# pages through the OS page cache. The hash of each input is recorded with its size and mtime in sources/, and is only
+# recomputed when those change. Bounded to max_size by least-recently-used eviction like OutputCache, run once per
+# batch (see main2.run_augmentation_batch) rather than on every miss, so the cache may exceed max_size during a batch
+class InputCache(OutputCache):
+    def __init__(self, cache_dir, max_size=None):
+        super().__init__(cache_dir, max_size)
+        os.makedirs(os.path.join(cache_dir, 'sources'), exist_ok=True)
+
+    # Function to give the content hash of an input, rehashing it only when its size or mtime changed
+    def source_hash(self, file_path):
+        record_path = os.path.join(self.cache_dir, 'sources',
+                                   hashlib.sha256(os.path.abspath(file_path).encode()).hexdigest() + '.json')
+        inputs = read_json(record_path) or {}
+        known = dict(inputs)
+        digest = input_hash({'inputs': inputs}, file_path)
+        if inputs != known:
+            write_json_atomic(record_path, inputs)
+        return digest
+
+    # Function to give the path to read an input from: its decompressed copy, stored first if it is not cached yet
+    # Inputs that are not gzip-compressed are read in place
+    def cached_path(self, file_path):
+        if not file_path.endswith('.gz'):
+            return file_path
+        cached_path = self.path(self.source_hash(file_path), file_path[:-len('.gz')])
+        try:
+            os.utime(cached_path)
+            count('input_cache_hits')
+            return cached_path
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        temporary_path = f'{cached_path}.{socket.gethostname()}-{os.getpid()}.tmp'
+        try:
+            with gzip.open(file_path, 'rb') as source, open(temporary_path, 'wb') as destination:
+                shutil.copyfileobj(source, destination, 4 * 1024 * 1024)
+            os.replace(temporary_path, cached_path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        count('input_cache_misses')
+        # An input larger than the whole cache is removed at once and read from the source instead
+        if self.max_size is not None and os.path.getsize(cached_path) > self.max_size:
+            try:
+                os.remove(cached_path)
+            except FileNotFoundError:
+                # Another machine sharing the cache evicted it first
+                pass
+            return file_path
+        return cached_path
+
+    # Function to evict like OutputCache, then drop the records in sources/ of inputs whose decompressed copy is gone
+    # A dropped input is hashed again the next time it is read, which costs less than decompressing it again
+    def evict(self):
+        removed = super().evict()
+        for entry in os.scandir(os.path.join(self.cache_dir, 'sources')):
+            if not entry.name.endswith('.json'):
+                continue
+            inputs = read_json(entry.path) or {}
+            if not any(os.path.exists(self.path(known['sha256'], file_path[:-len('.gz')]))
+                       for file_path, known in inputs.items()):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        return removed
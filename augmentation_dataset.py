@@ -0,0 +1,182 @@
+import os
+import queue
+import threading
+import numpy as np
+from file_handler2 import load_nifti_file, read_nifti_shape_and_dtype
+from augmentation_pipeline import process_volume_and_label_batched
+from batch_runner import find_volume_label_pairs
+from shard_store import ShardReader, SHARD_EXTENSION
+
+# Names of the six augmentations, in the order process_volume_and_label_batched returns them
+AUGMENTATION_NAMES = ['normalized', 'rotated', 'flipped', 'zoomed', 'contrast', 'denoised']
+
+# Marker a worker puts on a volume's queue once all of that volume's samples are queued
+END_OF_VOLUME = object()
+
+# Class to produce augmented (image, label) slices or slabs on demand, without writing anything to disk
+# Volumes are read and augmented by background worker threads (OpenCV, numpy and zlib release the GIL) that
+# prefetch into bounded queues. The order of volumes, slabs and augmentations is shuffled from seeds derived
+# from (seed, epoch, volume, slab), so an epoch always yields the same samples in the same order for any num_workers.
+class AugmentedSliceDataset:
+    def __init__(self, pairs, slab_size=1, label_value=3, variants=None, variants_per_slab=None, seed=0, shuffle=True):
+        if slab_size < 1:
+            raise ValueError("slab_size must be at least 1.")
+        self.pairs = list(pairs)
+        self.slab_size = slab_size
+        self.label_value = label_value
+        self.variants = list(range(6)) if variants is None else [AUGMENTATION_NAMES.index(v) if isinstance(v, str) else v
+                                                                  for v in variants]
+        self.variants_per_slab = len(self.variants) if variants_per_slab is None else variants_per_slab
+        if not 1 <= self.variants_per_slab <= len(self.variants):
+            raise ValueError("variants_per_slab must be between 1 and the number of variants.")
+        self.seed = seed
+        self.shuffle = shuffle
+
+        # Slice counts come from the NIfTI headers, so no voxel data is read until iteration starts
+        self.depths = [read_nifti_shape_and_dtype(volume_path)[0][2] for volume_path, _ in self.pairs]
+
+    # Function to build a dataset from the volume-*/labels-* pairs of a CT-ORG directory
+    @classmethod
+    def from_directory(cls, data_dir, **kwargs):
+        pairs = [(os.path.join(data_dir, volume_file), os.path.join(data_dir, label_file))
+                 for volume_file, label_file in find_volume_label_pairs(data_dir)]
+        return cls(pairs, **kwargs)
+
+    # Function to count the samples in one epoch
+    def __len__(self):
+        return sum(-(-depth // self.slab_size) for depth in self.depths) * self.variants_per_slab
+
+    def __iter__(self):
+        return self.iterate(epoch=0)
+
+    # Function to give the random generator for one (epoch, volume, slab) position, independent of worker scheduling
+    def rng(self, epoch, *position):
+        return np.random.default_rng([self.seed, epoch] + list(position))
+
+    # Function to list the volume order of an epoch
+    def volume_order(self, epoch):
+        order = np.arange(len(self.pairs))
+        return self.rng(epoch).permutation(order) if self.shuffle else order
+
+    # Function to load one volume pair and put its augmented samples on sample_queue in their per-volume order
+    def produce_volume_samples(self, epoch, volume_index, sample_queue, stop_event):
+        volume_path, label_path = self.pairs[volume_index]
+        volume_data, _, _ = load_nifti_file(volume_path, dtype='native')
+        label_data, _, _ = load_nifti_file(label_path, dtype='native')
+        label_data = (label_data == self.label_value).astype(np.uint8)
+        if volume_data.shape != label_data.shape:
+            raise ValueError(f"Shape mismatch between volume and label for {volume_path} and {label_path}")
+
+        slab_starts = np.arange(0, volume_data.shape[2], self.slab_size)
+        if self.shuffle:
+            slab_starts = self.rng(epoch, volume_index).permutation(slab_starts)
+        for start in slab_starts:
+            start = int(start)
+            stop = min(start + self.slab_size, volume_data.shape[2])
+
+            # Pick which augmentations of this slab to yield, and in which order, and compute only those
+            variants = self.variants
+            if self.shuffle or self.variants_per_slab < len(variants):
+                variants = self.rng(epoch, volume_index, start).permutation(variants)[:self.variants_per_slab]
+            variants = [int(variant) for variant in variants]
+            volume_aug, label_aug = process_volume_and_label_batched(volume_data[:, :, start:stop], label_data[:, :, start:stop],
+                                                                     augmentations=variants)
+            for variant in variants:
+                image, label = volume_aug[variant], label_aug[variant]
+                if self.slab_size == 1:
+                    image, label = image[:, :, 0], label[:, :, 0]
+                if not put_until_stopped(sample_queue, (image, label), stop_event):
+                    return
+
+    # Function run by each worker thread: produce the volumes assigned to it, one queue per volume
+    def worker(self, epoch, assigned, volume_queues, stop_event):
+        for volume_index in assigned:
+            sample_queue = volume_queues[volume_index]
+            try:
+                self.produce_volume_samples(epoch, volume_index, sample_queue, stop_event)
+            except Exception as e:
+                put_until_stopped(sample_queue, RuntimeError(f"Error augmenting {self.pairs[volume_index][0]}: {e}"), stop_event)
+            if not put_until_stopped(sample_queue, END_OF_VOLUME, stop_event):
+                return
+
+    # Function to yield the augmented (image, label) samples of one epoch
+    # num_workers threads each prefetch up to prefetch samples; volumes are handed to workers round-robin in epoch order
+    # and samples are yielded volume by volume in that order, so backpressure never reorders the output
+    def iterate(self, epoch=0, num_workers=2, prefetch=16):
+        order = [int(i) for i in self.volume_order(epoch)]
+        num_workers = max(1, min(num_workers, len(order)))
+        volume_queues = {volume_index: queue.Queue(maxsize=prefetch) for volume_index in order}
+        stop_event = threading.Event()
+        threads = [threading.Thread(target=self.worker, args=(epoch, order[k::num_workers], volume_queues, stop_event), daemon=True)
+                   for k in range(num_workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            for volume_index in order:
+                while True:
+                    item = volume_queues[volume_index].get()
+                    if item is END_OF_VOLUME:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+        finally:
+            # Unblock and stop the workers if the consumer stops early or an error is raised
+            stop_event.set()
+            for thread in threads:
+                thread.join()
+
+# Function to put an item on a bounded queue, giving up if stop_event is set while the queue is full
+def put_until_stopped(sample_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            sample_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+# Class to read augmented (image, label) slices back from the shards main2.py writes with --output-format shards
+# Any slice can be read without decompressing its whole volume, so samples can be drawn in a fully random order;
+# __getitem__ also lets a framework sampler pick the order. augmentations optionally keeps only the named augmentations.
+# Compressed shards decompress a whole chunk per slice read, so fully random access is cheapest on uncompressed shards
+class ShardSliceDataset:
+    def __init__(self, shard_paths, augmentations=None, seed=0, shuffle=True):
+        self.readers = [ShardReader(shard_path) for shard_path in shard_paths]
+        self.seed = seed
+        self.shuffle = shuffle
+
+        # Global sample list as (reader, slice) arrays, built from the shard indexes without reading any slice
+        readers, indices = [], []
+        for reader_index, reader in enumerate(self.readers):
+            for entry_index, entry in enumerate(reader.entries):
+                if augmentations is None or entry['augmentation'] in augmentations:
+                    start = int(reader.starts[entry_index])
+                    indices.append(np.arange(start, start + entry['slices']))
+                    readers.append(np.full(entry['slices'], reader_index))
+        self.sample_readers = np.concatenate(readers) if readers else np.zeros(0, dtype=np.int64)
+        self.sample_indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+
+    # Function to build a dataset from every shard in a directory
+    @classmethod
+    def from_directory(cls, shard_dir, **kwargs):
+        with os.scandir(shard_dir) as entries:
+            shard_paths = sorted(entry.path for entry in entries if entry.name.endswith(SHARD_EXTENSION))
+        return cls(shard_paths, **kwargs)
+
+    def __len__(self):
+        return len(self.sample_indices)
+
+    # Function to read one (image, label) sample; uncompressed shards return read-only views of the mapped file
+    def __getitem__(self, index):
+        image, label, _ = self.readers[self.sample_readers[index]].read_slice(int(self.sample_indices[index]))
+        return image, label
+
+    # Function to yield the (image, label) samples of one epoch, in an order seeded by (seed, epoch)
+    def iterate(self, epoch=0):
+        order = np.random.default_rng([self.seed, epoch]).permutation(len(self)) if self.shuffle else range(len(self))
+        for index in order:
+            yield self[index]
+
+    def __iter__(self):
+        return self.iterate(epoch=0)
@@ -1,12 +1,22 @@
 import numpy as np
-from augmentation_utils import *
+from concurrent.futures import ThreadPoolExecutor
+from augmentation_utils import (normalize_image, convert_to_grayscale, rotate_image_and_label, flip_image_and_label,
+                                zoom_image_and_label, adjust_contrast, reduce_noise, fused_geometric_augmentations,
+                                normalize_volume, rotate_volume_and_label, flip_volume_and_label, zoom_volume_and_label,
+                                adjust_contrast_volume, reduce_noise_volume, fused_geometric_augmentations_volume,
+                                empty_volume, is_slice_major, slice_major_copy, validate_volume_and_label, CONTRAST_ALPHA)
+from instrumentation import stage, count
 
 # Function to process an individual image and its corresponding label, applying all augmentations
-def process_image_and_label(image, label):
+# With fused=True, rotate and zoom resample the original slice once through a combined matrix instead of resampling
+# the normalized slice again, and labels are normalized with nearest-neighbour interpolation
+def process_image_and_label(image, label, fused=False):
     if image is None or label is None or image.size == 0 or label.size == 0:
         raise ValueError("Input image or label is empty or None.")
     if image.shape != label.shape:
         raise ValueError("Image and label must have the same shape.")
+    if fused:
+        return process_image_and_label_fused(image, label)
 
     # Convert the image to grayscale and normalize both image and label to 512x512 pixels
     try:
@@ -29,44 +39,227 @@ def process_image_and_label(image, label):
     return [grayscale_image, rotated_image, flipped_image, zoomed_image, contrast_image, denoised_image], \
            [normalized_label, rotated_label, flipped_label, zoomed_label, contrast_label, denoised_label]
 
+# Function to process an individual image and its label with the geometric augmentations fused into one warp each
+def process_image_and_label_fused(image, label):
+    # Convert the image to grayscale first, which is per pixel and leaves the geometry to the fused warps
+    try:
+        grayscale_source = convert_to_grayscale(image)
+        images, labels = fused_geometric_augmentations(grayscale_source, label)
+    except Exception as e:
+        raise RuntimeError(f"Error during fused normalization, rotation or zoom: {e}")
+
+    # Flip, contrast and denoise do not resample, so they work on the normalized slice as before
+    try:
+        grayscale_image, normalized_label = images['normalized'], labels['normalized']
+        flipped_image, flipped_label = flip_image_and_label(grayscale_image, normalized_label)
+        contrast_image, contrast_label = adjust_contrast(grayscale_image, normalized_label)
+        denoised_image, denoised_label = reduce_noise(grayscale_image, normalized_label)
+    except Exception as e:
+        raise RuntimeError(f"Error during augmentation: {e}")
+
+    return [grayscale_image, images['rotated'], flipped_image, images['zoomed'], contrast_image, denoised_image], \
+           [normalized_label, labels['rotated'], flipped_label, labels['zoomed'], contrast_label, denoised_label]
+
+# Function to augment the slices in [start, stop) and write them into the output volumes by slice index
+# Returns the (slice index, error) pairs of slices that could not be processed, which are left unwritten
+def process_slice_range(volume, label, start, stop, out_volumes, out_labels, fused=False):
+    errors = []
+    for i in range(start, stop):
+        try:
+            augmentations, label_augmentations = process_image_and_label(volume[:, :, i], label[:, :, i], fused)
+            for j in range(6):
+                out_volumes[j][:, :, i] = augmentations[j]
+                out_labels[j][:, :, i] = label_augmentations[j]
+        except Exception as e:
+            errors.append((i, e))
+    return errors
+
 # Function to process an entire volume and its corresponding label, applying all augmentations slice by slice
-def process_volume_and_label(volume, label):
+# With num_threads > 1, chunks of chunk_size slices run on a thread pool (OpenCV releases the GIL while it works)
+# and write into shared output volumes by slice index, so slice order does not depend on the threads
+def process_volume_and_label(volume, label, num_threads=1, chunk_size=16, fused=False):
     if volume is None or label is None or volume.size == 0 or label.size == 0:
         raise ValueError("Input volume or label is empty or None.")
     if volume.shape != label.shape:
         raise ValueError("Volume and label must have the same shape.")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1.")
+    depth = volume.shape[2]
 
-    # Create lists to store the augmented volumes and labels for all slices
-    augmentations_volume = [[] for _ in range(6)]
-    augmentations_label = [[] for _ in range(6)]
-
-    # Loop through each slice in the volume and label
-    for i in range(volume.shape[2]):
-        image = volume[:, :, i]
-        label_slice = label[:, :, i]
-
-        # Apply augmentations to each slice
+    # Process slices in order until one succeeds, which gives the shape and dtype of every output volume
+    errors = []
+    first_slice = 0
+    while first_slice < depth:
         try:
-            augmentations, label_augmentations = process_image_and_label(image, label_slice)
+            augmentations, label_augmentations = process_image_and_label(volume[:, :, first_slice], label[:, :, first_slice], fused)
+            break
         except Exception as e:
-            print(f"Error processing slice {i}: {e}")
-            continue
-
-        # Store each augmented slice in the respective list
-        for j in range(6):
-            augmentations_volume[j].append(augmentations[j])
-            augmentations_label[j].append(label_augmentations[j])
+            errors.append((first_slice, e))
+            first_slice += 1
 
     # Validate that we have successfully processed slices
-    if any(len(aug) == 0 for aug in augmentations_volume):
+    if first_slice == depth:
+        for i, e in errors:
+            print(f"Error processing slice {i}: {e}")
         raise RuntimeError("Failed to process any slices for augmentation.")
 
-    # Stack the augmented slices along the third dimension to form complete volumes
+    # Preallocate one (H, W, Z) output per augmentation instead of building lists of slices and stacking them
+    augmentations_volume = [empty_volume(aug.shape + (depth,), aug.dtype) for aug in augmentations]
+    augmentations_label = [empty_volume(aug.shape + (depth,), aug.dtype) for aug in label_augmentations]
+    for j in range(6):
+        augmentations_volume[j][:, :, first_slice] = augmentations[j]
+        augmentations_label[j][:, :, first_slice] = label_augmentations[j]
+
+    # Loop through the remaining slices in chunks, on a thread pool if requested
+    chunks = [(start, min(start + chunk_size, depth)) for start in range(first_slice + 1, depth, chunk_size)]
+    if num_threads > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = [executor.submit(process_slice_range, volume, label, start, stop, augmentations_volume, augmentations_label,
+                                       fused)
+                       for start, stop in chunks]
+            for future in futures:
+                errors.extend(future.result())
+    else:
+        for start, stop in chunks:
+            errors.extend(process_slice_range(volume, label, start, stop, augmentations_volume, augmentations_label, fused))
+
+    count('slices_processed', depth - len(errors))
+    count('slices_skipped', len(errors))
+
+    # Report failed slices in slice order and drop them from the output, as the sequential loop always has
+    if errors:
+        for i, e in errors:
+            print(f"Error processing slice {i}: {e}")
+        processed = np.ones(depth, dtype=bool)
+        processed[[i for i, _ in errors]] = False
+        augmentations_volume = [aug[:, :, processed] for aug in augmentations_volume]
+        augmentations_label = [aug[:, :, processed] for aug in augmentations_label]
+
+    # Return the augmented volumes and labels
+    return augmentations_volume, augmentations_label
+
+# Function to process an entire volume and its corresponding label, applying each augmentation to all slices at once
+# Produces the same volumes as process_volume_and_label without the per-slice Python loop and np.stack copies
+# Results are written into out_volumes and out_labels when given (see allocate_augmentation_buffers), keeping the input dtypes
+# With fused=True the geometric augmentations are resampled once from the input, as in process_image_and_label_fused
+# augmentations optionally lists the indices to compute (e.g. the outdated ones on a rerun); the others are returned as None
+# label may be None for volumes without a segmentation, and the augmented labels are then all None
+# contrast_alpha is the contrast factor of the contrast augmentation (the DICOM script uses a lower one)
+def process_volume_and_label_batched(volume, label, out_volumes=None, out_labels=None, fused=False, augmentations=None,
+                                     contrast_alpha=CONTRAST_ALPHA):
+    volume_aug, label_aug = [None] * 6, [None] * 6
+    for i, augmented_volume, augmented_label in iter_volume_augmentations_batched(volume, label, out_volumes, out_labels,
+                                                                                  fused, augmentations, contrast_alpha):
+        volume_aug[i], label_aug[i] = augmented_volume, augmented_label
+
+    # Return all augmented volumes and labels in the same order as process_volume_and_label
+    return volume_aug, label_aug
+
+# Function to compute the augmentations of a volume one at a time, yielding (index, augmented volume, augmented label)
+# in the order of process_volume_and_label_batched, which takes the same arguments. Each augmentation is only computed
+# when the next one is asked for, and the generator keeps no reference to it after that, so a caller that writes each
+# one out and lets it go holds the normalized volume and about two augmentations at a time instead of all six.
+# Unless fused, the input volume and label are released once normalized, if the caller holds no other reference to them
+def iter_volume_augmentations_batched(volume, label, out_volumes=None, out_labels=None, fused=False, augmentations=None,
+                                      contrast_alpha=CONTRAST_ALPHA):
+    validate_volume_and_label(volume, label)
+    if out_volumes is None:
+        out_volumes = [None] * 6
+    if out_labels is None:
+        out_labels = [None] * 6
+    if len(out_volumes) != 6 or len(out_labels) != 6:
+        raise ValueError("out_volumes and out_labels must each hold six volumes.")
+    selected = set(range(6)) if augmentations is None else set(augmentations)
+    if not selected <= set(range(6)):
+        raise ValueError("augmentations must be indices between 0 and 5.")
+    depth = volume.shape[2]
+
+    # Normalize every slice to 512x512 pixels (volume slices are already single channel, so no grayscale conversion)
+    # The normalized volume is the source of every other augmentation, so it is always computed
     try:
-        augmentations_volume = [np.stack(aug, axis=2) for aug in augmentations_volume]
-        augmentations_label = [np.stack(aug, axis=2) for aug in augmentations_label]
+        with stage('augment.normalized'):
+            if fused:
+                # The fused warps all resample the input slices, so gather them once for every warp
+                if volume.shape[:2] != (512, 512) and not is_slice_major(volume):
+                    volume, label = slice_major_copy(volume), None if label is None else slice_major_copy(label)
+                volumes, labels = fused_geometric_augmentations_volume(
+                    volume, label, out_volumes={'normalized': out_volumes[0]}, out_labels={'normalized': out_labels[0]},
+                    names=['normalized'])
+                grayscale_volume, normalized_label = volumes['normalized'], labels['normalized']
+                del volumes, labels
+                # For 512x512 slices the normalized copy is the input, already gathered slice by slice
+                if volume.shape[:2] == (512, 512):
+                    volume, label = grayscale_volume, normalized_label
+            else:
+                grayscale_volume = normalize_volume(volume, out=out_volumes[0])
+                normalized_label = None if label is None else normalize_volume(label, out=out_labels[0])
+                volume = label = None
     except Exception as e:
-        raise RuntimeError(f"Error stacking augmented slices: {e}")
+        raise RuntimeError(f"Error during normalization: {e}")
+    if 0 in selected:
+        yield 0, grayscale_volume, normalized_label
 
-    # Return the augmented volumes and labels
-    return augmentations_volume, augmentations_label
\ No newline at end of file
+    # Function to resample the input once through the combined matrix of a geometric augmentation
+    def fused_geometry(name, i):
+        volumes, labels = fused_geometric_augmentations_volume(volume, label, out_volumes={name: out_volumes[i]},
+                                                               out_labels={name: out_labels[i]}, names=[name])
+        return volumes[name], labels[name]
+
+    # Apply each selected augmentation to the whole volume and label
+    steps = [
+        (1, 'rotated', lambda: fused_geometry('rotated', 1) if fused else rotate_volume_and_label(
+            grayscale_volume, normalized_label, out_volume=out_volumes[1], out_label=out_labels[1])),
+        (2, 'flipped', lambda: flip_volume_and_label(grayscale_volume, normalized_label, out_volume=out_volumes[2],
+                                                     out_label=out_labels[2])),
+        (3, 'zoomed', lambda: fused_geometry('zoomed', 3) if fused else zoom_volume_and_label(
+            grayscale_volume, normalized_label, out_volume=out_volumes[3], out_label=out_labels[3])),
+        (4, 'contrast', lambda: adjust_contrast_volume(grayscale_volume, normalized_label, alpha=contrast_alpha,
+                                                       out_volume=out_volumes[4])),
+        (5, 'denoised', lambda: reduce_noise_volume(grayscale_volume, normalized_label, out_volume=out_volumes[5])),
+    ]
+    for i, name, augment in steps:
+        if i not in selected:
+            continue
+        try:
+            with stage(f'augment.{name}'):
+                augmented_volume, augmented_label = augment()
+        except Exception as e:
+            raise RuntimeError(f"Error during augmentation: {e}")
+
+        # Contrast and denoise leave the label unchanged, so it is only copied when separate label buffers were given
+        if i in (4, 5) and out_labels[i] is not None and normalized_label is not None:
+            if out_labels[i] is not normalized_label:
+                out_labels[i][...] = normalized_label
+            augmented_label = out_labels[i]
+        yield i, augmented_volume, augmented_label
+        del augmented_volume, augmented_label
+
+    count('slices_processed', depth)
+
+# Function to augment a volume slab by slab from iterators of (start, slab) pairs such as file_handler2.iter_nifti_slabs
+# Yields (start, augmented volumes, augmented labels) for each slab as soon as it is read. Every augmentation works on
+# each slice on its own, so the slabs join up to exactly the whole-volume result of process_volume_and_label_batched
+def process_volume_slabs_batched(volume_slabs, label_slabs, fused=False, augmentations=None, contrast_alpha=CONTRAST_ALPHA):
+    for (start, volume_slab), (label_start, label_slab) in zip(volume_slabs, label_slabs):
+        if start != label_start:
+            raise ValueError(f"Volume slab at slice {start} does not line up with label slab at slice {label_start}.")
+        volume_aug, label_aug = process_volume_and_label_batched(volume_slab, label_slab, fused=fused,
+                                                                 augmentations=augmentations, contrast_alpha=contrast_alpha)
+        yield start, volume_aug, label_aug
+
+        # Release this slab's outputs before the next slab is augmented
+        del volume_slab, label_slab, volume_aug, label_aug
+
+# Function to estimate the peak bytes needed to augment a volume of the given shape with the batched engine
+# Counts the input volume and label, the label remap, the six augmented volumes (the contrast one is uint8),
+# the four distinct augmented labels and one extra image copy for the NIfTI writer. With streamed_variants, augmentations
+# are written one at a time as iter_volume_augmentations_batched yields them, so only the normalized volume and label
+# and two augmentations are held besides the input. windows counts the uint8 intensity windows of the normalized volume
+def estimate_augmentation_memory(shape, image_dtype, label_dtype, streamed_variants=False, windows=0):
+    image_bytes = np.dtype(image_dtype).itemsize
+    label_bytes = np.dtype(label_dtype).itemsize
+    input_voxels = int(np.prod(shape[:3]))
+    output_voxels = 512 * 512 * int(shape[2])
+    if streamed_variants:
+        return input_voxels * (image_bytes + 2 * label_bytes) + output_voxels * (4 * image_bytes + 3 * label_bytes + windows)
+    return input_voxels * (image_bytes + 2 * label_bytes) + output_voxels * (6 * image_bytes + 1 + 4 * label_bytes + windows)
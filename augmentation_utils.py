@@ -1,11 +1,29 @@
-import cv2
+import functools
 import numpy as np
+from lazy_imports import lazy_import
+
+cv2 = lazy_import('cv2')
+
+# Parameters of the six augmentations, used as the defaults of the functions below
+# augmentation_cache builds its cache keys from these, so a change here recomputes only the augmentations it affects
+NORMALIZED_SIZE = (512, 512)
+ROTATION_ANGLE = 30
+ROTATION_SCALE = 1
+FLIP_CODE = 1
+ZOOM_CROP = (50, 462)
+CONTRAST_ALPHA = 0.35
+CONTRAST_BETA = 0
+DENOISE_KERNEL = (5, 5)
+DENOISE_SIGMA = 0
 
 # Function to normalize the input image to a size of 512x512 pixels
+# Most CT slices are already 512x512, so those are only copied into C order instead of going through cv2.resize
 def normalize_image(image):
     if image is None or image.size == 0:
         raise ValueError("Input image is empty or None.")
-    return cv2.resize(image, (512, 512))
+    if image.shape[:2] == NORMALIZED_SIZE:
+        return np.array(image, order='C')
+    return cv2.resize(image, NORMALIZED_SIZE)
 
 # Function to convert an image to grayscale
 # If the input image has three channels, it is converted to a single channel grayscale image
@@ -20,25 +38,69 @@ def convert_to_grayscale(image):
         raise ValueError("Input image has an unsupported number of channels.")
 
 # Function to rotate both an image and its corresponding label by a specified angle
-def rotate_image_and_label(image, label, angle=30):
+def rotate_image_and_label(image, label, angle=ROTATION_ANGLE):
     if image is None or label is None or image.size == 0 or label.size == 0:
         raise ValueError("Input image or label is empty or None.")
     if image.shape != label.shape:
         raise ValueError("Image and label must have the same shape.")
     rows, cols = image.shape
-    rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1)
+    rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, ROTATION_SCALE)
     rotated_image = cv2.warpAffine(image, rotation_matrix, (cols, rows))
-    rotated_label = cv2.warpAffine(label, rotation_matrix, (cols, rows), flags=cv2.INTER_NEAREST)
+    if label.dtype in REMAP_PLAN_DTYPES:
+        rotated_label = remap_with_plan(label, rotation_matrix, nearest=True)
+    else:
+        rotated_label = cv2.warpAffine(label, rotation_matrix, (cols, rows), flags=cv2.INTER_NEAREST)
     return rotated_image, rotated_label
 
+# Fixed-point precision of the coordinates (AB_BITS) and interpolation table (INTER_BITS) inside OpenCV's warpAffine
+WARP_COORDINATE_BITS = 10
+WARP_INTERPOLATION_BITS = 5
+
+# Dtypes for which a cached remap plan gives the same pixels as warpAffine; label rotation uses the plans for these,
+# where nearest-neighbour remap measured as fast or faster (see benchmark_remap.py). OpenCV warps float32 and uint8
+# with separate kernels that round coordinates differently, and those kernels beat remap
+REMAP_PLAN_DTYPES = (np.float64, np.int16)
+
+# Function to build the fixed-point cv2.remap maps that warpAffine computes internally for a forward matrix
+# Plans are cached per (shape, matrix, interpolation), so every slice and volume of a run shares them
+@functools.lru_cache(maxsize=16)
+def remap_plan(rows, cols, matrix, nearest=False):
+    inverse = cv2.invertAffineTransform(np.array(matrix, dtype=np.float64).reshape(2, 3))
+    scale = 1 << WARP_COORDINATE_BITS
+    round_delta = scale // 2 if nearest else scale >> (WARP_INTERPOLATION_BITS + 1)
+    shift = WARP_COORDINATE_BITS if nearest else WARP_COORDINATE_BITS - WARP_INTERPOLATION_BITS
+    x, y = np.arange(cols), np.arange(rows)
+    map_x = np.rint((inverse[0, 1] * y + inverse[0, 2]) * scale).astype(np.int64)[:, None] + round_delta + \
+        np.rint(inverse[0, 0] * x * scale).astype(np.int64)[None, :]
+    map_y = np.rint((inverse[1, 1] * y + inverse[1, 2]) * scale).astype(np.int64)[:, None] + round_delta + \
+        np.rint(inverse[1, 0] * x * scale).astype(np.int64)[None, :]
+    map_x >>= shift
+    map_y >>= shift
+    if nearest:
+        coordinates, weights = np.dstack([map_x, map_y]), None
+    else:
+        table_mask = (1 << WARP_INTERPOLATION_BITS) - 1
+        coordinates = np.dstack([map_x >> WARP_INTERPOLATION_BITS, map_y >> WARP_INTERPOLATION_BITS])
+        weights = ((map_y & table_mask) << WARP_INTERPOLATION_BITS | (map_x & table_mask)).astype(np.uint16)
+        weights.flags.writeable = False
+    coordinates = np.clip(coordinates, -32768, 32767).astype(np.int16)
+    coordinates.flags.writeable = False
+    return coordinates, weights
+
+# Function to warp an image like cv2.warpAffine(image, matrix, (cols, rows)) through a cached remap plan
+def remap_with_plan(image, matrix, nearest=False):
+    rows, cols = image.shape[:2]
+    coordinates, weights = remap_plan(rows, cols, tuple(np.asarray(matrix, dtype=np.float64).ravel()), nearest)
+    return cv2.remap(image, coordinates, weights, cv2.INTER_NEAREST if nearest else cv2.INTER_LINEAR)
+
 # Function to flip both an image and its corresponding label horizontally
 def flip_image_and_label(image, label):
     if image is None or label is None or image.size == 0 or label.size == 0:
         raise ValueError("Input image or label is empty or None.")
     if image.shape != label.shape:
         raise ValueError("Image and label must have the same shape.")
-    flipped_image = cv2.flip(image, 1)
-    flipped_label = cv2.flip(label, 1)
+    flipped_image = cv2.flip(image, FLIP_CODE)
+    flipped_label = cv2.flip(label, FLIP_CODE)
     return flipped_image, flipped_label
 
 # Function to zoom into both an image and its corresponding label
@@ -48,14 +110,16 @@ def zoom_image_and_label(image, label):
         raise ValueError("Input image or label is empty or None.")
     if image.shape != label.shape:
         raise ValueError("Image and label must have the same shape.")
-    if image.shape[0] < 462 or image.shape[1] < 462:
-        raise ValueError("Input image and label must be at least 462x462 pixels for zooming.")
-    zoomed_image = image[50:462, 50:462]
-    zoomed_label = label[50:462, 50:462]
-    return cv2.resize(zoomed_image, (512, 512)), cv2.resize(zoomed_label, (512, 512), interpolation=cv2.INTER_NEAREST)
+    if image.shape[0] < ZOOM_CROP[1] or image.shape[1] < ZOOM_CROP[1]:
+        raise ValueError(f"Input image and label must be at least {ZOOM_CROP[1]}x{ZOOM_CROP[1]} pixels for zooming.")
+    crop = slice(*ZOOM_CROP)
+    zoomed_image = image[crop, crop]
+    zoomed_label = label[crop, crop]
+    return cv2.resize(zoomed_image, NORMALIZED_SIZE), cv2.resize(zoomed_label, NORMALIZED_SIZE,
+                                                                 interpolation=cv2.INTER_NEAREST)
 
 # Function to adjust the contrast of the image, with no changes to the label
-def adjust_contrast(image, label, alpha=0.35, beta=0):
+def adjust_contrast(image, label, alpha=CONTRAST_ALPHA, beta=CONTRAST_BETA):
     if image is None or label is None or image.size == 0 or label.size == 0:
         raise ValueError("Input image or label is empty or None.")
     contrast_image = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
@@ -65,5 +129,282 @@ def adjust_contrast(image, label, alpha=0.35, beta=0):
 def reduce_noise(image, label):
     if image is None or label is None or image.size == 0 or label.size == 0:
         raise ValueError("Input image or label is empty or None.")
-    denoised_image = cv2.GaussianBlur(image, (5, 5), 0)
-    return denoised_image, label
\ No newline at end of file
+    denoised_image = cv2.GaussianBlur(image, DENOISE_KERNEL, DENOISE_SIGMA)
+    return denoised_image, label
+
+# Number of slices resampled together as the channels of a single OpenCV image
+# OpenCV's 3- and 4-channel resampling kernels give the same pixels as running each slice on its own
+RESAMPLE_BATCH_SLICES = 4
+
+# Number of slices blurred together as channels. OpenCV's Gaussian blur is fastest on single-channel images
+# (wider batches measured 1.5-6x slower for every dtype), so slices are blurred one at a time
+FILTER_BATCH_SLICES = 1
+
+# Function to validate a volume and its corresponding label once, instead of once per slice
+# The volume augmentations accept label=None for images without a segmentation (such as DICOM series),
+# and then return None in place of every augmented label
+def validate_volume_and_label(volume, label):
+    if volume is None or volume.size == 0 or (label is not None and label.size == 0):
+        raise ValueError("Input volume or label is empty or None.")
+    if volume.ndim != 3:
+        raise ValueError("Input volume must have shape (H, W, Z).")
+    if label is not None and volume.shape != label.shape:
+        raise ValueError("Volume and label must have the same shape.")
+
+# Function to split the slice axis into batches of at most batch_size slices
+# Batches of two slices are split further because OpenCV's 2-channel kernels round differently
+def slice_batches(depth, batch_size):
+    for start in range(0, depth, batch_size):
+        stop = min(start + batch_size, depth)
+        if stop - start == 2:
+            yield start, start + 1
+            yield start + 1, stop
+        else:
+            yield start, stop
+
+# Function to allocate an (H, W, Z) volume whose slices are each contiguous in memory
+# Slice-major storage keeps batch gathers and scatters sequential, unlike C-order (H, W, Z) where slices are interleaved
+def empty_volume(shape, dtype):
+    return np.empty((shape[2], shape[0], shape[1]), dtype=dtype).transpose(1, 2, 0)
+
+# Function to check a caller-provided output volume, or allocate a new one when none is given
+def output_volume(out, shape, dtype):
+    if out is None:
+        return empty_volume(shape, dtype)
+    if out.shape != tuple(shape) or out.dtype != np.dtype(dtype):
+        raise ValueError(f"Output volume must have shape {tuple(shape)} and dtype {np.dtype(dtype)}, got {out.shape} and {out.dtype}.")
+    return out
+
+# Function to check whether every slice of an (H, W, Z) volume is contiguous, as in volumes from empty_volume
+def is_slice_major(volume):
+    return volume.shape[2] == 0 or volume[:, :, 0].flags.c_contiguous
+
+# Function to copy an (H, W, Z) volume into slice-major storage
+def slice_major_copy(volume):
+    copy = empty_volume(volume.shape, volume.dtype)
+    copy[...] = volume
+    return copy
+
+# Function to apply a per-slice OpenCV operation to a whole (H, W, Z) volume, a batch of slices at a time
+# The slices of each batch are handed to OpenCV as the channels of one image
+def apply_to_volume(operation, volume, batch_size, out_shape, out_dtype, out=None):
+    out = output_volume(out, out_shape + (volume.shape[2],), out_dtype)
+    write_in_place = is_slice_major(out)
+    for start, stop in slice_batches(volume.shape[2], batch_size):
+        # cv2.merge and cv2.split interleave and de-interleave channels much faster than numpy fancy copies
+        batch = cv2.merge([np.ascontiguousarray(volume[:, :, i]) for i in range(start, stop)])
+        result = operation(batch)
+        if stop - start == 1:
+            out[:, :, start] = result
+        elif write_in_place:
+            # The slices of a slice-major volume are contiguous, so cv2.split writes straight into them
+            cv2.split(result, [out[:, :, i] for i in range(start, stop)])
+        else:
+            for i, result_slice in enumerate(cv2.split(result), start):
+                out[:, :, i] = result_slice
+    return out
+
+# Function to normalize every slice of a volume to 512x512 pixels
+def normalize_volume(volume, out=None):
+    if volume is None or volume.size == 0:
+        raise ValueError("Input volume is empty or None.")
+    # Resizing to the same size is a plain copy in OpenCV, so already normalized volumes skip resampling
+    if volume.shape[:2] == NORMALIZED_SIZE:
+        normalized_volume = output_volume(out, volume.shape, volume.dtype)
+        normalized_volume[...] = volume
+        return normalized_volume
+    return apply_to_volume(lambda batch: cv2.resize(batch, NORMALIZED_SIZE),
+                           volume, RESAMPLE_BATCH_SLICES, NORMALIZED_SIZE, volume.dtype, out)
+
+# Function to rotate every slice of a volume and its label by a specified angle
+# Labels of REMAP_PLAN_DTYPES (the float64 labels of main2.py without --native-dtype) go through the cached remap plan,
+# which every slice and every volume of the same shape shares
+def rotate_volume_and_label(volume, label, angle=ROTATION_ANGLE, out_volume=None, out_label=None):
+    validate_volume_and_label(volume, label)
+    rows, cols = volume.shape[:2]
+    rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, ROTATION_SCALE)
+    rotated_volume = apply_to_volume(lambda batch: cv2.warpAffine(batch, rotation_matrix, (cols, rows)),
+                                     volume, RESAMPLE_BATCH_SLICES, (rows, cols), volume.dtype, out_volume)
+    if label is None:
+        return rotated_volume, None
+    if label.dtype in REMAP_PLAN_DTYPES:
+        rotate_label = lambda batch: remap_with_plan(batch, rotation_matrix, nearest=True)
+    else:
+        rotate_label = lambda batch: cv2.warpAffine(batch, rotation_matrix, (cols, rows), flags=cv2.INTER_NEAREST)
+    rotated_label = apply_to_volume(rotate_label, label, RESAMPLE_BATCH_SLICES, (rows, cols), label.dtype, out_label)
+    return rotated_volume, rotated_label
+
+# Function to flip every slice of a volume and its label horizontally
+# A reversed view of the column axis gives exactly the pixels of cv2.flip(image, 1)
+def flip_volume_and_label(volume, label, out_volume=None, out_label=None):
+    validate_volume_and_label(volume, label)
+    flipped_volume = output_volume(out_volume, volume.shape, volume.dtype)
+    flipped_volume[...] = volume[:, ::-1, :]
+    if label is None:
+        return flipped_volume, None
+    flipped_label = output_volume(out_label, label.shape, label.dtype)
+    flipped_label[...] = label[:, ::-1, :]
+    return flipped_volume, flipped_label
+
+# Function to zoom into every slice of a volume and its label
+# The central region of each slice is cropped and then resized back to 512x512 pixels
+def zoom_volume_and_label(volume, label, out_volume=None, out_label=None):
+    validate_volume_and_label(volume, label)
+    if volume.shape[0] < ZOOM_CROP[1] or volume.shape[1] < ZOOM_CROP[1]:
+        raise ValueError(f"Input image and label must be at least {ZOOM_CROP[1]}x{ZOOM_CROP[1]} pixels for zooming.")
+    crop = slice(*ZOOM_CROP)
+    zoomed_volume = apply_to_volume(lambda batch: cv2.resize(batch, NORMALIZED_SIZE),
+                                    volume[crop, crop], RESAMPLE_BATCH_SLICES, NORMALIZED_SIZE, volume.dtype, out_volume)
+    zoomed_label = None if label is None else apply_to_volume(
+        lambda batch: cv2.resize(batch, NORMALIZED_SIZE, interpolation=cv2.INTER_NEAREST),
+        label[crop, crop], RESAMPLE_BATCH_SLICES, NORMALIZED_SIZE, label.dtype, out_label)
+    return zoomed_volume, zoomed_label
+
+# Function to adjust the contrast of a whole volume in one call, with no changes to the label
+# convertScaleAbs is element-wise, so the slices are passed to OpenCV as one tall 2D image
+def adjust_contrast_volume(volume, label, alpha=CONTRAST_ALPHA, beta=CONTRAST_BETA, out_volume=None):
+    validate_volume_and_label(volume, label)
+    contrast_volume = output_volume(out_volume, volume.shape, np.uint8)
+    slices = np.ascontiguousarray(volume.transpose(2, 0, 1)).reshape(-1, volume.shape[1])
+    if is_slice_major(contrast_volume):
+        cv2.convertScaleAbs(slices, contrast_volume.transpose(2, 0, 1).reshape(slices.shape), alpha=alpha, beta=beta)
+    else:
+        contrast_volume[...] = cv2.convertScaleAbs(slices, alpha=alpha, beta=beta).reshape(
+            volume.shape[2], volume.shape[0], volume.shape[1]).transpose(1, 2, 0)
+    return contrast_volume, label
+
+# Function to reduce noise in every slice of a volume using Gaussian blur, with no changes to the label
+def reduce_noise_volume(volume, label, out_volume=None):
+    validate_volume_and_label(volume, label)
+    denoised_volume = apply_to_volume(lambda batch: cv2.GaussianBlur(batch, DENOISE_KERNEL, DENOISE_SIGMA),
+                                      volume, FILTER_BATCH_SLICES, volume.shape[:2], volume.dtype, out_volume)
+    return denoised_volume, label
+
+# Function to preallocate the six augmented volumes and labels produced for a volume of the given shape
+# Images keep image_dtype (except the uint8 contrast image); the unchanged contrast and denoise labels share the normalized label
+# With augmentations given, only those indices (and the normalized volume every augmentation starts from) get buffers
+def allocate_augmentation_buffers(shape, image_dtype, label_dtype, augmentations=None):
+    output_shape = NORMALIZED_SIZE + (shape[2],)
+    needed = set(range(6)) if augmentations is None else set(augmentations) | {0}
+    volumes = [empty_volume(output_shape, np.uint8 if i == 4 else image_dtype) if i in needed else None for i in range(6)]
+    labels = [empty_volume(output_shape, label_dtype) if i in needed else None for i in range(4)]
+    return volumes, labels + [labels[0], labels[0]]
+
+
+# Function to build the 3x3 matrix mapping pixel coordinates of a cv2.resize output back to its input
+# Follows OpenCV's pixel-centre convention, src = (dst + 0.5) * scale - 0.5
+def resize_affine(src_shape, dst_size=NORMALIZED_SIZE):
+    scale_x = src_shape[1] / dst_size[0]
+    scale_y = src_shape[0] / dst_size[1]
+    return np.array([[scale_x, 0, 0.5 * scale_x - 0.5],
+                     [0, scale_y, 0.5 * scale_y - 0.5],
+                     [0, 0, 1]])
+
+# Function to build the matrix mapping output pixels of a crop (at top, left, of crop_shape) resized to dst_size back to the input
+def crop_resize_affine(top, left, crop_shape, dst_size=NORMALIZED_SIZE):
+    matrix = resize_affine(crop_shape, dst_size)
+    matrix[0, 2] += left
+    matrix[1, 2] += top
+    return matrix
+
+# Function to build the matrix mapping output pixels of rotate_image_and_label back to its input
+def rotation_affine(shape, angle=ROTATION_ANGLE):
+    rows, cols = shape[:2]
+    rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, ROTATION_SCALE)
+    return np.vstack([cv2.invertAffineTransform(rotation_matrix), [0, 0, 1]])
+
+# Function to combine output-to-input matrices, given in the order the transforms are applied to the image
+def compose_affines(*matrices):
+    composed = np.eye(3)
+    for matrix in matrices:
+        composed = composed @ matrix
+    return composed
+
+# Function to build the fused output-to-input matrices of the geometric augmentations for an input of the given shape
+# Each augmentation is a single resample of the original slice: normalize to 512x512, then rotate or zoom
+def geometric_affines(shape, angle=ROTATION_ANGLE):
+    normalize = resize_affine(shape)
+    return {
+        'normalized': normalize,
+        'rotated': compose_affines(normalize, rotation_affine(NORMALIZED_SIZE, angle)),
+        'zoomed': compose_affines(normalize, crop_resize_affine(ZOOM_CROP[0], ZOOM_CROP[0],
+                                                                (ZOOM_CROP[1] - ZOOM_CROP[0],) * 2)),
+    }
+
+# Function to find the whole-pixel crop (top, left, rows, cols) that an axis-aligned matrix resizes to 512x512, if any
+def matrix_crop(matrix, shape):
+    if matrix[0, 1] != 0 or matrix[1, 0] != 0:
+        return None
+    crop = np.array([matrix[1, 2] - 0.5 * matrix[1, 1] + 0.5, matrix[0, 2] - 0.5 * matrix[0, 0] + 0.5,
+                     matrix[1, 1] * NORMALIZED_SIZE[0], matrix[0, 0] * NORMALIZED_SIZE[1]])
+    rounded = np.round(crop)
+    top, left, rows, cols = (int(n) for n in rounded)
+    if not np.allclose(crop, rounded, atol=1e-9) or top < 0 or left < 0 or top + rows > shape[0] or left + cols > shape[1]:
+        return None
+    return top, left, rows, cols
+
+# Function to resample an image to 512x512 through an output-to-input matrix with one interpolation
+# A matrix that only crops and scales on whole pixels goes through cv2.resize, which is much faster than warpAffine
+# (and is just a copy for a 512x512 slice being normalized). OpenCV has no fast linear warp for 16-bit images,
+# so those are warped in float32 and rounded back. interpolation and border_mode default to linear and replicated borders
+def warp_image(image, matrix, interpolation=None, border_mode=None):
+    interpolation = cv2.INTER_LINEAR if interpolation is None else interpolation
+    border_mode = cv2.BORDER_REPLICATE if border_mode is None else border_mode
+    crop = matrix_crop(matrix, image.shape)
+    if crop is not None:
+        top, left, rows, cols = crop
+        region = image[top:top + rows, left:left + cols]
+        if (rows, cols) == NORMALIZED_SIZE:
+            return np.array(region, order='C')
+        return cv2.resize(np.ascontiguousarray(region), NORMALIZED_SIZE, interpolation=interpolation)
+    image = np.ascontiguousarray(image)
+    if interpolation != cv2.INTER_NEAREST and image.dtype in (np.int16, np.uint16):
+        warped = cv2.warpAffine(image.astype(np.float32), matrix[:2], NORMALIZED_SIZE,
+                                flags=interpolation | cv2.WARP_INVERSE_MAP, borderMode=border_mode)
+        limits = np.iinfo(image.dtype)
+        return np.clip(np.rint(warped), limits.min, limits.max, out=warped).astype(image.dtype)
+    return cv2.warpAffine(image, matrix[:2], NORMALIZED_SIZE, flags=interpolation | cv2.WARP_INVERSE_MAP,
+                          borderMode=border_mode)
+
+# Function to apply the normalize, rotate and zoom augmentations to an image and its label with one resample each
+# Labels use nearest-neighbour interpolation throughout; rotation fills with zeros as rotate_image_and_label does
+def fused_geometric_augmentations(image, label, angle=ROTATION_ANGLE):
+    if image is None or label is None or image.size == 0 or label.size == 0:
+        raise ValueError("Input image or label is empty or None.")
+    if image.shape[:2] != label.shape[:2]:
+        raise ValueError("Image and label must have the same shape.")
+    affines = geometric_affines(image.shape, angle)
+    borders = {'normalized': cv2.BORDER_REPLICATE, 'rotated': cv2.BORDER_CONSTANT, 'zoomed': cv2.BORDER_REPLICATE}
+    images = {name: warp_image(image, matrix, cv2.INTER_LINEAR, borders[name]) for name, matrix in affines.items()}
+    labels = {name: warp_image(label, matrix, cv2.INTER_NEAREST, borders[name]) for name, matrix in affines.items()}
+    return images, labels
+
+# Function to apply the fused normalize, rotate and zoom augmentations to every slice of a volume and its label
+# Returns dicts of volumes keyed like geometric_affines; out_volumes and out_labels optionally hold preallocated outputs
+# and names limits the work to some of the augmentations
+def fused_geometric_augmentations_volume(volume, label, angle=ROTATION_ANGLE, out_volumes=None, out_labels=None,
+                                         names=None):
+    validate_volume_and_label(volume, label)
+    out_volumes = out_volumes or {}
+    out_labels = out_labels or {}
+    affines = geometric_affines(volume.shape, angle)
+    if names is not None:
+        affines = {name: matrix for name, matrix in affines.items() if name in names}
+    borders = {'normalized': cv2.BORDER_REPLICATE, 'rotated': cv2.BORDER_CONSTANT, 'zoomed': cv2.BORDER_REPLICATE}
+    volumes, labels = {}, {}
+    if volume.shape[:2] == NORMALIZED_SIZE and 'normalized' in affines:
+        # 512x512 slices need no resampling to normalize, and the normalized copy is then the source of the other warps
+        volumes['normalized'] = volume = normalize_volume(volume, out=out_volumes.get('normalized'))
+        labels['normalized'] = label = None if label is None else normalize_volume(label, out=out_labels.get('normalized'))
+    elif not is_slice_major(volume):
+        # Gather the slices once rather than once per augmentation
+        volume, label = slice_major_copy(volume), None if label is None else slice_major_copy(label)
+    for name, matrix in affines.items():
+        if name in volumes:
+            continue
+        volumes[name] = apply_to_volume(lambda batch: warp_image(batch, matrix, cv2.INTER_LINEAR, borders[name]), volume,
+                                        RESAMPLE_BATCH_SLICES, NORMALIZED_SIZE, volume.dtype, out_volumes.get(name))
+        labels[name] = None if label is None else apply_to_volume(
+            lambda batch: warp_image(batch, matrix, cv2.INTER_NEAREST, borders[name]),
+            label, RESAMPLE_BATCH_SLICES, NORMALIZED_SIZE, label.dtype, out_labels.get(name))
+    return volumes, labels
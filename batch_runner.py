@@ -0,0 +1,233 @@
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+# Suffixes accepted by parse_memory_size, in bytes
+MEMORY_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# Function to parse a memory size such as '512M', '16G' or '1073741824' into a number of bytes
+def parse_memory_size(size):
+    if size is None:
+        return None
+    if isinstance(size, (int, float)):
+        return int(size)
+    text = str(size).strip().upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in MEMORY_UNITS else ''
+    try:
+        return int(float(text[:len(text) - len(unit)]) * MEMORY_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid memory size: {size}")
+
+# Function to pair volume and label files in a data directory, sorted for consistency
+def find_volume_label_pairs(data_dir, extension='.nii.gz'):
+    if not os.path.isdir(data_dir):
+        raise FileNotFoundError(f"Data directory not found: {data_dir}")
+    file_names = os.listdir(data_dir)
+    volume_files = sorted([f for f in file_names if f.startswith('volume') and f.endswith(extension)])
+    label_files = sorted([f for f in file_names if f.startswith('labels') and f.endswith(extension)])
+
+    # Validate that there is a matching label for each volume
+    if len(volume_files) != len(label_files):
+        raise ValueError("The number of volume files and label files must be the same.")
+    return list(zip(volume_files, label_files))
+
+# Function to give the tasks of one shard of a batch split between several machines, the same on every machine
+# Tasks are dealt largest first to the shard with the least work so far (by weights, e.g. input file sizes, or by count),
+# so shards finish at about the same time. Ties go by task name, which keeps the split deterministic
+def partition_tasks(tasks, num_shards, shard_index, weights=None):
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Shard index {shard_index} is out of range for {num_shards} shards.")
+    weights = weights or {}
+    loads = [0] * num_shards
+    assigned = set()
+    for name, _ in sorted(tasks, key=lambda task: (-weights.get(task[0], 1), task[0])):
+        shard = min(range(num_shards), key=lambda i: loads[i])
+        loads[shard] += weights.get(name, 1)
+        if shard == shard_index:
+            assigned.add(name)
+    return [task for task in tasks if task[0] in assigned]
+
+# Function to keep OpenCV from starting its own thread pool in every worker process
+def limit_worker_threads():
+    try:
+        import cv2
+        cv2.setNumThreads(1)
+    except ImportError:
+        pass
+
+# Function to run a task in a worker and capture any error as text, so one bad volume never stops the batch
+def run_task(task_fn, task_args):
+    try:
+        return True, task_fn(*task_args)
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+
+# Function to call prepare(name, args) on a task, capturing any error as text like run_task
+# Returns (True, the args to run the task with or None) or (False, the error), so a task whose inputs cannot be read
+# while preparing it (e.g. hashing a missing file) fails on its own instead of stopping the batch
+def prepare_task(prepare, name, task_args):
+    try:
+        return True, prepare(name, task_args)
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}\n{traceback.format_exc()}"
+
+# Function to estimate a task's peak memory, treating unreadable inputs as free so the task itself reports the error
+def estimate_task_memory(estimate_fn, task_args):
+    try:
+        return estimate_fn(*task_args)
+    except Exception:
+        return 0
+
+# Function to run task_fn over every task on a pool of worker processes within a memory budget
+# tasks is a list of (name, args) pairs and estimate_fn(*args) gives the peak bytes a task is expected to use.
+# Tasks start in list order while their estimates fit into memory_budget alongside the running tasks;
+# a task larger than the whole budget runs on its own. Returns (results, failures), both dicts keyed by task name
+# and ordered like tasks, so the outcome does not depend on the number of workers or the completion order.
+# on_complete(name, succeeded, value) is called in this process as each task finishes, e.g. to record progress.
+# prepare(name, args) is called in this process just before a task starts and returns the args to run it with, or None
+# to leave the task out of this run (e.g. because another machine claimed it); such tasks are in neither dict.
+# A task whose prepare raises is recorded as failed with that error
+def run_batch(task_fn, tasks, num_workers=None, memory_budget=None, estimate_fn=None, on_complete=None, prepare=None):
+    num_workers = num_workers or os.cpu_count() or 1
+    memory_budget = parse_memory_size(memory_budget)
+    outcomes = {}
+
+    # Function to keep the outcome of a finished task and report it
+    def finish(name, outcome):
+        outcomes[name] = outcome
+        if on_complete is not None:
+            on_complete(name, *outcome)
+
+    # Run in this process when only one worker is requested, which keeps tracebacks and profilers simple
+    if num_workers == 1:
+        for name, task_args in tasks:
+            if prepare is not None:
+                prepared, task_args = prepare_task(prepare, name, task_args)
+                if not prepared:
+                    finish(name, (False, task_args))
+                    continue
+                if task_args is None:
+                    continue
+            finish(name, run_task(task_fn, task_args))
+    else:
+        use_budget = memory_budget is not None and estimate_fn is not None
+        pending = [(name, task_args, estimate_task_memory(estimate_fn, task_args) if use_budget else 0) for name, task_args in tasks]
+        running = {}
+        in_flight_bytes = 0
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=limit_worker_threads) as executor:
+            while pending or running:
+                # Start tasks in order for as long as there is a free worker and room in the memory budget
+                while pending and len(running) < num_workers:
+                    name, task_args, estimate = pending[0]
+                    if use_budget and running and in_flight_bytes + estimate > memory_budget:
+                        break
+                    pending.pop(0)
+                    if prepare is not None:
+                        prepared, task_args = prepare_task(prepare, name, task_args)
+                        if not prepared:
+                            finish(name, (False, task_args))
+                            continue
+                        if task_args is None:
+                            continue
+                    try:
+                        running[executor.submit(run_task, task_fn, task_args)] = (name, estimate)
+                    except BrokenProcessPool as e:
+                        finish(name, (False, f"{type(e).__name__}: {e}"))
+                        continue
+                    in_flight_bytes += estimate
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, estimate = running.pop(future)
+                    in_flight_bytes -= estimate
+                    try:
+                        outcome = future.result()
+                    except Exception as e:
+                        # The worker process itself died (e.g. killed by the OOM killer)
+                        outcome = False, f"{type(e).__name__}: {e}"
+                    finish(name, outcome)
+
+    results, failures = {}, {}
+    for name, _ in tasks:
+        if name not in outcomes:
+            continue
+        succeeded, value = outcomes[name]
+        (results if succeeded else failures)[name] = value
+    return results, failures
+
+# Function to run every task through a pipeline of stages in this process, each stage on its own thread
+# The first of stages is called with a task's args and each later stage with the value the one before returned; the
+# last gives the task's result. Stages are connected by queues holding up to queue_size values, so a stage that gets
+# ahead blocks until the next one catches up (backpressure) and at most about 2 * queue_size + 1 tasks are in flight
+# per stage boundary. With every stage busy on another task, e.g. reading one volume while augmenting the next and
+# writing the one before, a batch takes about as long as its slowest stage instead of the sum of all of them.
+# An error in any stage fails that task only and skips its remaining stages. Returns (results, failures) like run_batch;
+# prepare and on_complete are as for run_batch, and never run at the same time as each other
+def run_pipelined_batch(stages, tasks, queue_size=1, on_complete=None, prepare=None):
+    if queue_size < 1:
+        raise ValueError("queue_size must be at least 1.")
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    callback_lock = threading.Lock()
+    errors = []
+
+    # Function run by the first stage's thread: prepare each task in turn and run the stage on it
+    def read_tasks():
+        try:
+            for name, task_args in tasks:
+                if prepare is not None:
+                    with callback_lock:
+                        prepared, task_args = prepare_task(prepare, name, task_args)
+                    if not prepared:
+                        # Failed tasks pass through the later stages untouched, so the error reaches on_complete
+                        queues[0].put((name, (False, task_args)))
+                        continue
+                    if task_args is None:
+                        continue
+                queues[0].put((name, run_task(stages[0], task_args)))
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            queues[0].put(None)
+
+    # Function run by the thread of every later stage, passing failed tasks through untouched
+    def run_stage(stage_fn, inbox, outbox):
+        try:
+            while (item := inbox.get()) is not None:
+                name, (succeeded, value) = item
+                del item
+                outbox.put((name, run_task(stage_fn, (value,)) if succeeded else (False, value)))
+                del value
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            outbox.put(None)
+
+    threads = [threading.Thread(target=read_tasks, daemon=True)]
+    threads += [threading.Thread(target=run_stage, args=(stage_fn, inbox, outbox), daemon=True)
+                for stage_fn, inbox, outbox in zip(stages[1:], queues, queues[1:])]
+    for thread in threads:
+        thread.start()
+    outcomes = {}
+    while (item := queues[-1].get()) is not None:
+        name, outcome = item
+        outcomes[name] = outcome
+        if on_complete is not None:
+            with callback_lock:
+                on_complete(name, *outcome)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    results, failures = {}, {}
+    for name, _ in tasks:
+        if name not in outcomes:
+            continue
+        succeeded, value = outcomes[name]
+        (results if succeeded else failures)[name] = value
+    return results, failures
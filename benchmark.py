@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Version of the JSON report layout
+REPORT_VERSION = 1
+
+# Function to read the peak resident set size of this process in MB, or None where the resource module is missing
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+# Class to load the benchmark inputs of one case on first use, so each case only holds the data it needs in memory
+class BenchmarkInputs:
+    def __init__(self, data_dir, output_dir):
+        self.data_dir = data_dir
+        self.output_dir = output_dir
+        self.volume_path = os.path.join(data_dir, 'volume-0.nii.gz')
+        self.label_path = os.path.join(data_dir, 'labels-0.nii.gz')
+        self.dicom_dir = os.path.join(data_dir, 'dicom')
+
+    # Volume in its native dtype and the label remapped to one organ, as main2.py loads them
+    @functools.cached_property
+    def volume(self):
+        from file_handler2 import load_nifti_file
+        return load_nifti_file(self.volume_path, dtype='native')[0]
+
+    @functools.cached_property
+    def label(self):
+        from file_handler2 import load_nifti_file
+        return (load_nifti_file(self.label_path, dtype='native')[0] == 3).astype(np.uint8)
+
+    # Normalized (512x512, slice-major) volume and label, the input of every augmentation after normalization
+    @functools.cached_property
+    def normalized(self):
+        from augmentation_utils import normalize_volume
+        return normalize_volume(self.volume), normalize_volume(self.label)
+
+    # Augmented outputs of the batched engine, the input of the save benchmark
+    @functools.cached_property
+    def augmented(self):
+        from augmentation_pipeline import process_volume_and_label_batched
+        return process_volume_and_label_batched(self.volume, self.label)
+
+    @property
+    def input_bytes(self):
+        return self.volume.nbytes + self.label.nbytes
+
+# Function to time a per-slice augmentation over every normalized slice; operation takes (image, label)
+def per_slice_case(operation, normalized=True):
+    def run(inputs):
+        volume, label = inputs.normalized if normalized else (inputs.volume, inputs.label)
+        for i in range(volume.shape[2]):
+            operation(volume[:, :, i], label[:, :, i])
+        return volume.shape[2], volume.nbytes + label.nbytes
+    return run
+
+# Function to time a whole-volume operation on the normalized (or loaded) volume; operation takes (volume, label)
+def volume_case(operation, normalized=True):
+    def run(inputs):
+        volume, label = inputs.normalized if normalized else (inputs.volume, inputs.label)
+        operation(volume, label)
+        return volume.shape[2], volume.nbytes + label.nbytes
+    return run
+
+def augmentation_utils_cases():
+    import augmentation_utils as au
+    return {
+        'normalize_image': per_slice_case(lambda image, label: au.normalize_image(image), normalized=False),
+        'convert_to_grayscale': per_slice_case(lambda image, label: au.convert_to_grayscale(image)),
+        'rotate_image_and_label': per_slice_case(au.rotate_image_and_label),
+        'flip_image_and_label': per_slice_case(au.flip_image_and_label),
+        'zoom_image_and_label': per_slice_case(au.zoom_image_and_label),
+        'adjust_contrast': per_slice_case(au.adjust_contrast),
+        'reduce_noise': per_slice_case(au.reduce_noise),
+        'normalize_volume': volume_case(lambda volume, label: (au.normalize_volume(volume), au.normalize_volume(label)),
+                                        normalized=False),
+        'rotate_volume_and_label': volume_case(au.rotate_volume_and_label),
+        'flip_volume_and_label': volume_case(au.flip_volume_and_label),
+        'zoom_volume_and_label': volume_case(au.zoom_volume_and_label),
+        'adjust_contrast_volume': volume_case(au.adjust_contrast_volume),
+        'reduce_noise_volume': volume_case(au.reduce_noise_volume),
+        'fused_geometric_augmentations_volume': volume_case(au.fused_geometric_augmentations_volume, normalized=False),
+    }
+
+def pipeline_cases():
+    import augmentation_pipeline as ap
+    return {
+        'process_image_and_label': per_slice_case(ap.process_image_and_label, normalized=False),
+        'process_volume_and_label': volume_case(ap.process_volume_and_label, normalized=False),
+        'process_volume_and_label_batched': volume_case(ap.process_volume_and_label_batched, normalized=False),
+        'process_volume_and_label_batched_fused': volume_case(
+            lambda volume, label: ap.process_volume_and_label_batched(volume, label, fused=True), normalized=False),
+    }
+
+def io_cases():
+    import file_handler2 as fh
+    import main2
+
+    def nifti_load(inputs):
+        volume = fh.load_nifti_file(inputs.volume_path, dtype='native')[0]
+        label = fh.load_nifti_file(inputs.label_path, dtype='native')[0]
+        return volume.shape[2], volume.nbytes + label.nbytes
+
+    def nifti_save(inputs):
+        volume_aug, label_aug = inputs.augmented
+        _, affine, metadata = fh.load_nifti_file(inputs.volume_path, dtype='native')
+        fh.save_augmented_volumes(volume_aug, label_aug, inputs.output_dir, 'volume-0', affine, metadata)
+        return volume_aug[0].shape[2], sum(aug.nbytes for aug in volume_aug + label_aug if aug is not None)
+
+    def end_to_end(slab_size):
+        def run(inputs):
+            result = main2.process_volume_pair(inputs.volume_path, inputs.label_path, inputs.output_dir, preserve_dtype=True,
+                                               slab_size=slab_size)
+            depth = result['shape'][2]
+            return depth, inputs.input_bytes
+        return run
+
+    def dicom_series_read(inputs):
+        import process_dicom
+        volume, _ = process_dicom.read_dicom_series(process_dicom.find_dicom_files(inputs.dicom_dir))
+        return volume.shape[2], volume.nbytes
+
+    def dicom_series_round_trip(inputs):
+        import process_dicom
+        file_paths = process_dicom.find_dicom_files(inputs.dicom_dir)
+        process_dicom.process_dicom_series(file_paths, os.path.join(inputs.output_dir, 'dicom'))
+        return len(file_paths), sum(os.path.getsize(file_path) for file_path in file_paths)
+
+    return {
+        'nifti_load': nifti_load,
+        'nifti_save': nifti_save,
+        'nifti_round_trip': end_to_end(None),
+        'nifti_round_trip_streaming': end_to_end(32),
+        'dicom_series_read': dicom_series_read,
+        'dicom_series_round_trip': dicom_series_round_trip,
+    }
+
+# Modules whose import is timed: the entry points of the command line tools, and what pool workers import
+IMPORT_TIMED_MODULES = ['main2', 'process_dicom', 'process_nifty2', 'split_data', 'dicom_index', 'augmentation_pipeline',
+                        'file_handler2', 'augmentation_dataset']
+
+# Function to time starting a fresh interpreter with the given arguments in the repository directory, as pool workers
+# and short command line invocations do. Each run counts as one slice and no bytes
+def interpreter_case(arguments):
+    def run(inputs):
+        completed = subprocess.run([sys.executable] + arguments, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   capture_output=True, text=True)
+        if completed.returncode != 0:
+            raise RuntimeError(f"python {' '.join(arguments)} failed: {completed.stderr.strip()}")
+        return 1, 0
+    return run
+
+def import_cases():
+    cases = {'python_startup': interpreter_case(['-c', 'pass'])}
+    cases.update({f'import_{module}': interpreter_case(['-c', f'import {module}']) for module in IMPORT_TIMED_MODULES})
+    cases['ct_augment_help'] = interpreter_case(['ct_augment.py', 'augment', '--help'])
+    return cases
+
+# Benchmark groups in report order, each a function returning {case name: case function}
+# A case function takes a BenchmarkInputs and returns (slices processed, bytes processed)
+BENCHMARK_GROUPS = {
+    'augmentation_utils': augmentation_utils_cases,
+    'augmentation_pipeline': pipeline_cases,
+    'io': io_cases,
+    'imports': import_cases,
+}
+
+# Function to list (group, case name) of every benchmark, optionally keeping only names containing one of filters
+def list_cases(filters=None):
+    cases = [(group, name) for group, build in BENCHMARK_GROUPS.items() for name in build()]
+    if filters:
+        cases = [(group, name) for group, name in cases if any(f in name or f == group for f in filters)]
+    return cases
+
+# Function to run one benchmark case repeats times, returning its timings, throughput and peak memory
+def run_case(group, name, data_dir, repeats=3):
+    output_dir = tempfile.mkdtemp(prefix='benchmark-output-')
+    try:
+        inputs = BenchmarkInputs(data_dir, output_dir)
+        case = BENCHMARK_GROUPS[group]()[name]
+        # One untimed run loads the inputs and warms up caches and OpenCV's lazily initialized kernels
+        case(inputs)
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            slices, nbytes = case(inputs)
+            timings.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    best = min(timings)
+    return {'group': group, 'name': name, 'repeats': repeats, 'seconds_best': best, 'seconds_mean': float(np.mean(timings)),
+            'slices': slices, 'slices_per_second': slices / best, 'mb_per_second': nbytes / 1024 ** 2 / best,
+            'peak_rss_mb': peak_rss_mb()}
+
+# Function to write the synthetic NIfTI pair and DICOM series the benchmarks read
+def write_benchmark_data(data_dir, shape):
+    from synthetic_ct import write_synthetic_nifti_pair, write_synthetic_dicom_series
+    write_synthetic_nifti_pair(data_dir, shape)
+    write_synthetic_dicom_series(os.path.join(data_dir, 'dicom'), shape)
+
+# Function to describe the machine and library versions a report was produced with
+def environment_info():
+    import cv2
+    import nibabel
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'numpy': np.__version__, 'opencv': cv2.__version__, 'nibabel': nibabel.__version__}
+
+# Function to run the benchmarks on synthetic volumes of the given shape and return the JSON report as a dict
+# Each case runs in a fresh process by default, so its peak RSS is its own and not the maximum of earlier cases
+def run_benchmarks(shape=(512, 512, 64), repeats=3, filters=None, isolate=True, data_dir=None):
+    temporary_dir = None
+    if data_dir is None:
+        data_dir = temporary_dir = tempfile.mkdtemp(prefix='benchmark-data-')
+    try:
+        cases = list_cases(filters)
+        # The import cases read no data
+        if any(group != 'imports' for group, _ in cases) and not os.path.exists(os.path.join(data_dir, 'volume-0.nii.gz')):
+            write_benchmark_data(data_dir, shape)
+        results = []
+        for group, name in cases:
+            if isolate:
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    result = executor.submit(run_case, group, name, data_dir, repeats).result()
+            else:
+                result = run_case(group, name, data_dir, repeats)
+            print(f"{group:>22} {name:<40} {result['slices_per_second']:>9.1f} slices/s {result['mb_per_second']:>9.1f} MB/s "
+                  f"{result['peak_rss_mb'] or 0:>8.0f} MB peak", file=sys.stderr)
+            results.append(result)
+    finally:
+        if temporary_dir is not None:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+    return {'version': REPORT_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'shape': list(shape),
+            'repeats': repeats, 'environment': environment_info(), 'results': results}
+
+# Function to compare a report with a baseline report, listing the cases whose best time grew by more than tolerance
+def find_regressions(report, baseline, tolerance=0.1):
+    baseline_results = {(r['group'], r['name']): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        previous = baseline_results.get((result['group'], result['name']))
+        if previous is not None and result['seconds_best'] > previous['seconds_best'] * (1 + tolerance):
+            regressions.append({'group': result['group'], 'name': result['name'], 'baseline_seconds': previous['seconds_best'],
+                                'seconds': result['seconds_best'], 'slowdown': result['seconds_best'] / previous['seconds_best']})
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the augmentations and NIfTI/DICOM I/O on synthetic CT volumes, "
+                                                 "and the import time of the command line tools.")
+    parser.add_argument('--shape', type=int, nargs=3, default=[512, 512, 64], metavar=('H', 'W', 'Z'),
+                        help="Shape of the synthetic volume (default: 512 512 64)")
+    parser.add_argument('--repeats', type=int, default=3, help="Timed runs per benchmark; the best is reported (default: 3)")
+    parser.add_argument('--cases', nargs='*', default=None, help="Only run benchmarks whose name contains one of these, or groups")
+    parser.add_argument('--data-dir', default=None, help="Reuse (or create) synthetic data here instead of a temporary directory")
+    parser.add_argument('--in-process', action='store_true', help="Run every case in this process (faster, but peak RSS accumulates)")
+    parser.add_argument('--output', default=None, help="Write the JSON report to this file instead of standard output")
+    parser.add_argument('--compare', default=None, help="Baseline JSON report; exit with status 1 if any case got slower")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed slowdown against --compare (default: 0.1 = 10%%)")
+    parser.add_argument('--list', action='store_true', help="List the benchmark cases and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for group, name in list_cases(args.cases):
+            print(f"{group} {name}")
+        return
+
+    report = run_benchmarks(tuple(args.shape), args.repeats, args.cases, isolate=not args.in_process, data_dir=args.data_dir)
+    if args.compare:
+        with open(args.compare) as f:
+            report['regressions'] = find_regressions(report, json.load(f), args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    for regression in report.get('regressions', []):
+        print(f"Regression: {regression['group']} {regression['name']} {regression['slowdown']:.2f}x slower", file=sys.stderr)
+    if report.get('regressions'):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
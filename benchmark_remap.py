@@ -0,0 +1,54 @@
+import time
+import argparse
+import cv2
+import numpy as np
+from augmentation_utils import remap_plan, remap_with_plan
+
+# Function to time a callable, returning the best of several rounds in milliseconds per call
+def time_call(fn, repeats=50, rounds=3):
+    fn()
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn()
+        best = min(best, (time.perf_counter() - start) / repeats)
+    return best * 1e3
+
+# Function to compare warpAffine with a cached remap plan for the rotation used by the augmentations
+# Reports milliseconds per call for each dtype, slice batch width and interpolation, and whether the pixels match
+def benchmark_rotation(size=512, angle=30, dtypes=('float64', 'float32', 'int16', 'uint8'), channels=(1, 4), repeats=50):
+    rng = np.random.default_rng(0)
+    matrix = cv2.getRotationMatrix2D((size / 2, size / 2), angle, 1)
+    results = []
+    for dtype in dtypes:
+        for channel_count in channels:
+            shape = (size, size) if channel_count == 1 else (size, size, channel_count)
+            image = rng.normal(100, 50, shape).astype(dtype)
+            for nearest in (False, True):
+                flags = cv2.INTER_NEAREST if nearest else cv2.INTER_LINEAR
+                remap_plan.cache_clear()
+                build_ms = time_call(lambda: remap_with_plan(image, matrix, nearest), repeats=1, rounds=1)
+                warp_ms = time_call(lambda: cv2.warpAffine(image, matrix, (size, size), flags=flags), repeats)
+                remap_ms = time_call(lambda: remap_with_plan(image, matrix, nearest), repeats)
+                identical = np.array_equal(cv2.warpAffine(image, matrix, (size, size), flags=flags),
+                                           remap_with_plan(image, matrix, nearest))
+                results.append({'dtype': dtype, 'channels': channel_count, 'interpolation': 'nearest' if nearest else 'linear',
+                                'warp_affine_ms': warp_ms, 'remap_plan_ms': remap_ms, 'first_call_ms': build_ms,
+                                'identical': identical})
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare cv2.warpAffine with cached cv2.remap plans for slice rotation.")
+    parser.add_argument('--size', type=int, default=512, help="Slice width and height in pixels (default: 512)")
+    parser.add_argument('--angle', type=float, default=30, help="Rotation angle in degrees (default: 30)")
+    parser.add_argument('--repeats', type=int, default=50, help="Calls per timing round (default: 50)")
+    args = parser.parse_args()
+
+    print(f"{'dtype':>8} {'ch':>3} {'interp':>8} {'warpAffine':>11} {'remap plan':>11} {'first call':>11} {'identical':>10}")
+    for row in benchmark_rotation(args.size, args.angle, repeats=args.repeats):
+        print(f"{row['dtype']:>8} {row['channels']:>3} {row['interpolation']:>8} {row['warp_affine_ms']:>9.2f}ms "
+              f"{row['remap_plan_ms']:>9.2f}ms {row['first_call_ms']:>9.2f}ms {str(row['identical']):>10}")
+
+if __name__ == '__main__':
+    main()
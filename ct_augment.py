@@ -0,0 +1,36 @@
+import sys
+import argparse
+import importlib
+
+# Subcommands of the ct-augment command, each running the main() of the module that implements it
+# Modules are imported only when their command runs, so one command never pays for the imports of another
+COMMANDS = {
+    'augment': ('main2', "Augment every CT-ORG volume and label pair in a directory"),
+    'dicom': ('process_dicom', "Augment every DICOM series in a folder"),
+    'index': ('dicom_index', "Build or update the header index of a DICOM tree"),
+    'split': ('split_data', "Split augmented files into train/val/test sets by source volume"),
+    'view': ('process_nifty2', "View the augmentations of a volume slice by slice"),
+    'benchmark': ('benchmark', "Benchmark the augmentations, the I/O and the import times"),
+}
+
+# Function to run a subcommand with the rest of the arguments, e.g. `ct-augment augment --data-dir DIR`
+# Each subcommand parses its own arguments, so `ct-augment augment --help` lists the options of main2.py
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    parser = argparse.ArgumentParser(prog='ct-augment', description="Augment CT volumes and labels for segmentation training.")
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND', required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        # The command's own parser handles every option, including --help
+        subparsers.add_parser(name, help=help_text, add_help=False)
+    args, arguments = parser.parse_known_args(argv)
+
+    module = importlib.import_module(COMMANDS[args.command][0])
+    saved_argv = sys.argv
+    sys.argv = [f'{parser.prog} {args.command}'] + arguments
+    try:
+        module.main()
+    finally:
+        sys.argv = saved_argv
+
+if __name__ == '__main__':
+    main()
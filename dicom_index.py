@@ -0,0 +1,153 @@
+import os
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from lazy_imports import lazy_import
+
+pydicom = lazy_import('pydicom')
+
+# One row per file. Files that are not readable DICOM are kept with a NULL series, so they are not read again until they change
+INDEX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS instances (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    study_uid TEXT,
+    series_uid TEXT,
+    instance_number INTEGER,
+    position_x REAL,
+    position_y REAL,
+    position_z REAL,
+    slice_position REAL,
+    rows INTEGER,
+    columns INTEGER
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS instances_series ON instances (series_uid, slice_position, instance_number);
+'''
+
+# Function to give the position of a slice along the scan axis, for sorting the instances of a series
+# Projects ImagePositionPatient onto the slice normal, so tilted and reversed scans sort correctly;
+# instances without a position fall back to their InstanceNumber. Plain floats, since this runs once per indexed file
+def slice_position(dicom):
+    if 'ImagePositionPatient' in dicom and 'ImageOrientationPatient' in dicom:
+        rx, ry, rz, cx, cy, cz = (float(value) for value in dicom.ImageOrientationPatient)
+        x, y, z = (float(value) for value in dicom.ImagePositionPatient)
+        return (ry * cz - rz * cy) * x + (rz * cx - rx * cz) * y + (rx * cy - ry * cx) * z
+    return float(dicom.get('InstanceNumber', 0))
+
+# Function to list the .dcm files under a folder with their size and mtime, using os.scandir so no extra stat is needed
+# for directories. Yields (absolute path, size, mtime_ns)
+def scan_dicom_tree(dicom_dir):
+    pending = [os.path.abspath(dicom_dir)]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.lower().endswith('.dcm') and entry.is_file():
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime_ns
+
+# Function to read the indexed header elements of one file, returning the values of an index row after path, size and mtime
+def read_index_entry(file_path):
+    try:
+        dicom = pydicom.dcmread(file_path, stop_before_pixels=True)
+    except (pydicom.errors.InvalidDicomError, OSError, ValueError) as e:
+        print(f"Indexing {file_path} as unreadable: {e}")
+        return (None,) * 9
+    position = [float(value) for value in dicom.ImagePositionPatient] if 'ImagePositionPatient' in dicom else [None] * 3
+    instance_number = dicom.get('InstanceNumber')
+    return (str(dicom.get('StudyInstanceUID', '')) or None, str(dicom.get('SeriesInstanceUID', '')) or None,
+            int(instance_number) if instance_number is not None else None, *position, slice_position(dicom),
+            dicom.get('Rows'), dicom.get('Columns'))
+
+# Function to give the bounds of the paths under a folder, for index range queries on the path column
+def path_range(dicom_dir):
+    prefix = os.path.join(os.path.abspath(dicom_dir), '')
+    return prefix, prefix[:-1] + chr(ord(os.sep) + 1)
+
+# Class for a persistent header-only index of DICOM trees, kept in an SQLite file
+# Updates only read the files whose size or mtime changed since the last scan, so repeat scans cost one stat per file
+class DicomIndex:
+    def __init__(self, index_path):
+        self.connection = sqlite3.connect(index_path)
+        self.connection.executescript(INDEX_SCHEMA)
+
+    # Function to bring the index of a folder up to date, reading new and changed headers with a pool of threads
+    # Rows of files that no longer exist are removed. Returns the number of added, updated, removed and unchanged files
+    def update(self, dicom_dir, num_workers=8, batch_size=1000):
+        low, high = path_range(dicom_dir)
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute(
+            'SELECT path, size, mtime_ns FROM instances WHERE path >= ? AND path < ?', (low, high))}
+        changed, stats = [], {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+        for path, size, mtime_ns in scan_dicom_tree(dicom_dir):
+            previous = known.pop(path, None)
+            if previous == (size, mtime_ns):
+                stats['unchanged'] += 1
+                continue
+            stats['updated' if previous else 'added'] += 1
+            changed.append((path, size, mtime_ns))
+
+        # Read the changed headers in parallel and commit in batches, so an interrupted scan keeps what it has read
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+            for start in range(0, len(changed), batch_size):
+                batch = changed[start:start + batch_size]
+                entries = executor.map(read_index_entry, [path for path, _, _ in batch])
+                with self.connection:
+                    self.connection.executemany('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                                [file + entry for file, entry in zip(batch, entries)])
+        with self.connection:
+            self.connection.executemany('DELETE FROM instances WHERE path = ?', [(path,) for path in known])
+        stats['removed'] = len(known)
+        return stats
+
+    # Function to list the indexed series, optionally only those under a folder or of one study
+    # Returns dicts with the study and series UIDs, the number of instances and the slice size
+    def series(self, dicom_dir=None, study_uid=None):
+        query = 'SELECT study_uid, series_uid, COUNT(*), MIN(rows), MIN(columns) FROM instances WHERE series_uid IS NOT NULL'
+        parameters = []
+        if dicom_dir is not None:
+            query += ' AND path >= ? AND path < ?'
+            parameters += path_range(dicom_dir)
+        if study_uid is not None:
+            query += ' AND study_uid = ?'
+            parameters.append(study_uid)
+        query += ' GROUP BY study_uid, series_uid ORDER BY study_uid, series_uid'
+        return [{'study_uid': study, 'series_uid': series, 'instances': instances, 'rows': rows, 'columns': columns}
+                for study, series, instances, rows, columns in self.connection.execute(query, parameters)]
+
+    # Function to give the files of a series in slice order, optionally only those under a folder
+    def series_files(self, series_uid, dicom_dir=None):
+        query = 'SELECT path FROM instances WHERE series_uid = ?'
+        parameters = [series_uid]
+        if dicom_dir is not None:
+            query += ' AND path >= ? AND path < ?'
+            parameters += path_range(dicom_dir)
+        query += ' ORDER BY slice_position, instance_number, path'
+        return [path for path, in self.connection.execute(query, parameters)]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Index the headers of a DICOM tree and list its series.")
+    parser.add_argument('--dicom-dir', required=True, help="Folder searched recursively for .dcm files")
+    parser.add_argument('--index', default='dicom_index.sqlite', help="SQLite index file, updated in place (default: dicom_index.sqlite)")
+    parser.add_argument('--workers', type=int, default=8, help="Threads reading headers (default: 8)")
+    args = parser.parse_args()
+
+    with DicomIndex(args.index) as index:
+        stats = index.update(args.dicom_dir, num_workers=args.workers)
+        for series in index.series(args.dicom_dir):
+            print(f"{series['study_uid']} {series['series_uid']} {series['instances']} x {series['rows']}x{series['columns']}")
+    print(f"Indexed {args.dicom_dir}: {stats['added']} added, {stats['updated']} updated, {stats['removed']} removed, "
+          f"{stats['unchanged']} unchanged.")
+
+if __name__ == '__main__':
+    main()
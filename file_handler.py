@@ -1,6 +1,8 @@
-import nibabel as nib
 import os
 import numpy as np
+from lazy_imports import lazy_import
+
+nib = lazy_import('nibabel')
 
 # Function to load a NIfTI file and return its data
 def load_nifti_file(file_path):
@@ -26,7 +28,8 @@ def save_augmented_volumes(volume_aug, label_aug, output_dir, prefix):
     if len(volume_aug) != len(label_aug):
         raise ValueError("volume_aug and label_aug must have the same length.")
 
-    # Loop through each of the augmented volumes and labels
+    # Loop through each of the augmented volumes and labels, collecting errors so one bad output does not stop the rest
+    errors = []
     for i in range(len(volume_aug)):
         try:
             # Validate that the augmented volumes and labels are not empty
@@ -45,4 +48,9 @@ def save_augmented_volumes(volume_aug, label_aug, output_dir, prefix):
             nib.save(vol_nifti, vol_output_path)
             nib.save(lbl_nifti, lbl_output_path)
         except Exception as e:
-            print(f"Error saving augmented volume or label {i} for prefix {prefix}: {e}")
\ No newline at end of file
+            print(f"Error saving augmented volume or label {i} for prefix {prefix}: {e}")
+            errors.append(f"{i}: {e}")
+
+    # Report failed outputs to the caller instead of only printing them
+    if errors:
+        raise RuntimeError(f"Failed to save {len(errors)} augmented outputs for prefix {prefix}: {'; '.join(errors)}")
\ No newline at end of file
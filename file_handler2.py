@@ -1,29 +1,109 @@
-import nibabel as nib
+import io
 import os
+import gzip
+import json
+import shutil
+import zlib
+import contextvars
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import stage, count, enabled as metrics_enabled
+from lazy_imports import lazy_import
+
+nib = lazy_import('nibabel')
+
+# Function to check whether a NIfTI header rescales the stored voxel values (scl_slope/scl_inter)
+def has_intensity_scaling(header):
+    slope, inter = header.get_slope_inter()
+    return slope not in (None, 1) or inter not in (None, 0)
+
+# Function to read the voxel data of a loaded NIfTI image
+# dtype=None returns float64 (get_fdata), 'native' keeps the on-disk dtype (float32 if the header applies scaling),
+# and a floating dtype such as np.float32 is passed through to get_fdata
+def read_nifti_data(nifti_image, dtype=None):
+    if dtype is None:
+        return nifti_image.get_fdata()
+    if isinstance(dtype, str) and dtype == 'native':
+        if not has_intensity_scaling(nifti_image.header):
+            return np.asanyarray(nifti_image.dataobj)
+        return nifti_image.get_fdata(dtype=np.float32)
+    return nifti_image.get_fdata(dtype=dtype)
+
+# Function to read the shape and the dtype load_nifti_file would return, from the header alone
+def read_nifti_shape_and_dtype(file_path, dtype=None):
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found: {file_path}")
+    nifti_image = nib.load(file_path)
+    if dtype is None:
+        return nifti_image.shape, np.dtype(np.float64)
+    if isinstance(dtype, str) and dtype == 'native':
+        if not has_intensity_scaling(nifti_image.header):
+            return nifti_image.shape, nifti_image.get_data_dtype()
+        return nifti_image.shape, np.dtype(np.float32)
+    return nifti_image.shape, np.dtype(dtype)
+
+# Function to extract only the important metadata fields from a NIfTI header
+def extract_important_metadata(header):
+    return {
+        'datatype': header.get_data_dtype(),
+        'dim': header['dim'].copy(),
+        'pixdim': header['pixdim'].copy(),
+        'qform_code': header['qform_code'],
+        'sform_code': header['sform_code'],
+        'srow_x': header['srow_x'].copy(),
+        'srow_y': header['srow_y'].copy(),
+        'srow_z': header['srow_z'].copy(),
+        'xyzt_units': header['xyzt_units']
+    }
+
+# Function to open a NIfTI file for slab-wise reading without loading its voxel data
+# Returns the image (whose dataobj is an array proxy kept open between reads), its affine and important metadata.
+# With an input_cache (see augmentation_cache.InputCache), the decompressed copy of the file is read instead
+def open_nifti_file(file_path, input_cache=None):
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found: {file_path}")
+    try:
+        # Keeping the file open lets consecutive slab reads continue the gzip stream instead of restarting it
+        nifti_image = nib.load(input_cache.cached_path(file_path) if input_cache is not None else file_path,
+                               keep_file_open=True)
+    except nib.filebasedimages.ImageFileError:
+        raise ValueError(f"Invalid NIfTI file format: {file_path}")
+    if len(nifti_image.shape) != 3:
+        raise ValueError(f"Expected a 3D NIfTI volume, got shape {nifti_image.shape}: {file_path}")
+    return nifti_image, nifti_image.affine, extract_important_metadata(nifti_image.header)
+
+# Function to yield (start, slab) pairs of slab_size consecutive axial slices from an opened NIfTI image
+# Slices are the last, slowest-varying axis on disk, so each slab is one sequential read of the file;
+# dtype has the same meaning as in read_nifti_data; first and stop limit the slices read to a range
+def iter_nifti_slabs(nifti_image, slab_size=32, dtype=None, first=0, stop=None):
+    if slab_size < 1:
+        raise ValueError("slab_size must be at least 1.")
+    scaled = has_intensity_scaling(nifti_image.header)
+    stop = nifti_image.shape[2] if stop is None else min(stop, nifti_image.shape[2])
+    for start in range(first, stop, slab_size):
+        with stage('load'):
+            slab = nifti_image.dataobj[:, :, start:min(start + slab_size, stop)]
+        if dtype is None:
+            slab = slab.astype(np.float64, copy=False)
+        elif isinstance(dtype, str) and dtype == 'native':
+            slab = slab.astype(np.float32, copy=False) if scaled else slab
+        else:
+            slab = slab.astype(dtype, copy=False)
+        yield start, slab
 
 # Function to load a NIfTI file and return its data, affine, and important metadata
-def load_nifti_file(file_path):
+# With an input_cache (see augmentation_cache.InputCache), the decompressed copy of the file is memory-mapped instead,
+# so native-dtype data comes back as a copy-on-write memmap
+def load_nifti_file(file_path, dtype=None, input_cache=None):
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
     try:
-        nifti_image = nib.load(file_path)
-        data = nifti_image.get_fdata()
+        with stage('load'):
+            nifti_image = nib.load(input_cache.cached_path(file_path) if input_cache is not None else file_path)
+            data = read_nifti_data(nifti_image, dtype)
         affine = nifti_image.affine
-        header = nifti_image.header
-
-        # Extract only the important metadata fields
-        important_metadata = {
-            'datatype': header.get_data_dtype(),
-            'dim': header['dim'].copy(),
-            'pixdim': header['pixdim'].copy(),
-            'qform_code': header['qform_code'],
-            'sform_code': header['sform_code'],
-            'srow_x': header['srow_x'].copy(),
-            'srow_y': header['srow_y'].copy(),
-            'srow_z': header['srow_z'].copy(),
-            'xyzt_units': header['xyzt_units']
-        }
+        important_metadata = extract_important_metadata(nifti_image.header)
 
         return data, affine, important_metadata
     except nib.filebasedimages.ImageFileError:
@@ -48,8 +128,160 @@ def create_header_with_important_metadata(important_metadata):
 
     return new_header
 
+# Function to build the output path of an augmented volume or label ('volume' or 'label' kind), or of an intensity
+# window of the normalized volume ('window' kind, indexed by the window name)
+# Uncompressed .nii files are much faster to write and suit scratch or intermediate datasets
+def augmented_output_path(output_dir, prefix, kind, index, compressed=True):
+    extension = '.nii.gz' if compressed else '.nii'
+    return os.path.join(output_dir, f'{prefix}_augmented_{kind}_{index}{extension}')
+
+# Index of the augmentation whose label each augmentation shares, in the order process_volume_and_label_batched returns them
+# Contrast adjustment and denoising leave the normalized label unchanged, so their labels are the normalized one
+LABEL_SOURCES = [0, 1, 2, 3, 0, 0]
+
+# How labels shared between augmentations are written: 'shared' writes each distinct label once and lists the label of
+# every augmented volume in <prefix>_labels.json, 'hardlink' also gives every augmentation a label file of its own as a
+# hard link to the shared one, and 'copy' writes every label in full as in earlier versions
+LABEL_FILE_MODES = ('shared', 'hardlink', 'copy')
+
+# Function to give the index of the label file holding the label of augmentation i
+def label_file_index(i, label_files='shared'):
+    if label_files not in LABEL_FILE_MODES:
+        raise ValueError(f"Unknown label file mode {label_files!r}; use one of {', '.join(LABEL_FILE_MODES)}.")
+    return i if label_files == 'copy' else LABEL_SOURCES[i]
+
+# Function to list the augmentations whose label file is a hard link to the label file of augmentation i
+def linked_labels(i, label_files='shared'):
+    if label_files != 'hardlink' or LABEL_SOURCES[i] != i:
+        return []
+    return [j for j, source in enumerate(LABEL_SOURCES) if source == i and j != i]
+
+# Function to give the path of the label manifest of a source volume
+def label_manifest_path(output_dir, prefix):
+    return os.path.join(output_dir, prefix + '_labels.json')
+
+# Function to load the label manifest of a source volume as {augmented volume file name: label file name}
+# Returns an empty dict for outputs written before labels were shared
+def load_label_manifest(output_dir, prefix):
+    try:
+        with open(label_manifest_path(output_dir, prefix)) as f:
+            return json.load(f)['labels']
+    except FileNotFoundError:
+        return {}
+
+# Function to finish the labels of augmentations just written: hard link each written label to the augmentations
+# sharing it (copying where hard links are not supported) and record the label file of every augmented volume.
+# Intensity windows, named by windows, are recorded with the label of the normalized volume they come from
+def finish_augmented_labels(output_dir, prefix, written, label_files='shared', compressed=True, windows=()):
+    for i in written:
+        source = augmented_output_path(output_dir, prefix, 'label', i, compressed)
+        for j in linked_labels(i, label_files):
+            destination = augmented_output_path(output_dir, prefix, 'label', j, compressed)
+            if os.path.lexists(destination):
+                os.remove(destination)
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copyfile(source, destination)
+    labels = {os.path.basename(augmented_output_path(output_dir, prefix, 'volume', i, compressed)):
+              os.path.basename(augmented_output_path(output_dir, prefix, 'label', label_file_index(i, label_files), compressed))
+              for i in range(len(LABEL_SOURCES))}
+    labels.update({os.path.basename(augmented_output_path(output_dir, prefix, 'window', name, compressed)):
+                   labels[os.path.basename(augmented_output_path(output_dir, prefix, 'volume', 0, compressed))] for name in windows})
+    manifest_path = label_manifest_path(output_dir, prefix)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'label_files': label_files, 'labels': labels}, f, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+# Function to compress one block of data into a complete gzip member
+# zlib releases the GIL while compressing, so blocks compress in parallel on threads
+def compress_gzip_member(block, compresslevel):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+    return compressor.compress(block) + compressor.flush()
+
+# Class for a write-only gzip file that compresses fixed-size blocks on a thread pool
+# Each block becomes its own gzip member; multi-member files are standard gzip and read back with gzip or nibabel.
+# Only forward writes are supported, with tell() and no-op seeks so nibabel can write headers and data through it.
+class ParallelGzipWriter(io.RawIOBase):
+    def __init__(self, file_path, compresslevel=1, threads=None, block_size=4 * 1024 * 1024):
+        super().__init__()
+        self.fileobj = open(file_path, 'wb')
+        self.compresslevel = compresslevel
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.position = 0
+
+    # Function to append data, compressing every full block in the background
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    # Function to queue one block for compression, writing finished members in order to bound memory
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(compress_gzip_member, block, self.compresslevel))
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence != 0 or offset != self.position:
+            raise OSError("ParallelGzipWriter only supports forward writes.")
+        return self.position
+
+    # Function to compress the last partial block and wait for all members to be written
+    def close(self):
+        if self.fileobj is None:
+            return
+        try:
+            if self.buffer or self.position == 0:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown()
+            self.fileobj.close()
+            self.fileobj = None
+            super().close()
+
+# Function to open a file for writing NIfTI data: plain for .nii, gzip at compresslevel for .nii.gz,
+# and block-parallel gzip when compress_threads is greater than one
+def open_nifti_output(file_path, compresslevel=1, compress_threads=1):
+    if not file_path.endswith('.gz'):
+        return open(file_path, 'wb')
+    if compress_threads > 1:
+        return ParallelGzipWriter(file_path, compresslevel=compresslevel, threads=compress_threads)
+    return gzip.GzipFile(file_path, 'wb', compresslevel=compresslevel)
+
+# Function to save a NIfTI image like nib.save, with a selectable compression level and parallel gzip compression
+def write_nifti_image(nifti_image, file_path, compresslevel=1, compress_threads=1):
+    with open_nifti_output(file_path, compresslevel, compress_threads) as fileobj:
+        nifti_image.to_file_map(nifti_image.make_file_map({'image': fileobj}))
+    if metrics_enabled():
+        count('bytes_written', os.path.getsize(file_path))
+        count('files_written')
+
 # Function to save augmented volumes and labels to NIfTI files with important metadata
-def save_augmented_volumes(volume_aug, label_aug, output_dir, prefix, affine, important_metadata):
+# compresslevel (0-9) and compress_threads set the gzip compression, compressed=False writes uncompressed .nii files,
+# and write_workers saves that many of the output files at the same time. label_files (see LABEL_FILE_MODES) sets how
+# labels shared between augmentations are written; a shared label is written with the augmentation it comes from.
+# window_aug optionally maps intensity window names to windowed normalized volumes (None for windows not written now)
+def save_augmented_volumes(volume_aug, label_aug, output_dir, prefix, affine, important_metadata,
+                           compresslevel=1, compress_threads=1, compressed=True, write_workers=1, label_files='shared',
+                           window_aug=None):
     # Create the output directory if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
@@ -60,26 +292,117 @@ def save_augmented_volumes(volume_aug, label_aug, output_dir, prefix, affine, im
     if len(volume_aug) != len(label_aug):
         raise ValueError("volume_aug and label_aug must have the same length.")
 
-    # Loop through each of the augmented volumes and labels
-    for i in range(len(volume_aug)):
-        try:
-            # Validate that the augmented volumes and labels are not empty
-            if volume_aug[i].size == 0 or label_aug[i].size == 0:
-                raise ValueError(f"Augmented volume or label {i} is empty.")
-            
-            # Create a new header with only the important metadata
-            new_header = create_header_with_important_metadata(important_metadata)
-
-            # Create NIfTI objects for the augmented volume and label using the new header and original affine
-            vol_nifti = nib.Nifti1Image(volume_aug[i], affine=affine, header=new_header)
-            lbl_nifti = nib.Nifti1Image(label_aug[i], affine=affine, header=new_header)
-
-            # Construct the output paths for the augmented volume and label
-            vol_output_path = os.path.join(output_dir, f'{prefix}_augmented_volume_{i}.nii.gz')
-            lbl_output_path = os.path.join(output_dir, f'{prefix}_augmented_label_{i}.nii.gz')
-
-            # Save the augmented volume and label to the specified paths
-            nib.save(vol_nifti, vol_output_path)
-            nib.save(lbl_nifti, lbl_output_path)
-        except Exception as e:
-            print(f"Error saving augmented volume or label {i} for prefix {prefix}: {e}")
\ No newline at end of file
+    # Function to save the augmented volume or label of one kind and index
+    def save_output(kind, i, data):
+        # Validate that the augmented volumes and labels are not empty
+        if data.size == 0:
+            raise ValueError(f"Augmented {kind} {i} is empty.")
+
+        # Create a NIfTI object using a new header with only the important metadata and the original affine
+        # Intensity windows are display values, so they are stored as uint8 whatever the input datatype
+        metadata = dict(important_metadata, datatype=np.dtype(np.uint8)) if kind == 'window' else important_metadata
+        nifti_image = nib.Nifti1Image(data, affine=affine, header=create_header_with_important_metadata(metadata))
+        write_nifti_image(nifti_image, augmented_output_path(output_dir, prefix, kind, i, compressed),
+                          compresslevel=compresslevel, compress_threads=compress_threads)
+
+    # Save every augmented volume and label, collecting errors so one bad output does not stop the rest
+    # Outputs given as None (augmentations that were not recomputed) are skipped
+    jobs = [(kind, i, outputs[i]) for i in range(len(volume_aug)) for kind, outputs in (('volume', volume_aug), ('label', label_aug))
+            if outputs[i] is not None and (kind == 'volume' or label_file_index(i, label_files) == i)]
+    jobs += [('window', name, data) for name, data in (window_aug or {}).items() if data is not None]
+    errors = []
+    with stage('save'), ThreadPoolExecutor(max_workers=max(1, write_workers)) as executor:
+        # Each writer runs in a copy of this thread's context, so it reports to the metrics of the volume being saved
+        futures = [executor.submit(contextvars.copy_context().run, save_output, kind, i, data) for kind, i, data in jobs]
+        for (kind, i, _), future in zip(jobs, futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error saving augmented {kind} {i} for prefix {prefix}: {e}")
+                errors.append(f"{kind} {i}: {e}")
+
+    # Report failed outputs to the caller instead of only printing them
+    if errors:
+        raise RuntimeError(f"Failed to save {len(errors)} augmented outputs for prefix {prefix}: {'; '.join(errors)}")
+    finish_augmented_labels(output_dir, prefix, [i for kind, i, _ in jobs if kind == 'label'], label_files, compressed,
+                            list(window_aug or {}))
+
+# Function to open streaming writers for the augmented volumes and labels of one input, named like save_augmented_volumes
+# Writers are registered with an ExitStack so they are closed however the caller finishes; compression options match
+# save_augmented_volumes (write_workers is applied by the caller when it writes slabs). A dtype of None gives None instead of a
+# writer, as do labels shared with another augmentation; call finish_augmented_labels once the writers are closed.
+# Returns (volume writers, label writers, {window name: writer}) with a uint8 writer for each of the windows named
+def open_augmented_volume_writers(exit_stack, output_dir, prefix, shape, volume_dtypes, label_dtypes, affine, important_metadata,
+                                  compresslevel=1, compress_threads=1, compressed=True, label_files='shared', windows=()):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    volume_writers = [exit_stack.enter_context(StreamingNiftiWriter(
+        augmented_output_path(output_dir, prefix, 'volume', i, compressed), shape, dtype, affine, important_metadata,
+        compresslevel=compresslevel, compress_threads=compress_threads)) if dtype is not None else None
+        for i, dtype in enumerate(volume_dtypes)]
+    label_writers = [exit_stack.enter_context(StreamingNiftiWriter(
+        augmented_output_path(output_dir, prefix, 'label', i, compressed), shape, dtype, affine, important_metadata,
+        compresslevel=compresslevel, compress_threads=compress_threads))
+        if dtype is not None and label_file_index(i, label_files) == i else None
+        for i, dtype in enumerate(label_dtypes)]
+    window_writers = {name: exit_stack.enter_context(StreamingNiftiWriter(
+        augmented_output_path(output_dir, prefix, 'window', name, compressed), shape, np.uint8, affine,
+        dict(important_metadata, datatype=np.dtype(np.uint8)),
+        compresslevel=compresslevel, compress_threads=compress_threads)) for name in windows}
+    return volume_writers, label_writers, window_writers
+
+# Class to write a NIfTI volume slab by slab, so the whole volume never has to be held in memory
+# The header is written up front from the final shape; slabs must arrive in slice order and fill the whole volume.
+# Data is stored in the header datatype from important_metadata when dtype casts to it losslessly, otherwise in dtype.
+class StreamingNiftiWriter:
+    def __init__(self, file_path, shape, dtype, affine, important_metadata, compresslevel=1, compress_threads=1):
+        header = create_header_with_important_metadata(important_metadata)
+        disk_dtype = header.get_data_dtype()
+        if not np.can_cast(dtype, disk_dtype, casting='safe'):
+            disk_dtype = np.dtype(dtype)
+
+        # A zero-strided placeholder lets nibabel fill in shape, qform and sform exactly as nib.save would
+        placeholder = nib.Nifti1Image(np.broadcast_to(np.zeros((), dtype=disk_dtype), shape), affine, header=header)
+        placeholder.update_header()
+        self.header = placeholder.header
+        self.header.set_data_dtype(disk_dtype)
+        self.header.set_slope_inter(1.0, 0.0)
+        self.header['vox_offset'] = 0
+
+        self.file_path = file_path
+        self.shape = tuple(shape)
+        self.disk_dtype = disk_dtype
+        self.slices_written = 0
+        self.fileobj = open_nifti_output(file_path, compresslevel, compress_threads)
+        self.header.write_to(self.fileobj)
+
+    # Function to append the next slab of slices, an (H, W, k) array
+    def write_slab(self, slab):
+        if slab.shape[:2] != self.shape[:2] or self.slices_written + slab.shape[2] > self.shape[2]:
+            raise ValueError(f"Slab of shape {slab.shape} does not fit volume {self.shape} after {self.slices_written} slices.")
+        # NIfTI stores voxels in Fortran order, so consecutive slabs are consecutive byte ranges
+        self.fileobj.write(np.asarray(slab, dtype=self.disk_dtype).tobytes(order='F'))
+        self.slices_written += slab.shape[2]
+
+    # Function to finish the file, checking that every slice was written
+    def close(self):
+        if self.fileobj is None:
+            return
+        with stage('save'):
+            self.fileobj.close()
+        self.fileobj = None
+        if metrics_enabled():
+            count('bytes_written', os.path.getsize(self.file_path))
+            count('files_written')
+        if self.slices_written != self.shape[2]:
+            raise RuntimeError(f"Incomplete NIfTI file {self.file_path}: wrote {self.slices_written} of {self.shape[2]} slices.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
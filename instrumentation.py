@@ -0,0 +1,138 @@
+import json
+import time
+import cProfile
+import threading
+import contextlib
+import contextvars
+
+# Shared no-op context manager returned by stage() while no metrics are being collected
+NULL_STAGE = contextlib.nullcontext()
+
+# The collector stage() and count() report to, or None when instrumentation is disabled
+_active_metrics = None
+
+# Collector of the volume the current thread works on, set by collect_metrics and used before _active_metrics
+# Lets the stages of a pipelined batch, each busy with another volume, report to the right one
+_context_metrics = contextvars.ContextVar('context_metrics', default=None)
+
+# Class to accumulate the seconds spent in named stages and named counters (e.g. slices processed) for one volume
+# Stages may nest ('augment' around 'augment.rotated'), and may be entered from several threads at once
+class VolumeMetrics:
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self):
+        return {'timings': dict(self.timings), 'counters': dict(self.counters)}
+
+# Function to time a stage of the current volume: `with stage('load'): ...`
+# Costs a global lookup and returns a shared no-op context when instrumentation is disabled
+def stage(name):
+    metrics = _context_metrics.get() or _active_metrics
+    if metrics is None:
+        return NULL_STAGE
+    return metrics.stage(name)
+
+# Function to add to a counter of the current volume, doing nothing when instrumentation is disabled
+def count(name, amount=1):
+    metrics = _context_metrics.get() or _active_metrics
+    if metrics is not None:
+        metrics.count(name, amount)
+
+# Function to check whether metrics are being collected, to skip work (such as a stat call) that only feeds a counter
+def enabled():
+    return (_context_metrics.get() or _active_metrics) is not None
+
+# Function to report the stages and counters of a with block to metrics (a VolumeMetrics, or None for no change)
+# Unlike run_with_metrics this only affects the current thread, and threads given a copy of its context
+@contextlib.contextmanager
+def collect_metrics(metrics):
+    token = _context_metrics.set(metrics)
+    try:
+        yield
+    finally:
+        _context_metrics.reset(token)
+
+# Function to collect the stages and counters reported while fn(*args) runs
+# Returns (result, metrics dict); with profile_path set, the call also runs under cProfile and the stats are dumped there
+def run_with_metrics(fn, args, profile_path=None):
+    global _active_metrics
+    previous, _active_metrics = _active_metrics, VolumeMetrics()
+    profiler = cProfile.Profile() if profile_path else None
+    try:
+        with _active_metrics.stage('total'):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                result = fn(*args)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                    profiler.dump_stats(profile_path)
+        return result, _active_metrics.as_dict()
+    finally:
+        _active_metrics = previous
+
+# Class to write metrics as JSON lines, one record per volume followed by a summary record for the whole run
+# Records are flushed as they are written, so a log of a crashed run still holds every finished volume
+class MetricsLog:
+    def __init__(self, file_path):
+        self.file = open(file_path, 'w')
+        self.start = time.perf_counter()
+        self.timings = {}
+        self.counters = {}
+        self.succeeded = 0
+        self.failed = 0
+
+    # Function to write the record of one volume and add its metrics to the run totals
+    def write_volume(self, name, succeeded, metrics=None, error=None):
+        record = {'volume': name, 'succeeded': succeeded}
+        if metrics:
+            record.update(metrics)
+            for key, value in metrics.get('timings', {}).items():
+                self.timings[key] = self.timings.get(key, 0.0) + value
+            for key, value in metrics.get('counters', {}).items():
+                self.counters[key] = self.counters.get(key, 0) + value
+        if error:
+            record['error'] = error
+        if succeeded:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        self.write(record)
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    # Function to write the run summary and close the log
+    # Stage timings are summed over volumes, so with several workers they can exceed the wall time
+    def close(self):
+        if self.file.closed:
+            return
+        self.write({'summary': True, 'succeeded': self.succeeded, 'failed': self.failed,
+                    'wall_seconds': time.perf_counter() - self.start, 'timings': self.timings, 'counters': self.counters})
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,109 @@
+import functools
+import numpy as np
+from augmentation_utils import output_volume, is_slice_major, validate_volume_and_label
+from lazy_imports import lazy_import
+
+cv2 = lazy_import('cv2')
+
+# Standard CT display windows as (center, width) in Hounsfield units
+WINDOW_PRESETS = {
+    'brain': (40, 80),
+    'liver': (30, 150),
+    'abdomen': (50, 400),
+    'mediastinum': (50, 350),
+    'lung': (-600, 1500),
+    'bone': (400, 1800),
+}
+
+# Number of windows whose lookup tables are packed side by side into one table of 4-byte entries, so each voxel is
+# looked up once for all of them
+PACKED_WINDOWS = 4
+
+# Function to turn a window given as a preset name or as 'center,width' or 'center,width,gamma' (in HU) into a dict
+# with its name, center, width and gamma; dicts are checked and returned with defaults filled in
+def parse_window(spec):
+    if isinstance(spec, dict):
+        window = dict({'gamma': 1.0}, **spec)
+    elif spec in WINDOW_PRESETS:
+        center, width = WINDOW_PRESETS[spec]
+        window = {'name': spec, 'center': center, 'width': width, 'gamma': 1.0}
+    else:
+        try:
+            values = [float(value) for value in str(spec).split(',')]
+        except ValueError:
+            values = []
+        if len(values) not in (2, 3):
+            raise ValueError(f"Unknown window {spec!r}; use one of {', '.join(WINDOW_PRESETS)} or 'center,width[,gamma]'.")
+        center, width, gamma = values + [1.0] * (3 - len(values))
+        name = f'c{center:g}w{width:g}' + (f'g{gamma:g}' if gamma != 1 else '')
+        window = {'name': name, 'center': center, 'width': width, 'gamma': gamma}
+    if window['width'] <= 0 or window['gamma'] <= 0:
+        raise ValueError(f"Window {window['name']} must have a positive width and gamma.")
+    return window
+
+# Function to map pixel values through a window to uint8 display values
+# Stored values are converted to HU by slope and intercept first. HU below the window become 0 and above it 255,
+# and gamma below 1 brightens the window while gamma above 1 darkens it
+def window_values(values, window, slope=1.0, intercept=0.0):
+    hu = values.astype(np.float64) * slope + intercept
+    scaled = np.clip((hu - (window['center'] - window['width'] / 2)) / window['width'], 0, 1)
+    if window['gamma'] != 1:
+        scaled **= window['gamma']
+    return np.rint(scaled * 255).astype(np.uint8)
+
+# Function to build the lookup table of a window for every 8- or 16-bit stored value, indexed by the value's bits read
+# as unsigned. Tables are cached, so every slice and volume of a run with the same windows shares them
+@functools.lru_cache(maxsize=32)
+def window_lookup_table(dtype, center, width, gamma=1.0, slope=1.0, intercept=0.0):
+    dtype = np.dtype(dtype)
+    values = np.arange(1 << (8 * dtype.itemsize), dtype=f'u{dtype.itemsize}').view(dtype)
+    table = window_values(values, {'center': center, 'width': width, 'gamma': gamma}, slope, intercept)
+    table.flags.writeable = False
+    return table
+
+# Function to give the tables of a group of windows packed into one table of 4-byte entries, byte k of each entry
+# holding window k. Groups of fewer than four windows are padded with zero bytes
+def packed_lookup_table(dtype, windows, slope=1.0, intercept=0.0):
+    tables = [window_lookup_table(dtype, window['center'], window['width'], window['gamma'], slope, intercept)
+              for window in windows]
+    tables += [np.zeros_like(tables[0])] * (PACKED_WINDOWS - len(tables))
+    return np.ascontiguousarray(np.stack(tables, axis=1)).view(np.uint32).ravel()
+
+# Function to apply several windows to a whole (H, W, Z) volume in one pass over it, returning a uint8 volume per window
+# 8- and 16-bit volumes (CT stored values) go through lookup tables, so windowing, gamma and the HU rescale cost one
+# table lookup per voxel. The tables of up to PACKED_WINDOWS windows are packed together, so each slice is read and
+# looked up once for the whole group and cv2.split spreads the bytes over the outputs. Other dtypes (such as the
+# float volumes of files that apply scaling) are computed with window_values. out_volumes optionally holds the outputs
+def apply_windows(volume, windows, slope=1.0, intercept=0.0, out_volumes=None):
+    validate_volume_and_label(volume, None)
+    windows = [parse_window(window) for window in windows]
+    out_volumes = [output_volume(out, volume.shape, np.uint8)
+                   for out in (out_volumes if out_volumes is not None else [None] * len(windows))]
+    if len(out_volumes) != len(windows):
+        raise ValueError("out_volumes must hold one volume per window.")
+    lookup = volume.dtype.kind in 'iu' and volume.dtype.itemsize <= 2
+    unsigned = np.dtype(f'u{volume.dtype.itemsize}')
+    for group_start in range(0, len(windows), PACKED_WINDOWS):
+        group = windows[group_start:group_start + PACKED_WINDOWS]
+        outs = out_volumes[group_start:group_start + PACKED_WINDOWS]
+        if not lookup:
+            for z in range(volume.shape[2]):
+                for window, out in zip(group, outs):
+                    out[:, :, z] = window_values(volume[:, :, z], window, slope, intercept)
+            continue
+        if len(group) == 1:
+            table = window_lookup_table(volume.dtype, group[0]['center'], group[0]['width'], group[0]['gamma'], slope, intercept)
+            for z in range(volume.shape[2]):
+                outs[0][:, :, z] = np.take(table, volume[:, :, z].view(unsigned), mode='wrap')
+            continue
+        table = packed_lookup_table(volume.dtype, group, slope, intercept)
+        write_in_place = all(is_slice_major(out) for out in outs)
+        padding = [np.empty(volume.shape[:2], dtype=np.uint8) for _ in range(PACKED_WINDOWS - len(group))]
+        for z in range(volume.shape[2]):
+            packed = np.take(table, volume[:, :, z].view(unsigned), mode='wrap').view(np.uint8).reshape(volume.shape[:2] + (4,))
+            if write_in_place:
+                cv2.split(packed, [out[:, :, z] for out in outs] + padding)
+            else:
+                for out, window_slice in zip(outs, cv2.split(packed)):
+                    out[:, :, z] = window_slice
+    return out_volumes
@@ -0,0 +1,136 @@
+import os
+import json
+import numpy as np
+
+# How slices are chosen from the label before augmentation:
+# 'all' keeps every slice, 'skip' keeps only slices with foreground, 'subsample' keeps the foreground slices and every
+# subsample_step-th empty slice, and 'crop' keeps the contiguous range of foreground slices and crops each slice to the
+# square box around the foreground. padding widens the foreground by that many voxels along every axis
+LABEL_MODES = ('all', 'skip', 'subsample', 'crop')
+
+# Label options used when none are given: keep the liver (class 3 of CT-ORG) as a binary mask of every slice
+DEFAULT_LABEL_OPTIONS = {'values': [3], 'binary': True, 'mode': 'all', 'subsample_step': 8, 'padding': 8}
+
+# Function to fill in the defaults of label options and check them
+def label_options_with_defaults(label_options=None):
+    options = dict(DEFAULT_LABEL_OPTIONS, **(label_options or {}))
+    options['values'] = [int(value) for value in options['values']]
+    if not options['values'] or any(not 0 <= value <= 255 for value in options['values']):
+        raise ValueError(f"Label values must be between 0 and 255, got {options['values']}.")
+    if options['mode'] not in LABEL_MODES:
+        raise ValueError(f"Unknown label mode {options['mode']!r}; use one of {', '.join(LABEL_MODES)}.")
+    if options['subsample_step'] < 1 or options['padding'] < 0:
+        raise ValueError("subsample_step must be at least 1 and padding at least 0.")
+    return options
+
+# Function to build the 256-entry uint8 table mapping label classes to output values
+# Every kept class maps to 1 when binary, or to 1, 2, ... in the order given otherwise; all other classes map to 0
+def label_lookup_table(label_values, binary=True):
+    lut = np.zeros(256, dtype=np.uint8)
+    for i, value in enumerate(label_values):
+        lut[value] = 1 if binary else i + 1
+    return lut
+
+# Function to remap a label volume (or slab) through a lookup table into a uint8 array of the same shape
+# Labels stored in another dtype are checked to hold integer classes 0-255 first. A table that keeps a single class
+# is applied as one comparison, which is several times faster than a table lookup
+def remap_label(label, lut):
+    if label.dtype != np.uint8:
+        if label.size and (label.min() < 0 or label.max() > 255 or
+                           (label.dtype.kind == 'f' and not np.array_equal(label, np.round(label)))):
+            raise ValueError("Label classes must be integers between 0 and 255.")
+        label = label.astype(np.uint8)
+    kept = np.flatnonzero(lut)
+    if len(kept) == 1 and lut[kept[0]] == 1:
+        return (label == kept[0]).view(np.uint8)
+    return lut[label]
+
+# Function to find where a remapped (H, W, Z) label has foreground, in one reduction per axis
+# Returns (slices, rows, cols): boolean arrays of length Z, H and W that are True where that slice, row or column holds
+# foreground. Extents of consecutive slabs combine with merge_foreground_extents
+def foreground_extent(label):
+    slices = label.reshape(-1, label.shape[2], order='F' if label.flags.f_contiguous else 'A').max(axis=0) > 0
+    if slices.any():
+        # Project only the slices with foreground onto the slice plane
+        projection = label[:, :, np.flatnonzero(slices)].max(axis=2)
+        return slices, projection.max(axis=1) > 0, projection.max(axis=0) > 0
+    return slices, np.zeros(label.shape[0], dtype=bool), np.zeros(label.shape[1], dtype=bool)
+
+# Function to combine the foreground extents of consecutive slabs into the extent of the whole volume
+def merge_foreground_extents(extents):
+    extents = list(extents)
+    return (np.concatenate([slices for slices, _, _ in extents]), np.logical_or.reduce([rows for _, rows, _ in extents]),
+            np.logical_or.reduce([cols for _, _, cols in extents]))
+
+# Function to widen a boolean mask along its only axis by padding elements on each side
+def dilate_flags(flags, padding):
+    if not padding:
+        return flags
+    return np.convolve(flags, np.ones(2 * padding + 1))[padding:padding + len(flags)] > 0
+
+# Function to grow the range [start, stop) to at least size elements, keeping it centred and within [0, limit)
+def widen_range(start, stop, size, limit):
+    size = min(size, limit)
+    start = max(0, min(start - (size - (stop - start)) // 2, limit - size))
+    return start, max(stop, start + size)
+
+# Function to choose the slices and in-plane box to augment from the foreground extent of a volume
+# Returns (slices, box): the sorted indices of the kept slices and (top, left, rows, cols) of the crop, or None for the
+# whole slice. The crop box is made square so the resize to 512x512 keeps the aspect ratio of the anatomy
+def select_foreground(extent, mode='all', subsample_step=8, padding=8):
+    slices, rows, cols = extent
+    depth = len(slices)
+    if mode == 'all':
+        return np.arange(depth), None
+    foreground = dilate_flags(slices, padding)
+    if mode == 'skip':
+        return np.flatnonzero(foreground), None
+    if mode == 'subsample':
+        return np.flatnonzero(foreground | (np.arange(depth) % subsample_step == 0)), None
+    if not foreground.any():
+        return np.arange(0), None
+    first, last = np.flatnonzero(foreground)[[0, -1]]
+    row_indices, col_indices = np.flatnonzero(rows), np.flatnonzero(cols)
+    top, bottom = max(row_indices[0] - padding, 0), min(row_indices[-1] + padding + 1, len(rows))
+    left, right = max(col_indices[0] - padding, 0), min(col_indices[-1] + padding + 1, len(cols))
+    size = max(bottom - top, right - left)
+    top, bottom = widen_range(top, bottom, size, len(rows))
+    left, right = widen_range(left, right, size, len(cols))
+    return np.arange(first, last + 1), (int(top), int(left), int(bottom - top), int(right - left))
+
+# Function to take the selected slices of a (H, W, n) slab starting at slice start, cropped to box
+# Returns None when the slab holds none of the selected slices. Contiguous selections are views, not copies
+def select_slab(slab, start, slices, box=None):
+    begin, end = np.searchsorted(slices, [start, start + slab.shape[2]])
+    if begin == end:
+        return None
+    if box is not None:
+        top, left, rows, cols = box
+        slab = slab[top:top + rows, left:left + cols]
+    local = slices[begin:end] - start
+    if local[-1] - local[0] + 1 == len(local):
+        return slab[:, :, local[0]:local[-1] + 1]
+    return slab[:, :, local]
+
+# Function to give the affine of the augmented outputs of a selection, whose slices are resized to 512x512
+# The origin moves to the first kept slice and, for a crop, to the corner of the box, and the in-plane voxel size
+# scales with the box. The slice spacing is left as is, so for non-contiguous selections the slice indices recorded
+# with the outputs are needed to place each slice
+def selection_affine(affine, slices, box=None, size=512):
+    if box is None:
+        # Without a crop the in-plane resampling is left out of the affine, as for unselected volumes
+        matrix = np.eye(4)
+    else:
+        top, left, rows, cols = box
+        scale_rows, scale_cols = rows / size, cols / size
+        matrix = np.diag([scale_rows, scale_cols, 1.0, 1.0])
+        matrix[:2, 3] = [top + 0.5 * scale_rows - 0.5, left + 0.5 * scale_cols - 0.5]
+    matrix[2, 3] = slices[0] if len(slices) else 0
+    return np.asarray(affine) @ matrix
+
+# Function to record which source slices (and crop box) the augmented outputs of a volume hold, as <prefix>_selection.json
+def save_selection(output_dir, prefix, slices, box, depth):
+    file_path = os.path.join(output_dir, prefix + '_selection.json')
+    with open(file_path, 'w') as f:
+        json.dump({'source_slices': depth, 'slices': [int(z) for z in slices], 'box': list(box) if box else None}, f)
+    return file_path
@@ -0,0 +1,29 @@
+import sys
+import importlib
+
+# Class standing in for a module until one of its attributes is first used, which imports it
+# The import goes through importlib.import_module, whose import lock makes the first use safe from several threads
+# at once (unlike importlib.util.LazyLoader before Python 3.12). Later uses cost one extra attribute lookup
+class LazyModule:
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attribute):
+        module = self.__dict__['_module']
+        if module is None:
+            module = self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return getattr(module, attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(importlib.import_module(self.__dict__['_name']), attribute, value)
+
+    def __repr__(self):
+        return f"<lazy module {self.__dict__['_name']!r}>"
+
+# Function to import a heavy dependency (cv2, nibabel, pydicom, matplotlib, sklearn) on first use instead of now
+# Returns the module itself when it is already imported, so there is no indirection left to pay for
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
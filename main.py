@@ -1,48 +1,30 @@
 import os
+import argparse
 from file_handler import load_nifti_file, save_augmented_volumes
-from augmentation_pipeline import process_volume_and_label
+from file_handler2 import read_nifti_shape_and_dtype
+from augmentation_pipeline import process_volume_and_label_batched, estimate_augmentation_memory
+from batch_runner import find_volume_label_pairs, run_batch
 import numpy as np
 
 # Define directories
 data_dir = '/Users/omkarbhope/Library/Mobile Documents/com~apple~CloudDocs/Research/PKG - CT-ORG/CT-ORG/TestData'
 output_dir = 'augmented_nifti_volumes2'
 
-# Create output directory if it doesn't exist
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-
-# Get the list of all volume and label files in the directory, sorted for consistency
-volume_files = sorted([f for f in os.listdir(data_dir) if f.startswith('volume') and f.endswith('.nii.gz')])
-label_files = sorted([f for f in os.listdir(data_dir) if f.startswith('labels') and f.endswith('.nii.gz')])
-
-# Validate that there is a matching label for each volume
-if len(volume_files) != len(label_files):
-    raise ValueError("The number of volume files and label files must be the same.")
-
-# Loop through all volume and label files
-for volume_file, label_file in zip(volume_files, label_files):
-    volume_path = os.path.join(data_dir, volume_file)
-    label_path = os.path.join(data_dir, label_file)
-
-    try:
-        volume_data = load_nifti_file(volume_path)
-        label_data = load_nifti_file(label_path).astype(np.int32)
-    except FileNotFoundError:
-        print(f"Error: File not found - {volume_path} or {label_path}")
-        continue
-    except Exception as e:
-        print(f"Error loading files: {e}")
-        continue
+# Function to load, augment and save one volume and its label, raising an error if any step fails
+def process_volume_pair(volume_path, label_path, output_dir):
+    volume_file = os.path.basename(volume_path)
+    label_file = os.path.basename(label_path)
+
+    volume_data = load_nifti_file(volume_path)
+    label_data = load_nifti_file(label_path).astype(np.int32)
 
     # Validate that the volume and label data have the same shape
     if volume_data.shape != label_data.shape:
-        print(f"Error: Shape mismatch between volume and label for {volume_file} and {label_file}")
-        continue
+        raise ValueError(f"Shape mismatch between volume and label for {volume_file} and {label_file}")
 
     # Validate that volume and label data are not empty
     if volume_data.size == 0 or label_data.size == 0:
-        print(f"Error: Volume or label data is empty for {volume_file} and {label_file}")
-        continue
+        raise ValueError(f"Volume or label data is empty for {volume_file} and {label_file}")
 
     # Modify the label data to retain only the values of 1, putting 0 everywhere else
     label_data_modified = np.where(label_data == 3, 1, 0)
@@ -50,23 +32,45 @@ for volume_file, label_file in zip(volume_files, label_files):
     # Convert the modified label data to float64 for consistency with the processing pipeline
     label_data_modified = label_data_modified.astype(np.float64)
 
-    # Generate augmented volumes and labels using the process_volume_and_label function
-    try:
-        volume_aug, label_aug = process_volume_and_label(volume_data, label_data_modified)
-    except Exception as e:
-        print(f"Error during augmentation processing for {volume_file}: {e}")
-        continue
+    # Generate augmented volumes and labels for all slices at once using the batched augmentation engine
+    volume_aug, label_aug = process_volume_and_label_batched(volume_data, label_data_modified)
 
     # Validate that augmentations were generated correctly
     if len(volume_aug) != len(label_aug):
-        print(f"Error: Mismatch between augmented volumes and labels for {volume_file}")
-        continue
+        raise RuntimeError(f"Mismatch between augmented volumes and labels for {volume_file}")
 
     # Save the augmented volumes and labels using the save_augmented_volumes function
-    try:
-        save_augmented_volumes(volume_aug, label_aug, output_dir, prefix=volume_file.split('.')[0])
-    except Exception as e:
-        print(f"Error saving augmented volumes for {volume_file}: {e}")
-        continue
+    prefix = volume_file.split('.')[0]
+    save_augmented_volumes(volume_aug, label_aug, output_dir, prefix=prefix)
+    return {'prefix': prefix, 'shape': [int(n) for n in volume_aug[0].shape]}
+
+# Function to estimate the peak memory of process_volume_pair from the volume's NIfTI header alone
+def estimate_volume_pair_memory(volume_path, label_path, output_dir):
+    shape, image_dtype = read_nifti_shape_and_dtype(volume_path)
+    return estimate_augmentation_memory(shape, image_dtype, np.float64)
+
+def main():
+    parser = argparse.ArgumentParser(description="Augment every CT-ORG volume and label pair in a directory.")
+    parser.add_argument('--data-dir', default=data_dir, help="Directory containing volume-*.nii.gz and labels-*.nii.gz files")
+    parser.add_argument('--output-dir', default=output_dir, help="Directory for the augmented NIfTI files")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes (default: 1)")
+    parser.add_argument('--memory-budget', default=None,
+                        help="Total memory the running volumes may use, e.g. 24G; volumes wait until they fit")
+    args = parser.parse_args()
+
+    # Create output directory if it doesn't exist
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    # Get the list of all volume and label files in the directory, sorted for consistency
+    tasks = [(volume_file, (os.path.join(args.data_dir, volume_file), os.path.join(args.data_dir, label_file), args.output_dir))
+             for volume_file, label_file in find_volume_label_pairs(args.data_dir)]
+    results, failures = run_batch(process_volume_pair, tasks, num_workers=args.workers,
+                                  memory_budget=args.memory_budget, estimate_fn=estimate_volume_pair_memory)
+
+    for volume_file, error in failures.items():
+        print(f"Error processing {volume_file}: {error.splitlines()[0]}")
+    print(f"Processing completed: {len(results)} succeeded, {len(failures)} failed.")
 
-print("Processing completed.")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
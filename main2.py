@@ -1,73 +1,612 @@
 import os
-from file_handler2 import load_nifti_file, save_augmented_volumes
-from augmentation_pipeline import process_volume_and_label
+import json
+import time
+import socket
+import argparse
+from contextlib import ExitStack, contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from file_handler2 import (load_nifti_file, read_nifti_shape_and_dtype, save_augmented_volumes, open_nifti_file,
+                           iter_nifti_slabs, open_augmented_volume_writers, finish_augmented_labels, LABEL_FILE_MODES)
+from augmentation_pipeline import (process_volume_and_label_batched, iter_volume_augmentations_batched, process_volume_slabs_batched,
+                                  estimate_augmentation_memory)
+from augmentation_utils import allocate_augmentation_buffers
+from batch_runner import find_volume_label_pairs, run_batch, run_pipelined_batch, partition_tasks
+from instrumentation import stage, count, run_with_metrics, collect_metrics, VolumeMetrics, MetricsLog
+from label_processing import (label_options_with_defaults, label_lookup_table, remap_label, foreground_extent,
+                              merge_foreground_extents, select_foreground, select_slab, selection_affine, save_selection,
+                              LABEL_MODES)
+from shard_store import (ShardWriter, save_augmented_shard, shard_path, shared_label_entry, write_window_volumes,
+                         SHARD_AUGMENTATION_NAMES)
+from augmentation_cache import (load_manifest, save_manifest, input_hash, augmentation_keys, outdated_augmentations,
+                                remove_augmentation_outputs, record_augmentations, OutputCache, InputCache, MANIFEST_NAME)
+from work_claims import WorkClaims, file_lock
+from intensity_transforms import parse_window, apply_windows, WINDOW_PRESETS
 import numpy as np
 
 # Define directories
 data_dir = '/Users/omkarbhope/Library/Mobile Documents/com~apple~CloudDocs/Research/PKG - CT-ORG/CT-ORG/TestData'
 output_dir = 'augmented_nifti_volumes3'
 
-# Create output directory if it doesn't exist
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
+# Keep images in their native dtype (float32 if the file applies scaling) and labels in uint8,
+# and write augmentations into preallocated buffers, instead of upcasting everything to float64.
+# Off by default, so outputs keep the float64 values of earlier versions unless --native-dtype is given
+preserve_dtype = False
 
-# Get the list of all volume and label files in the directory, sorted for consistency
-volume_files = sorted([f for f in os.listdir(data_dir) if f.startswith('volume') and f.endswith('.nii.gz')])
-label_files = sorted([f for f in os.listdir(data_dir) if f.startswith('labels') and f.endswith('.nii.gz')])
+# Function to load, augment and save one volume and its label, raising an error if any step fails
+# save_options are passed on to save_augmented_volumes and augment_options to process_volume_and_label_batched;
+# with slab_size set the pair is streamed slab by slab instead. label_options (see label_processing) choose the label
+# classes to keep and whether only the slices or region holding them are augmented; outputs of a selection are recorded
+# in <prefix>_selection.json and the kept slices returned under 'slices'. augment_options['windows'] optionally lists
+# intensity windows (see intensity_transforms.parse_window) written as uint8 volumes next to the normalized volume.
+# With metrics_options set (a dict, optionally with a 'profile_dir' for cProfile stats), the stage timings and
+# counters of the pair are returned under 'metrics'. input_cache optionally is an augmentation_cache.InputCache the
+# inputs are read from decompressed
+def process_volume_pair(volume_path, label_path, output_dir, preserve_dtype=False, slab_size=None, save_options=None,
+                        augment_options=None, label_options=None, metrics_options=None, input_cache=None):
+    if metrics_options is not None:
+        profile_dir = metrics_options.get('profile_dir')
+        profile_path = os.path.join(profile_dir, os.path.basename(volume_path).split('.')[0] + '.prof') if profile_dir else None
+        result, metrics = run_with_metrics(process_volume_pair, (volume_path, label_path, output_dir, preserve_dtype, slab_size,
+                                                                 save_options, augment_options, label_options, None,
+                                                                 input_cache), profile_path)
+        return dict(result, metrics=metrics)
+    label_options = label_options_with_defaults(label_options)
+    if slab_size:
+        return process_volume_pair_streaming(volume_path, label_path, output_dir, preserve_dtype, slab_size, save_options,
+                                             augment_options, label_options, input_cache)
+    pair = read_volume_pair(volume_path, label_path, output_dir, preserve_dtype, save_options, augment_options, label_options,
+                            input_cache)
+    if pair['stream_variants']:
+        # Write each augmentation while the next is computed, holding about two at a time instead of all twelve outputs
+        variants = iter_volume_augmentations_batched(pair.pop('volume_data'), pair.pop('label_data'), **pair['augment_options'])
+        save_augmented_variants(variants, output_dir, pair['prefix'], pair['affine'], pair['metadata'], pair['save_options'],
+                                pair['shards'], pair['windows'])
+        return volume_pair_result(pair['prefix'], pair['output_shape'], output_dir, label_options, pair['slices'],
+                                  pair['box'], pair['depth'])
+    return write_volume_pair(augment_volume_pair(pair))
 
-# Validate that there is a matching label for each volume
-if len(volume_files) != len(label_files):
-    raise ValueError("The number of volume files and label files must be the same.")
+# Function to load a volume and its label, remap the label and select the slices to augment, the first of the three
+# stages of process_volume_pair. Returns the pair as a dict carrying everything augment_volume_pair and
+# write_volume_pair need, so the stages can run on different threads (see run_pipelined_batch)
+def read_volume_pair(volume_path, label_path, output_dir, preserve_dtype=False, save_options=None, augment_options=None,
+                     label_options=None, input_cache=None):
+    label_options = label_options_with_defaults(label_options)
+    augment_options, windows = split_window_options(augment_options)
+    volume_file = os.path.basename(volume_path)
+    label_file = os.path.basename(label_path)
 
-# Loop through all volume and label files
-for volume_file, label_file in zip(volume_files, label_files):
-    volume_path = os.path.join(data_dir, volume_file)
-    label_path = os.path.join(data_dir, label_file)
-
-    try:
-        volume_data, volume_affine, volume_metadata = load_nifti_file(volume_path)
-        label_data, label_affine, label_metadata = load_nifti_file(label_path)
+    if preserve_dtype:
+        volume_data, volume_affine, volume_metadata = load_nifti_file(volume_path, dtype='native', input_cache=input_cache)
+        label_data, label_affine, label_metadata = load_nifti_file(label_path, dtype='native', input_cache=input_cache)
+    else:
+        volume_data, volume_affine, volume_metadata = load_nifti_file(volume_path, input_cache=input_cache)
+        label_data, label_affine, label_metadata = load_nifti_file(label_path, input_cache=input_cache)
         label_data = label_data.astype(np.int32)
-    except FileNotFoundError:
-        print(f"Error: File not found - {volume_path} or {label_path}")
-        continue
-    except Exception as e:
-        print(f"Error loading files: {e}")
-        continue
 
     # Validate that the volume and label data have the same shape
     if volume_data.shape != label_data.shape:
-        print(f"Error: Shape mismatch between volume and label for {volume_file} and {label_file}")
-        continue
+        raise ValueError(f"Shape mismatch between volume and label for {volume_file} and {label_file}")
 
     # Validate that volume and label data are not empty
     if volume_data.size == 0 or label_data.size == 0:
-        print(f"Error: Volume or label data is empty for {volume_file} and {label_file}")
-        continue
+        raise ValueError(f"Volume or label data is empty for {volume_file} and {label_file}")
+
+    # Remap the label classes to keep to 1 (or 1, 2, ... for several classes), putting 0 everywhere else
+    with stage('label_remap'):
+        label_data_modified = remap_label(label_data, label_lookup_table(label_options['values'], label_options['binary']))
+    del label_data
 
-    # Modify the label data to retain only the values of 1, putting 0 everywhere else
-    label_data_modified = np.where(label_data == 3, 1, 0)
+    # Keep only the slices (and region) holding foreground, so the work scales with the organ instead of the scan
+    depth = volume_data.shape[2]
+    slices, box = np.arange(depth), None
+    if label_options['mode'] != 'all':
+        with stage('label_select'):
+            slices, box = select_foreground(foreground_extent(label_data_modified), label_options['mode'],
+                                            label_options['subsample_step'], label_options['padding'])
+            if len(slices) == 0:
+                raise ValueError(f"No foreground of classes {label_options['values']} in {label_file} to select slices from.")
+            volume_data = select_slab(volume_data, 0, slices, box)
+            label_data_modified = select_slab(label_data_modified, 0, slices, box)
+        count('slices_skipped', depth - len(slices))
+    if not preserve_dtype:
+        # Convert the modified label data to float64 for consistency with the processing pipeline
+        label_data_modified = label_data_modified.astype(np.float64)
 
-    # Convert the modified label data to float64 for consistency with the processing pipeline
-    label_data_modified = label_data_modified.astype(np.float64)
+    save_options = dict(save_options or {})
+    return {'volume_file': volume_file, 'prefix': volume_file.split('.')[0], 'output_dir': output_dir,
+            'preserve_dtype': preserve_dtype, 'volume_data': volume_data, 'label_data': label_data_modified,
+            'affine': selection_affine(volume_affine, slices, box), 'metadata': volume_metadata,
+            'output_shape': [512, 512, int(volume_data.shape[2])], 'slices': slices, 'box': box, 'depth': depth,
+            'shards': save_options.pop('output_format', 'nifti') == 'shards',
+            'stream_variants': save_options.pop('stream_variants', False), 'save_options': save_options,
+            'augment_options': augment_options, 'windows': windows, 'label_options': label_options}
 
-    # Generate augmented volumes and labels using the process_volume_and_label function
-    try:
-        volume_aug, label_aug = process_volume_and_label(volume_data, label_data_modified)
-    except Exception as e:
-        print(f"Error during augmentation processing for {volume_file}: {e}")
-        continue
+# Function to augment a pair given by read_volume_pair, replacing its input volumes by the augmented outputs
+def augment_volume_pair(pair):
+    volume_data, label_data = pair.pop('volume_data'), pair.pop('label_data')
+    augment_options = pair['augment_options']
+    # Generate augmented volumes and labels for all slices at once using the batched augmentation engine
+    with stage('augment'):
+        if pair['preserve_dtype']:
+            out_volumes, out_labels = allocate_augmentation_buffers(volume_data.shape, volume_data.dtype, np.uint8,
+                                                                    augment_options.get('augmentations'))
+            volume_aug, label_aug = process_volume_and_label_batched(volume_data, label_data, out_volumes, out_labels,
+                                                                     **augment_options)
+        else:
+            volume_aug, label_aug = process_volume_and_label_batched(volume_data, label_data, **augment_options)
+    del volume_data, label_data
 
     # Validate that augmentations were generated correctly
     if len(volume_aug) != len(label_aug):
-        print(f"Error: Mismatch between augmented volumes and labels for {volume_file}")
-        continue
+        raise RuntimeError(f"Mismatch between augmented volumes and labels for {pair['volume_file']}")
+    pair['volume_aug'], pair['label_aug'] = volume_aug, label_aug
+    pair['window_aug'] = window_outputs(volume_aug[0], pair['windows'])
+    return pair
+
+# Function to save the outputs of a pair given by augment_volume_pair, returning the result of process_volume_pair
+def write_volume_pair(pair):
+    volume_aug, label_aug, window_aug = pair.pop('volume_aug'), pair.pop('label_aug'), pair.pop('window_aug')
+    # Save the augmented volumes and labels as NIfTI files, or as one shard with save_options['output_format'] == 'shards'
+    if pair['shards']:
+        save_augmented_shard(volume_aug, label_aug, pair['output_dir'], pair['prefix'], window_aug=window_aug,
+                             **pair['save_options'])
+    else:
+        save_augmented_volumes(volume_aug, label_aug, pair['output_dir'], prefix=pair['prefix'], affine=pair['affine'],
+                               important_metadata=pair['metadata'], window_aug=window_aug, **pair['save_options'])
+    return volume_pair_result(pair['prefix'], pair['output_shape'], pair['output_dir'], pair['label_options'],
+                              pair['slices'], pair['box'], pair['depth'])
+
+# Functions running the three stages of process_volume_pair for run_pipelined_batch, taking the same arguments
+# Each stage reports to the pair's own metrics, as the stages of different pairs run at the same time. The total time
+# of a pair runs from the start of its read to the end of its write, including the time it waited between stages
+def read_pipelined_pair(volume_path, label_path, output_dir, preserve_dtype=False, slab_size=None, save_options=None,
+                        augment_options=None, label_options=None, metrics_options=None, input_cache=None):
+    metrics = VolumeMetrics() if metrics_options is not None else None
+    start = time.perf_counter()
+    with collect_metrics(metrics):
+        pair = read_volume_pair(volume_path, label_path, output_dir, preserve_dtype, save_options, augment_options,
+                                label_options, input_cache)
+    pair['metrics'], pair['start'] = metrics, start
+    return pair
+
+def augment_pipelined_pair(pair):
+    with collect_metrics(pair['metrics']):
+        return augment_volume_pair(pair)
+
+def write_pipelined_pair(pair):
+    with collect_metrics(pair['metrics']):
+        result = write_volume_pair(pair)
+    if pair['metrics'] is None:
+        return result
+    pair['metrics'].add_time('total', time.perf_counter() - pair['start'])
+    return dict(result, metrics=pair['metrics'].as_dict())
+
+# Function to take the intensity windows out of augment_options, returning (the other options, the parsed windows)
+def split_window_options(augment_options):
+    augment_options = dict(augment_options or {})
+    return augment_options, [parse_window(window) for window in augment_options.pop('windows', None) or []]
+
+# Function to compute the intensity windows of a normalized volume (or slab) in one pass, as {name: uint8 volume}
+# Windows belong to the normalized output, so when it was not computed (it is up to date) every window is None
+def window_outputs(normalized, windows):
+    if normalized is None or not windows:
+        return {window['name']: None for window in windows}
+    with stage('augment.windows'):
+        return {window['name']: window_volume for window, window_volume in zip(windows, apply_windows(normalized, windows))}
+
+# Function to give the result of a processed pair, recording the selected slices next to the outputs if any were skipped
+def volume_pair_result(prefix, output_shape, output_dir, label_options, slices, box, depth):
+    if label_options['mode'] == 'all':
+        return {'prefix': prefix, 'shape': list(output_shape)}
+    save_selection(output_dir, prefix, slices, box, depth)
+    return {'prefix': prefix, 'shape': list(output_shape), 'slices': slices.tolist()}
+
+# Function to save augmentations one at a time as a generator such as iter_volume_augmentations_batched yields them
+# A writer thread saves each augmentation while the next one is computed, and an augmentation is only handed over once the
+# previous one is written, so no more than two are held at once. Options are those of save_augmented_volumes, or of
+# ShardWriter when shards is set. Intensity windows are computed and written with the normalized volume, on the writer thread
+def save_augmented_variants(variants, output_dir, prefix, affine, important_metadata, save_options, shards=False, windows=()):
+    with ExitStack() as exit_stack:
+        if shards:
+            os.makedirs(output_dir, exist_ok=True)
+            shard_writer = exit_stack.enter_context(ShardWriter(shard_path(output_dir, prefix), **save_options))
+            entries = {}
+
+            def save_variant(i, volume, label):
+                with stage('save'):
+                    entries[i] = shard_writer.write_volume(prefix, SHARD_AUGMENTATION_NAMES[i], volume, label,
+                                                           shared_label_entry(i, entries) if label is not None else None)
+                if i == 0:
+                    window_aug = window_outputs(volume, windows)
+                    with stage('save'):
+                        write_window_volumes(shard_writer, prefix, window_aug, label, entries)
+        else:
+            def save_variant(i, volume, label):
+                volume_aug, label_aug = [None] * 6, [None] * 6
+                volume_aug[i], label_aug[i] = volume, label
+                window_aug = window_outputs(volume if i == 0 else None, windows)
+                save_augmented_volumes(volume_aug, label_aug, output_dir, prefix=prefix, affine=affine,
+                                       important_metadata=important_metadata, window_aug=window_aug, **save_options)
+
+        executor = exit_stack.enter_context(ThreadPoolExecutor(max_workers=1))
+        pending = None
+        for i, volume, label in variants:
+            if pending is not None:
+                pending.result()
+            pending = executor.submit(save_variant, i, volume, label)
+            del volume, label
+        if pending is not None:
+            pending.result()
+
+# Function to load, augment and save one volume and its label slab by slab, so memory depends on slab_size only
+# Augmentation starts on the first slab while the rest of the gzip stream is still undecompressed. Outputs are written
+# in the input datatype when it holds them losslessly (e.g. int16 images and uint8 labels), otherwise unscaled as float
+# With a label selection, the label is read once ahead to find its foreground, and only the slabs holding kept slices
+# are augmented
+def process_volume_pair_streaming(volume_path, label_path, output_dir, preserve_dtype=False, slab_size=32, save_options=None,
+                                  augment_options=None, label_options=None, input_cache=None):
+    volume_file = os.path.basename(volume_path)
+    label_file = os.path.basename(label_path)
+
+    volume_image, volume_affine, volume_metadata = open_nifti_file(volume_path, input_cache)
+    label_image, label_affine, label_metadata = open_nifti_file(label_path, input_cache)
+
+    # Validate that the volume and label data have the same shape, from the headers alone
+    if volume_image.shape != label_image.shape:
+        raise ValueError(f"Shape mismatch between volume and label for {volume_file} and {label_file}")
+
+    # Validate that volume and label data are not empty
+    if 0 in volume_image.shape:
+        raise ValueError(f"Volume or label data is empty for {volume_file} and {label_file}")
+
+    # Read both files slab by slab and remap each label slab, keeping the chosen classes and putting 0 everywhere else
+    label_options = label_options_with_defaults(label_options)
+    augment_options, windows = split_window_options(augment_options)
+    lut = label_lookup_table(label_options['values'], label_options['binary'])
+
+    def remap_label_slabs(first=0, stop=None):
+        for start, slab in iter_nifti_slabs(label_image, slab_size, dtype='native', first=first, stop=stop):
+            with stage('label_remap'):
+                slab = remap_label(slab, lut)
+            yield start, slab
+
+    # Find the slices to keep from a first pass over the label, and read only the range of slices holding them
+    depth = volume_image.shape[2]
+    slices, box = np.arange(depth), None
+    if label_options['mode'] != 'all':
+        extent = merge_foreground_extents(foreground_extent(slab) for _, slab in remap_label_slabs())
+        with stage('label_select'):
+            slices, box = select_foreground(extent, label_options['mode'], label_options['subsample_step'],
+                                            label_options['padding'])
+        if len(slices) == 0:
+            raise ValueError(f"No foreground of classes {label_options['values']} in {label_file} to select slices from.")
+        count('slices_skipped', depth - len(slices))
+    first, stop = int(slices[0]), int(slices[-1]) + 1
+
+    # Number the kept slices of each slab by their position in the outputs
+    def select_slabs(slabs, dtype=None):
+        position = 0
+        for start, slab in slabs:
+            slab = select_slab(slab, start, slices, box)
+            if slab is None:
+                continue
+            yield position, slab if dtype is None else slab.astype(dtype)
+            position += slab.shape[2]
+    volume_slabs = select_slabs(iter_nifti_slabs(volume_image, slab_size, dtype='native' if preserve_dtype else None,
+                                                 first=first, stop=stop))
+    label_slabs = select_slabs(remap_label_slabs(first, stop), None if preserve_dtype else np.float64)
+
+    # Augment each slab and append it to the twelve output files as soon as it is ready
+    prefix = volume_file.split('.')[0]
+    output_shape = (512, 512, len(slices))
+    volume_affine = selection_affine(volume_affine, slices, box)
+    writer_options = dict(save_options or {})
+    # Slabs already bound the memory of every output, so augmentations are not streamed one at a time as well
+    writer_options.pop('stream_variants', None)
+    write_workers = max(1, writer_options.pop('write_workers', 1))
+    shards = writer_options.pop('output_format', 'nifti') == 'shards'
+    with ExitStack() as exit_stack:
+        executor = exit_stack.enter_context(ThreadPoolExecutor(max_workers=write_workers))
+        volume_writers = label_writers = shard_writer = None
+        for start, volume_aug, label_aug in process_volume_slabs_batched(volume_slabs, label_slabs, **augment_options):
+            window_aug = window_outputs(volume_aug[0], windows)
+            if shards:
+                # The shard holds all twelve outputs in one file, so its slabs are appended in order by this thread
+                if shard_writer is None:
+                    os.makedirs(output_dir, exist_ok=True)
+                    shard_writer = exit_stack.enter_context(ShardWriter(shard_path(output_dir, prefix), **writer_options))
+                    entries = {}
+                    for i, aug in enumerate(volume_aug):
+                        if aug is not None:
+                            entries[i] = shard_writer.add_volume(prefix, SHARD_AUGMENTATION_NAMES[i], output_shape[2],
+                                                                 output_shape[:2], aug.dtype, label_aug[i].dtype,
+                                                                 shared_label_entry(i, entries))
+                    window_entries = {name: shard_writer.add_volume(prefix, f'window_{name}', output_shape[2], output_shape[:2],
+                                                                    np.uint8, label_aug[0].dtype, entries.get(0))
+                                      for name, window_slab in window_aug.items() if window_slab is not None}
+                with stage('save'):
+                    for i, entry_index in entries.items():
+                        shard_writer.write_slices(entry_index, volume_aug[i], label_aug[i])
+                    for name, entry_index in window_entries.items():
+                        shard_writer.write_slices(entry_index, window_aug[name])
+                del volume_aug, label_aug, window_aug
+                continue
+            if volume_writers is None:
+                volume_writers, label_writers, window_writers = open_augmented_volume_writers(
+                    exit_stack, output_dir, prefix, output_shape, [aug.dtype if aug is not None else None for aug in volume_aug],
+                    [aug.dtype if aug is not None else None for aug in label_aug], volume_affine, volume_metadata,
+                    windows=[name for name, window_slab in window_aug.items() if window_slab is not None], **writer_options)
+            # Each output file has its own writer, so the twelve slabs (and windows) can be appended concurrently
+            # (augmentations that are not being recomputed have no writer)
+            jobs = [(writer, aug) for writer, aug in zip(volume_writers + label_writers, volume_aug + label_aug) if writer is not None]
+            jobs += [(writer, window_aug[name]) for name, writer in window_writers.items()]
+            with stage('save'):
+                list(executor.map(lambda job: job[0].write_slab(job[1]), jobs))
+            del volume_aug, label_aug, window_aug
+    if label_writers is not None:
+        finish_augmented_labels(output_dir, prefix, [i for i, writer in enumerate(label_writers) if writer is not None],
+                                writer_options.get('label_files', 'shared'), writer_options.get('compressed', True),
+                                [window['name'] for window in windows])
+    return volume_pair_result(prefix, output_shape, output_dir, label_options, slices, box, depth)
+
+# Function to estimate the peak memory of process_volume_pair from the volume's NIfTI header alone
+def estimate_volume_pair_memory(volume_path, label_path, output_dir, preserve_dtype=False, slab_size=None, save_options=None,
+                                augment_options=None, label_options=None, metrics_options=None, input_cache=None):
+    shape, image_dtype = read_nifti_shape_and_dtype(volume_path, dtype='native' if preserve_dtype else None)
+    if slab_size:
+        shape = shape[:2] + (min(slab_size, shape[2]),)
+    return estimate_augmentation_memory(shape, image_dtype, np.uint8 if preserve_dtype else np.float64,
+                                        streamed_variants=not slab_size and (save_options or {}).get('stream_variants', False),
+                                        windows=len((augment_options or {}).get('windows') or []))
+
+# Function to augment every volume and label pair in data_dir on a pool of worker processes
+# Returns (results, failures) keyed by volume file; failures hold the error text for each volume that failed
+# With slab_size set, each volume is streamed through process_volume_pair_streaming instead of loaded whole
+# With incremental=True, a manifest in output_dir records a content hash of every input and a key for every output,
+# so a rerun only recomputes the augmentations whose inputs or parameters changed (or whose files are missing).
+# cache_dir optionally keeps every output under its key, bounded to cache_size by least-recently-used eviction,
+# so outputs deleted or written elsewhere are restored from the cache instead of recomputed.
+# With metrics_path set, stage timings and counters are written there as JSON lines, one record per volume as it
+# finishes and a run summary at the end; profile_dir additionally keeps a cProfile .prof file per volume
+# label_options are passed on to process_volume_pair
+# To spread a batch over machines sharing output_dir, either give each machine its own shard_index of num_shards (a fixed
+# split balanced by input size), or start every machine with the same run_id to claim volumes one at a time through
+# lock files (see work_claims.WorkClaims), which keeps all machines busy until the batch is done and takes over the
+# volumes of machines that die. Results then hold only the volumes this machine processed
+# input_cache_dir optionally keeps decompressed copies of the inputs there (see augmentation_cache.InputCache), bounded to
+# input_cache_size, so later runs memory-map them instead of decompressing each input again
+# With pipelined=True, volumes are not spread over worker processes but run through three threads of this process that
+# read, augment and write them (see run_pipelined_batch), so reading and writing overlap augmenting other volumes.
+# Up to queue_size volumes wait between two stages; memory_budget does not apply. Whole volumes only, without
+# slab_size, stream_variants or profile_dir
+def run_augmentation_batch(data_dir, output_dir, num_workers=1, memory_budget=None, preserve_dtype=False, slab_size=None,
+                           save_options=None, augment_options=None, incremental=False, cache_dir=None, cache_size=None,
+                           metrics_path=None, profile_dir=None, label_options=None, num_shards=1, shard_index=0, run_id=None,
+                           stale_after=600, pipelined=False, queue_size=1, input_cache_dir=None, input_cache_size=None):
+    if pipelined and (slab_size or (save_options or {}).get('stream_variants') or profile_dir):
+        raise ValueError("The pipelined batch reads and writes whole volumes; it cannot be combined with slab_size, "
+                         "stream_variants or profile_dir.")
+    # Create output directory if it doesn't exist
+    os.makedirs(output_dir, exist_ok=True)
+    # The manifest tracks NIfTI outputs only; a shard holds every augmentation of a volume, so shards are always rewritten
+    if (save_options or {}).get('output_format') == 'shards':
+        incremental = False
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+    metrics_options = {'profile_dir': profile_dir} if metrics_path or profile_dir else None
+    input_cache = InputCache(input_cache_dir, input_cache_size) if input_cache_dir else None
+
+    # Get the list of all volume and label files in the directory, sorted for consistency, and keep this machine's shard
+    tasks = [(volume_file, (os.path.join(data_dir, volume_file), os.path.join(data_dir, label_file), output_dir, preserve_dtype,
+                            slab_size, save_options, augment_options, label_options, metrics_options, input_cache))
+             for volume_file, label_file in find_volume_label_pairs(data_dir)]
+    if num_shards > 1:
+        tasks = partition_tasks(tasks, num_shards, shard_index, {name: os.path.getsize(args[0]) for name, args in tasks})
+    shared = num_shards > 1 or run_id is not None
+
+    if incremental:
+        manifest = load_manifest(output_dir)
+        cache = OutputCache(cache_dir, cache_size) if cache_dir else None
+        compressed = (save_options or {}).get('compressed', True)
+        label_files = (save_options or {}).get('label_files', 'shared')
+        windows = [parse_window(window) for window in (augment_options or {}).get('windows') or []]
+        window_names = [window['name'] for window in windows]
+        # The label options in effect decide the label values kept, so they are part of every key
+        parameters = {'preserve_dtype': preserve_dtype, 'streamed': bool(slab_size), 'compressed': compressed,
+                      'fused': (augment_options or {}).get('fused', False),
+                      'label_options': label_options_with_defaults(label_options)}
+    planned, up_to_date = {}, {}
+
+    # Function to change the manifest and save it; when other machines write it too, it is reloaded and saved under a lock
+    @contextmanager
+    def manifest_update():
+        nonlocal manifest
+        with file_lock(os.path.join(output_dir, MANIFEST_NAME + '.lock')) if shared else nullcontext():
+            if shared:
+                input_hashes = manifest['inputs']
+                manifest = load_manifest(output_dir)
+                manifest['inputs'].update(input_hashes)
+            yield manifest
+            save_manifest(output_dir, manifest)
+
+    with ExitStack() as exit_stack:
+        metrics_log = exit_stack.enter_context(MetricsLog(metrics_path)) if metrics_path else None
+        claims = exit_stack.enter_context(WorkClaims(output_dir, run_id, stale_after)) if run_id is not None else None
+
+        # Claim each volume just before it starts, and work out which of its augmentations are outdated
+        def prepare_volume(volume_file, task_args):
+            if claims is not None and not claims.claim(volume_file):
+                return None
+            if not incremental:
+                return task_args
+            volume_path, label_path = task_args[:2]
+            prefix = volume_file.split('.')[0]
+            # Inputs are hashed before taking the manifest lock, so machines hash their volumes in parallel
+            hashes = input_hash(manifest, volume_path), input_hash(manifest, label_path)
+            with manifest_update():
+                keys = augmentation_keys(*hashes, parameters, windows, (augment_options or {}).get('contrast_alpha'))
+                outdated = outdated_augmentations(manifest, output_dir, prefix, keys, compressed, cache, label_files, window_names)
+                remove_augmentation_outputs(manifest, output_dir, prefix, outdated, compressed, label_files, window_names)
+            if not outdated:
+                up_to_date[volume_file] = {'prefix': prefix, 'up_to_date': True}
+                if claims is not None:
+                    claims.release(volume_file, True, up_to_date[volume_file])
+                return None
+            planned[volume_file] = prefix, keys, outdated
+            return task_args[:6] + (dict(augment_options or {}, augmentations=outdated),) + task_args[7:]
+
+        # Record each volume as soon as it finishes, so a crash only loses the volumes still running
+        def record_volume(volume_file, succeeded, value):
+            if succeeded and volume_file in planned:
+                prefix, keys, outdated = planned[volume_file]
+                with manifest_update():
+                    record_augmentations(manifest, output_dir, prefix, keys, outdated, compressed, cache, label_files,
+                                         window_names)
+            if claims is not None:
+                claims.release(volume_file, succeeded, {'prefix': value['prefix']} if succeeded else {'error': value.splitlines()[0]})
+            if metrics_log is not None:
+                if succeeded:
+                    metrics_log.write_volume(volume_file, True, value.get('metrics'))
+                else:
+                    metrics_log.write_volume(volume_file, False, error=value.splitlines()[0])
+
+        if pipelined:
+            results, failures = run_pipelined_batch([read_pipelined_pair, augment_pipelined_pair, write_pipelined_pair], tasks,
+                                                    queue_size=queue_size, on_complete=record_volume, prepare=prepare_volume)
+        else:
+            results, failures = run_batch(process_volume_pair, tasks, num_workers=num_workers, memory_budget=memory_budget,
+                                          estimate_fn=estimate_volume_pair_memory, on_complete=record_volume,
+                                          prepare=prepare_volume)
+        if metrics_log is not None:
+            for volume_file in up_to_date:
+                metrics_log.write({'volume': volume_file, 'succeeded': True, 'up_to_date': True})
+        if claims is not None:
+            claims.write_completion_manifest([volume_file for volume_file, _ in tasks])
+
+    if incremental and cache is not None:
+        cache.evict()
+    if input_cache is not None:
+        input_cache.evict()
+    results = {volume_file: up_to_date[volume_file] if volume_file in up_to_date else results[volume_file]
+               for volume_file, _ in tasks if volume_file in up_to_date or volume_file in results}
+    return results, failures
+
+# Function to write the outcome of a batch run next to the augmented files
+# Machines sharing an output directory each write their own report under report_name
+def write_batch_report(output_dir, results, failures, report_name='batch_report.json'):
+    report = {'processed': sorted(results), 'up_to_date': sorted(name for name, result in results.items() if result.get('up_to_date')),
+              'failed': {name: failures[name] for name in sorted(failures)}}
+    report_path = os.path.join(output_dir, report_name)
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Augment every CT-ORG volume and label pair in a directory.")
+    parser.add_argument('--data-dir', default=data_dir, help="Directory containing volume-*.nii.gz and labels-*.nii.gz files")
+    parser.add_argument('--output-dir', default=output_dir, help="Directory for the augmented NIfTI files")
+    parser.add_argument('--workers', type=int, default=1, help="Number of worker processes (default: 1)")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Instead of worker processes, read, augment and write volumes on three threads at once, so "
+                             "loading the next volume and saving the previous one overlap augmenting the current one")
+    parser.add_argument('--pipeline-queue', type=int, default=1,
+                        help="With --pipeline, volumes held ready between two stages (default: 1)")
+    parser.add_argument('--memory-budget', default=None,
+                        help="Total memory the running volumes may use, e.g. 24G; volumes wait until they fit")
+    parser.add_argument('--native-dtype', action='store_true',
+                        help="Keep images in their stored dtype and labels in uint8 instead of upcasting to float64. Uses "
+                             "far less memory, but interpolated values are rounded, so outputs differ slightly from the default")
+    parser.add_argument('--slab-size', type=int, default=None,
+                        help="Stream each volume through memory this many slices at a time instead of loading it whole")
+    parser.add_argument('--compresslevel', type=int, default=1, choices=range(10), metavar='0-9',
+                        help="gzip compression level of the output files (default: 1)")
+    parser.add_argument('--compress-threads', type=int, default=1,
+                        help="Threads compressing each output file in parallel gzip blocks (default: 1)")
+    parser.add_argument('--uncompressed', action='store_true', help="Write uncompressed .nii files for scratch datasets")
+    parser.add_argument('--stream-variants', action='store_true',
+                        help="Compute and write one augmentation at a time, so about two instead of all twelve outputs "
+                             "are in memory; writing each one overlaps computing the next")
+    parser.add_argument('--label-files', default='shared', choices=LABEL_FILE_MODES,
+                        help="Write labels shared between augmentations once and list them in <volume>_labels.json "
+                             "(default), also hard link them under every augmentation's name, or copy them in full")
+    parser.add_argument('--write-workers', type=int, default=1, help="Number of output files written at the same time (default: 1)")
+    parser.add_argument('--fused-geometry', action='store_true',
+                        help="Resample rotated and zoomed outputs once from the input instead of from the normalized slices")
+    parser.add_argument('--windows', nargs='+', default=None, metavar='WINDOW',
+                        help="Also write the normalized volume through these intensity windows as uint8 volumes, all in "
+                             f"one pass: presets ({', '.join(WINDOW_PRESETS)}) or center,width[,gamma] in HU")
+    parser.add_argument('--force', action='store_true',
+                        help="Recompute every volume instead of only those whose inputs or parameters changed")
+    parser.add_argument('--cache-dir', default=None, help="Keep every output in this content-addressed cache as well")
+    parser.add_argument('--cache-size', default=None, help="Evict least recently used cache files beyond this size, e.g. 200G")
+    parser.add_argument('--input-cache', default=None,
+                        help="Keep decompressed copies of the inputs in this local directory and memory-map them on later runs")
+    parser.add_argument('--input-cache-size', default=None,
+                        help="Evict least recently used decompressed inputs beyond this size, e.g. 50G")
+    parser.add_argument('--output-format', default='nifti', choices=['nifti', 'shards'],
+                        help="Write twelve NIfTI files per volume (default) or one chunked, memory-mappable shard per volume")
+    parser.add_argument('--chunk-slices', type=int, default=16, help="Slices per shard chunk (default: 16)")
+    parser.add_argument('--shard-compression', default=None, choices=['zlib'],
+                        help="Compress each shard chunk on its own (default: uncompressed, read without copying)")
+    parser.add_argument('--label-values', type=int, nargs='+', default=[3],
+                        help="Label classes to keep, e.g. 3 for the liver or 2 3 for lungs and liver (default: 3)")
+    parser.add_argument('--multiclass', action='store_true',
+                        help="Number the kept classes 1, 2, ... in the order given instead of merging them into one mask")
+    parser.add_argument('--label-mode', default='all', choices=LABEL_MODES,
+                        help="Augment all slices (default), skip slices without the kept classes, subsample those slices, "
+                             "or crop to the padded region holding the kept classes")
+    parser.add_argument('--subsample-step', type=int, default=8,
+                        help="With --label-mode subsample, keep every Nth slice without foreground (default: 8)")
+    parser.add_argument('--roi-padding', type=int, default=8,
+                        help="Voxels of context kept around the foreground by the skip, subsample and crop modes (default: 8)")
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help="Split the volumes between this many machines, each run with its own --shard-index (default: 1)")
+    parser.add_argument('--shard-index', type=int, default=0, help="Shard of the volumes this machine processes, from 0")
+    parser.add_argument('--claim-run', default=None,
+                        help="Claim volumes one at a time through lock files in the output directory, shared with every "
+                             "machine started with the same run name; rerunning a name resumes that run")
+    parser.add_argument('--stale-after', type=float, default=600,
+                        help="Seconds after which the claim of a machine that stopped responding is taken over (default: 600)")
+    parser.add_argument('--metrics', default=None, help="Write per-volume stage timings and counters to this JSON-lines file")
+    parser.add_argument('--profile-dir', default=None, help="Run each volume under cProfile and keep its stats in this directory")
+    args = parser.parse_args()
+
+    if args.output_format == 'shards':
+        save_options = {'output_format': 'shards', 'chunk_slices': args.chunk_slices, 'compression': args.shard_compression,
+                        'compresslevel': args.compresslevel, 'stream_variants': args.stream_variants}
+    else:
+        save_options = {'compresslevel': args.compresslevel, 'compress_threads': args.compress_threads,
+                        'compressed': not args.uncompressed, 'write_workers': args.write_workers,
+                        'stream_variants': args.stream_variants, 'label_files': args.label_files}
+    results, failures = run_augmentation_batch(args.data_dir, args.output_dir, num_workers=args.workers,
+                                               memory_budget=args.memory_budget,
+                                               preserve_dtype=preserve_dtype or args.native_dtype,
+                                               slab_size=args.slab_size, save_options=save_options,
+                                               augment_options={'fused': args.fused_geometry, 'windows': args.windows},
+                                               incremental=not args.force,
+                                               cache_dir=args.cache_dir, cache_size=args.cache_size,
+                                               metrics_path=args.metrics, profile_dir=args.profile_dir,
+                                               label_options={'values': args.label_values, 'binary': not args.multiclass,
+                                                              'mode': args.label_mode, 'subsample_step': args.subsample_step,
+                                                              'padding': args.roi_padding},
+                                               num_shards=args.num_shards, shard_index=args.shard_index, run_id=args.claim_run,
+                                               stale_after=args.stale_after, pipelined=args.pipeline,
+                                               queue_size=args.pipeline_queue, input_cache_dir=args.input_cache,
+                                               input_cache_size=args.input_cache_size)
 
-    # Save the augmented volumes and labels using the save_augmented_volumes function
-    try:
-        save_augmented_volumes(volume_aug, label_aug, output_dir, prefix=volume_file.split('.')[0], affine=volume_affine, important_metadata=volume_metadata)
-    except Exception as e:
-        print(f"Error saving augmented volumes for {volume_file}: {e}")
-        continue
+    # Print a summary and keep the full error of every failed volume in the report
+    for volume_file, error in failures.items():
+        print(f"Error processing {volume_file}: {error.splitlines()[0]}")
+    if args.claim_run is not None:
+        report_name = f'batch_report-{args.claim_run}-{socket.gethostname()}-{os.getpid()}.json'
+    elif args.num_shards > 1:
+        report_name = f'batch_report-{args.shard_index}-of-{args.num_shards}.json'
+    else:
+        report_name = 'batch_report.json'
+    report_path = write_batch_report(args.output_dir, results, failures, report_name)
+    up_to_date = sum(1 for result in results.values() if result.get('up_to_date'))
+    print(f"Processing completed: {len(results)} succeeded ({up_to_date} already up to date), {len(failures)} failed "
+          f"(see {report_path}).")
 
-print("Processing completed.")
+if __name__ == '__main__':
+    main()
@@ -1,104 +1,287 @@
-import cv2
-import matplotlib.pyplot as plt
 import os
-import numpy as np
-import pydicom
-from pydicom.dataset import Dataset, FileDataset
+import struct
+import argparse
 import datetime
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from augmentation_utils import empty_volume
+from augmentation_pipeline import process_volume_and_label_batched
+from instrumentation import stage, count
+from dicom_index import DicomIndex, slice_position
+from intensity_transforms import parse_window, apply_windows, WINDOW_PRESETS
+from lazy_imports import lazy_import
+
+pydicom = lazy_import('pydicom')
 
 # Folder containing DICOM files
 dicom_folder_path = "/Users/omkarbhope/Library/Mobile Documents/com~apple~CloudDocs/Research/CT_Images/100002/1.2.840.113654.2.55.187766322555605983451267194286230980878/1.2.840.113654.2.55.122344168497038128022524906545138736420"  # Replace with your folder path
 
 # Output folder for augmented DICOM files
 output_folder_path = "./augmented_dicoms"
-os.makedirs(output_folder_path, exist_ok=True)
-
-# Get list of DICOM files
-dicom_files = [f for f in os.listdir(dicom_folder_path) if f.endswith(".dcm")]
-
-# Function for Normalization: Resize the image to 512x512 pixels
-def normalize_image(image):
-    return cv2.resize(image, (512, 512))
-
-# Function for Color Space Conversion: Convert the image to grayscale
-def convert_to_grayscale(image):
-    if len(image.shape) == 3:
-        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    return image
-
-# Function for Data Augmentation: Apply rotation
-def rotate_image(image, angle=30):
-    rows, cols = image.shape
-    rotation_matrix = cv2.getRotationMatrix2D((cols / 2, rows / 2), angle, 1)
-    return cv2.warpAffine(image, rotation_matrix, (cols, rows))
-
-# Function for Data Augmentation: Apply flipping
-def flip_image(image):
-    return cv2.flip(image, 1)  # Horizontal flip
-
-# Function for Data Augmentation: Apply zooming (cropping and resizing back to original size)
-def zoom_image(image):
-    zoomed_image = image[50:462, 50:462]  # Crop the central region
-    return cv2.resize(zoomed_image, (512, 512))
-
-# Function for Data Augmentation: Adjust contrast
-def adjust_contrast(image, alpha=0.15, beta=0):
-    return cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
-
-# Function for Noise Reduction: Apply Gaussian blur
-def reduce_noise(image):
-    return cv2.GaussianBlur(image, (5, 5), 0)
-
-# Function to save the augmented image as DICOM
-def save_augmented_dicom(file_name, original_dicom, augmented_image, suffix):
-    # Create a new DICOM dataset
-    new_dicom = FileDataset(None, {}, file_meta=original_dicom.file_meta, preamble=b"\0" * 128)
-    new_dicom.PixelData = augmented_image.tobytes()
-    new_dicom.Rows, new_dicom.Columns = augmented_image.shape
-    new_dicom.BitsAllocated = original_dicom.BitsAllocated
-    new_dicom.BitsStored = original_dicom.BitsStored
-    new_dicom.HighBit = original_dicom.HighBit
-    new_dicom.PixelRepresentation = original_dicom.PixelRepresentation
-    new_dicom.SamplesPerPixel = original_dicom.SamplesPerPixel
-    new_dicom.PhotometricInterpretation = original_dicom.PhotometricInterpretation
-    new_dicom.InstanceCreationDate = datetime.datetime.now().strftime('%Y%m%d')
-    new_dicom.InstanceCreationTime = datetime.datetime.now().strftime('%H%M%S')
-    new_dicom.SOPInstanceUID = pydicom.uid.generate_uid()
-    
-    # Update metadata
-    new_dicom.PatientName = original_dicom.PatientName
-    new_dicom.PatientID = original_dicom.PatientID
-    new_dicom.StudyInstanceUID = original_dicom.StudyInstanceUID
-    new_dicom.SeriesInstanceUID = original_dicom.SeriesInstanceUID
-    new_dicom.ImagePositionPatient = original_dicom.ImagePositionPatient
-    new_dicom.PixelSpacing = original_dicom.PixelSpacing
-    
-    # Save the new DICOM file
-    output_path = os.path.join(output_folder_path, f"{file_name}_{suffix}.dcm")
-    new_dicom.save_as(output_path)
-
-# Function to process an image and save all augmentations
-def process_image(image_path, file_name):
-    dicom_data = pydicom.dcmread(image_path)
-    image = dicom_data.pixel_array
-    
-    # Apply each processing step
-    normalized_image = normalize_image(image)
-    grayscale_image = convert_to_grayscale(normalized_image)
-    rotated_image = rotate_image(grayscale_image)
-    flipped_image = flip_image(grayscale_image)
-    zoomed_image = zoom_image(grayscale_image)
-    contrast_image = adjust_contrast(grayscale_image)
-    denoised_image = reduce_noise(grayscale_image)
-    
-    # Save all augmented images as DICOM
-    save_augmented_dicom(file_name, dicom_data, grayscale_image, "grayscale")
-    save_augmented_dicom(file_name, dicom_data, rotated_image, "rotated")
-    save_augmented_dicom(file_name, dicom_data, flipped_image, "flipped")
-    save_augmented_dicom(file_name, dicom_data, zoomed_image, "zoomed")
-    save_augmented_dicom(file_name, dicom_data, contrast_image, "contrast")
-    save_augmented_dicom(file_name, dicom_data, denoised_image, "denoised")
-
-# Process each DICOM file in the folder
-for dicom_file in dicom_files:
-    process_image(os.path.join(dicom_folder_path, dicom_file), dicom_file)
+
+# File name suffixes of the six augmented series, in the order process_volume_and_label_batched returns them
+DICOM_AUGMENTATION_SUFFIXES = ['grayscale', 'rotated', 'flipped', 'zoomed', 'contrast', 'denoised']
+
+# Contrast factor of the contrast series, lower than the NIfTI one (augmentation_utils.CONTRAST_ALPHA) as in the original script
+DICOM_CONTRAST_ALPHA = 0.15
+
+# Header elements copied unchanged from each source instance into its augmented instances
+DICOM_COPIED_ELEMENTS = ['SpecificCharacterSet', 'PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex', 'StudyInstanceUID', 'StudyDate',
+                         'StudyTime', 'StudyID', 'AccessionNumber', 'Modality', 'FrameOfReferenceUID', 'ImageOrientationPatient',
+                         'SliceThickness', 'KVP', 'SeriesNumber']
+
+# Function to list the .dcm files under a folder, including its subfolders, in a stable order
+def find_dicom_files(dicom_dir):
+    file_paths = []
+    for root, _, files in os.walk(dicom_dir):
+        file_paths.extend(os.path.join(root, name) for name in files if name.lower().endswith('.dcm'))
+    return sorted(file_paths)
+
+# Function to read the header of one DICOM file, stopping before the pixel data
+# Unreadable files are reported and give None, so one corrupt file does not stop the scan of a folder
+def read_dicom_header(file_path):
+    try:
+        return pydicom.dcmread(file_path, stop_before_pixels=True)
+    except (pydicom.errors.InvalidDicomError, OSError, ValueError) as e:
+        print(f"Skipping unreadable DICOM file {file_path}: {e}")
+        return None
+
+# Function to read the headers of DICOM files in parallel, leaving out the files that cannot be read
+def read_dicom_headers(file_paths, num_workers=8):
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        return [header for header in executor.map(read_dicom_header, file_paths) if header is not None]
+
+# Function to group DICOM headers by series, returning {SeriesInstanceUID: [file paths]}
+# Headers without a SeriesInstanceUID (such as those of truncated files) are reported and left out
+def group_dicom_series(headers):
+    series = {}
+    for header in headers:
+        if 'SeriesInstanceUID' not in header:
+            print(f"Skipping DICOM file {header.filename} without a SeriesInstanceUID")
+            continue
+        series.setdefault(str(header.SeriesInstanceUID), []).append(header.filename)
+    return series
+
+# Function to read and decode one DICOM instance, returning its header (without pixel data) and its stored pixel values
+def read_dicom_instance(file_path):
+    dicom = pydicom.dcmread(file_path)
+    pixels = dicom.pixel_array
+    del dicom.PixelData
+    return dicom, pixels
+
+# Function to read all instances of one DICOM series in parallel and assemble them into an (H, W, Z) volume
+# Slices are sorted by position and kept as stored pixel values (RescaleSlope/Intercept stay in the headers),
+# so augmented instances can be written back with the same pixel representation. Returns (volume, sorted headers)
+def read_dicom_series(file_paths, num_workers=8):
+    if not file_paths:
+        raise ValueError("No DICOM files given for the series.")
+    with stage('load'), ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+        instances = list(executor.map(read_dicom_instance, file_paths))
+
+    # Validate that every instance belongs to the same series and has the same slice size and pixel type
+    series_uids = {str(dicom.SeriesInstanceUID) for dicom, _ in instances}
+    if len(series_uids) != 1:
+        raise ValueError(f"DICOM files belong to {len(series_uids)} series, expected one.")
+    shapes = {(pixels.shape, pixels.dtype) for _, pixels in instances}
+    if len(shapes) != 1:
+        raise ValueError(f"DICOM instances of series {series_uids.pop()} differ in slice size or pixel type: {shapes}")
+    (shape, dtype), = shapes
+    if len(shape) != 2:
+        raise ValueError(f"Only single-frame grayscale DICOM instances are supported, got pixel shape {shape}.")
+
+    # Copy the sorted slices into a slice-major volume, releasing each decoded slice as it is copied
+    instances.sort(key=lambda instance: slice_position(instance[0]))
+    volume = empty_volume(shape + (len(instances),), dtype)
+    headers = []
+    for z in range(len(instances)):
+        dicom, pixels = instances[z]
+        volume[:, :, z] = pixels
+        instances[z] = None
+        headers.append(dicom)
+    return volume, headers
+
+# Function to build the header elements shared by every instance of one augmented series
+# Each augmentation becomes a derived series with its own SeriesInstanceUID, and the pixel spacing follows the
+# resize to 512x512 pixels (and for the zoom, the crop of the central 412x412 region)
+def derived_series_header(source, pixels_dtype, suffix):
+    header = pydicom.dataset.Dataset()
+    for keyword in DICOM_COPIED_ELEMENTS:
+        if keyword in source:
+            setattr(header, keyword, source.data_element(keyword).value)
+    header.SOPClassUID = source.SOPClassUID
+    header.SeriesInstanceUID = pydicom.uid.generate_uid()
+    header.SeriesDescription = f"{source.get('SeriesDescription', '')} {suffix}".strip()
+    header.ImageType = ['DERIVED', 'SECONDARY']
+    now = datetime.datetime.now()
+    header.InstanceCreationDate = now.strftime('%Y%m%d')
+    header.InstanceCreationTime = now.strftime('%H%M%S')
+    header.Rows, header.Columns = 512, 512
+    header.SamplesPerPixel = 1
+    header.PhotometricInterpretation = 'MONOCHROME2'
+    bits = np.dtype(pixels_dtype).itemsize * 8
+    header.BitsAllocated = bits
+    header.BitsStored = bits if bits == 8 else source.BitsStored
+    header.HighBit = header.BitsStored - 1
+    header.PixelRepresentation = 1 if np.dtype(pixels_dtype).kind == 'i' else 0
+    if 'PixelSpacing' in source:
+        zoom = 412 / 512 if suffix == 'zoomed' else 1
+        header.PixelSpacing = [float(source.PixelSpacing[0]) * source.Rows / 512 * zoom,
+                               float(source.PixelSpacing[1]) * source.Columns / 512 * zoom]
+    return header
+
+# Function to encode the elements of a dataset as explicit VR little endian bytes, as a list of (tag, bytes)
+# The header shared by every instance of a derived series is encoded once, instead of once per file
+def encode_data_elements(dataset, character_set=None):
+    character_set = dataset.get('SpecificCharacterSet', character_set)
+    encoded = []
+    for element in dataset:
+        fp = pydicom.filebase.DicomBytesIO()
+        fp.is_little_endian, fp.is_implicit_VR = True, False
+        pydicom.filewriter.write_data_element(fp, element, character_set)
+        encoded.append((element.tag, fp.getvalue()))
+    return encoded
+
+# Function to write one augmented slice as a DICOM instance, merging the pre-encoded shared header of its series
+# with the elements of this instance (position, instance number, rescale) in tag order
+def write_derived_instance(shared_elements, source, pixels, suffix, file_path):
+    instance = pydicom.dataset.Dataset()
+    instance.SOPInstanceUID = pydicom.uid.generate_uid()
+    if 'InstanceNumber' in source:
+        instance.InstanceNumber = source.InstanceNumber
+    if 'SliceLocation' in source:
+        instance.SliceLocation = source.SliceLocation
+    if 'ImagePositionPatient' in source:
+        position = np.array(source.ImagePositionPatient, dtype=np.float64)
+        if suffix == 'zoomed' and 'ImageOrientationPatient' in source and 'PixelSpacing' in source:
+            # The first zoomed pixel centre lies this many normalized pixels into the crop of the normalized slice
+            offset = 50 + 0.5 * 412 / 512 - 0.5
+            orientation = np.array(source.ImageOrientationPatient, dtype=np.float64)
+            position += offset * (orientation[:3] * float(source.PixelSpacing[1]) * source.Columns / 512 +
+                                  orientation[3:] * float(source.PixelSpacing[0]) * source.Rows / 512)
+        instance.ImagePositionPatient = [float(value) for value in position]
+    # Contrast-adjusted and windowed pixels are display values, so only the other series keep the source rescale
+    if suffix != 'contrast' and not suffix.startswith('window-'):
+        for keyword in ('RescaleIntercept', 'RescaleSlope', 'RescaleType', 'WindowCenter', 'WindowWidth'):
+            if keyword in source:
+                setattr(instance, keyword, source.data_element(keyword).value)
+
+    # File meta information, which names this instance and the transfer syntax
+    file_meta = pydicom.dataset.FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = source.SOPClassUID
+    file_meta.MediaStorageSOPInstanceUID = instance.SOPInstanceUID
+    file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    meta = pydicom.filebase.DicomBytesIO()
+    pydicom.filewriter.write_file_meta_info(meta, file_meta)
+
+    # Pixel data goes last, written straight from the slice instead of through a bytes copy
+    pixels = np.ascontiguousarray(pixels, dtype=pixels.dtype.newbyteorder('<'))
+    elements = sorted(shared_elements + encode_data_elements(instance, source.get('SpecificCharacterSet')))
+    with open(file_path, 'wb') as f:
+        f.write(b"\0" * 128 + b"DICM")
+        f.write(meta.getvalue())
+        for _, encoded in elements:
+            f.write(encoded)
+        f.write(struct.pack('<HH2sHI', 0x7FE0, 0x0010, b'OB' if pixels.itemsize == 1 else b'OW', 0, pixels.nbytes))
+        f.write(memoryview(pixels).cast('B'))
+        if pixels.nbytes % 2:
+            f.write(b"\0")
+
+# Function to write the augmented volumes of a series as six derived DICOM series, with a pool of writer threads
+# Files are named <source file name>_<suffix>.dcm in output_dir; volumes given as None are skipped. window_aug optionally
+# maps intensity window names to windowed volumes, written as series with the suffix window-<name>
+def save_augmented_dicom_series(volume_aug, headers, output_dir, write_workers=4, window_aug=None):
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = []
+    outputs = list(zip(volume_aug, DICOM_AUGMENTATION_SUFFIXES))
+    outputs += [(volume, f'window-{name}') for name, volume in (window_aug or {}).items()]
+    for volume, suffix in outputs:
+        if volume is None:
+            continue
+        if volume.shape[2] != len(headers):
+            raise ValueError(f"Augmented {suffix} volume has {volume.shape[2]} slices for {len(headers)} DICOM instances.")
+        shared_elements = encode_data_elements(derived_series_header(headers[0], volume.dtype, suffix))
+        for z, source in enumerate(headers):
+            file_name = os.path.splitext(os.path.basename(source.filename))[0]
+            jobs.append((shared_elements, source, volume[:, :, z], suffix, os.path.join(output_dir, f"{file_name}_{suffix}.dcm")))
+    with stage('save'), ThreadPoolExecutor(max_workers=max(1, write_workers)) as executor:
+        list(executor.map(lambda job: write_derived_instance(*job), jobs))
+    count('files_written', len(jobs))
+    return [job[-1] for job in jobs]
+
+# Function to give the (RescaleSlope, RescaleIntercept) that turn the stored pixel values of a series into HU
+def series_rescale(headers):
+    rescales = {(float(header.get('RescaleSlope', 1)), float(header.get('RescaleIntercept', 0))) for header in headers}
+    if len(rescales) != 1:
+        raise ValueError(f"Instances of the series have {len(rescales)} different rescales; windows need one.")
+    return rescales.pop()
+
+# Function to read one DICOM series, augment it as a whole volume with the batched engine (without a label)
+# and write the six augmented series. augment_options['windows'] optionally lists intensity windows (see
+# intensity_transforms.parse_window) of the normalized volume to write as further series; the series rescale is
+# folded into their lookup tables, so the stored pixel values are windowed in HU directly.
+# augment_options['contrast_alpha'] defaults to DICOM_CONTRAST_ALPHA
+def process_dicom_series(file_paths, output_dir, read_workers=8, write_workers=4, augment_options=None):
+    augment_options = dict(augment_options or {})
+    augment_options.setdefault('contrast_alpha', DICOM_CONTRAST_ALPHA)
+    windows = [parse_window(window) for window in augment_options.pop('windows', None) or []]
+    volume, headers = read_dicom_series(file_paths, num_workers=read_workers)
+    with stage('augment'):
+        volume_aug, _ = process_volume_and_label_batched(volume, None, **augment_options)
+    del volume
+    window_aug = None
+    if windows and volume_aug[0] is not None:
+        with stage('augment.windows'):
+            slope, intercept = series_rescale(headers)
+            window_aug = {window['name']: window_volume
+                          for window, window_volume in zip(windows, apply_windows(volume_aug[0], windows, slope, intercept))}
+    return save_augmented_dicom_series(volume_aug, headers, output_dir, write_workers=write_workers, window_aug=window_aug)
+
+# Function to augment every DICOM series found under a folder, writing each into its own output subfolder
+# With index_path set, the series are selected from a persistent header index (see dicom_index.py) that is brought
+# up to date first, instead of reading every header; series_uids optionally limits the run to those series.
+# Returns {SeriesInstanceUID: error message} for the series that failed
+def process_dicom_folder(dicom_dir, output_dir, read_workers=8, write_workers=4, augment_options=None, index_path=None,
+                         series_uids=None):
+    if index_path:
+        with DicomIndex(index_path) as index:
+            index.update(dicom_dir, num_workers=read_workers)
+            series = {entry['series_uid']: index.series_files(entry['series_uid'], dicom_dir) for entry in index.series(dicom_dir)}
+    else:
+        series = group_dicom_series(read_dicom_headers(find_dicom_files(dicom_dir), num_workers=read_workers))
+    if series_uids:
+        series = {series_uid: file_paths for series_uid, file_paths in series.items() if series_uid in series_uids}
+    failures = {}
+    for series_uid, file_paths in series.items():
+        try:
+            process_dicom_series(file_paths, os.path.join(output_dir, series_uid), read_workers=read_workers,
+                                 write_workers=write_workers, augment_options=augment_options)
+            print(f"Processed series {series_uid} ({len(file_paths)} instances)")
+        except Exception as e:
+            print(f"Error processing series {series_uid}: {e}")
+            failures[series_uid] = str(e)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Augment every DICOM series in a folder and write the results as DICOM series.")
+    parser.add_argument('--dicom-dir', default=dicom_folder_path, help="Folder searched recursively for .dcm files")
+    parser.add_argument('--output-dir', default=output_folder_path, help="Folder for the augmented series, one subfolder per series")
+    parser.add_argument('--read-workers', type=int, default=8, help="Threads reading and decoding instances (default: 8)")
+    parser.add_argument('--write-workers', type=int, default=4, help="Threads writing augmented instances (default: 4)")
+    parser.add_argument('--fused-geometry', action='store_true',
+                        help="Resample rotated and zoomed outputs once from the input instead of from the normalized slices")
+    parser.add_argument('--windows', nargs='+', default=None, metavar='WINDOW',
+                        help="Also write the normalized series through these intensity windows as 8-bit series: presets "
+                             f"({', '.join(WINDOW_PRESETS)}) or center,width[,gamma] in HU")
+    parser.add_argument('--index', default=None,
+                        help="SQLite header index of the DICOM tree, updated incrementally and used to select the series")
+    parser.add_argument('--series', action='append', default=None, help="Only augment this SeriesInstanceUID (repeatable)")
+    args = parser.parse_args()
+
+    failures = process_dicom_folder(args.dicom_dir, args.output_dir, read_workers=args.read_workers,
+                                    write_workers=args.write_workers,
+                                    augment_options={'fused': args.fused_geometry, 'windows': args.windows},
+                                    index_path=args.index, series_uids=args.series)
+    print(f"Processing completed with {len(failures)} failed series.")
+
+if __name__ == '__main__':
+    main()
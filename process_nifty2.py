@@ -1,108 +1,207 @@
-import nibabel as nib
+import threading
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.widgets import Button
-import cv2
-from augmentation_utils import *
+from file_handler2 import load_nifti_file
 from augmentation_pipeline import process_image_and_label
+from label_processing import label_lookup_table, remap_label
+from lazy_imports import lazy_import
+
+plt = lazy_import('matplotlib.pyplot')
+widgets = lazy_import('matplotlib.widgets')
 
 # Load the CT volume and label data using nibabel
 volume_path = '/Users/omkarbhope/Library/Mobile Documents/com~apple~CloudDocs/Research/PKG - CT-ORG/CT-ORG/volume-0.nii.gz'  # Replace with the actual path to your volume file
 label_path = '/Users/omkarbhope/Library/Mobile Documents/com~apple~CloudDocs/Research/PKG - CT-ORG/CT-ORG/labels-0.nii.gz'  # Replace with the actual path to your label file
 
-try:
-    volume = nib.load(volume_path)
-    labels = nib.load(label_path)
-except FileNotFoundError:
-    raise FileNotFoundError("Volume or label file not found. Please provide the correct file paths.")
-except nib.filebasedimages.ImageFileError:
-    raise ValueError("The provided file is not a valid NIFTI file. Please check the file format.")
-
-volume_data = volume.get_fdata()
-label_data = labels.get_fdata().astype(np.int32)  # Convert label data to int
-
-# Validate data dimensions
-if volume_data.shape != label_data.shape:
-    raise ValueError("Volume data and label data must have the same shape.")
-
-# Validate that volume and label data are not empty
-if volume_data.size == 0 or label_data.size == 0:
-    raise ValueError("Volume data or label data is empty. Please provide valid data.")
-
-# Modify label data to retain values of 1 and put 0 everywhere else
-label_data_modified = np.where(label_data == 3, 1, 0)
-
-# Initial slice index
-current_slice = label_data.shape[2] // 2
-
-# Create a function to plot the slice and augmentations
-def plot_slice(slice_index):
-    plt.suptitle('CT Scan Viewer', fontsize=16)
-    for ax in axs:
-        ax.clear()
-    
-    # Display the CT volume slice and corresponding label slice
-    ct_slice = volume_data[:, :, slice_index]
-    label_slice = label_data_modified[:, :, slice_index]
-    
-    # Validate that the slice is not empty
-    if np.sum(ct_slice) == 0:
-        print(f"Warning: Slice {slice_index} is empty.")
-    
+# Titles of the six augmentations, in the order process_image_and_label returns them
+AUGMENTATION_TITLES = ["Original Grayscale", "Rotated", "Flipped", "Zoomed", "Contrast Adjusted", "Denoised"]
+
+# Slices moved by the Page Up and Page Down keys
+PAGE_SLICES = 10
+
+# Function to load a volume and its label for viewing, keeping only the given label classes
+# The volume keeps its native dtype (float32 if the file applies scaling) and the label becomes uint8
+def load_volume_and_label(volume_path, label_path, label_values=(3,)):
     try:
-        augmentations, label_augmentations = process_image_and_label(ct_slice, label_slice)
+        volume_data, _, _ = load_nifti_file(volume_path, dtype='native')
+        label_data, _, _ = load_nifti_file(label_path, dtype='native')
     except Exception as e:
-        raise RuntimeError(f"Error during augmentation processing: {e}")
-    
-    # Validate that augmentations match expected output
-    if len(augmentations) != len(label_augmentations):
-        raise ValueError("Mismatch between augmentations and label augmentations.")
-    
-    titles = ["Original Grayscale", "Rotated", "Flipped", "Zoomed", "Contrast Adjusted", "Denoised"]
-    
-    for i, (aug_image, aug_label, title) in enumerate(zip(augmentations, label_augmentations, titles)):
-        axs[i].imshow(aug_image, cmap='gray')
-        axs[i].set_title(f'{title} - Image')
-        axs[i].axis('off')
-        # Plot corresponding label in the next available axis
-        axs[i + 6].imshow(aug_label, cmap='viridis')
-        axs[i + 6].set_title(f'{title} - Label')
-        axs[i + 6].axis('off')
-
-    plt.pause(0.01)
-    plt.draw()
-
-# Create the figure and initial plot
-fig, axs = plt.subplots(2, 6, figsize=(24, 10))
-axs = axs.ravel()[:12]  # Use only 12 axes to plot augmentations and labels
-plt.subplots_adjust(bottom=0.2)
-plot_slice(current_slice)
-
-# Add buttons for navigating slices
-ax_prev = plt.axes([0.4, 0.01, 0.1, 0.05])
-ax_next = plt.axes([0.51, 0.01, 0.1, 0.05])
-
-prev_button = Button(ax_prev, 'Previous')
-next_button = Button(ax_next, 'Next')
-
-# Update functions for buttons
-def prev_slice(event):
-    global current_slice
-    if current_slice > 0:
-        current_slice -= 1
-        plot_slice(current_slice)
-    else:
-        print("Already at the first slice.")
-
-def next_slice(event):
-    global current_slice
-    if current_slice < label_data.shape[2] - 1:
-        current_slice += 1
-        plot_slice(current_slice)
-    else:
-        print("Already at the last slice.")
-
-prev_button.on_clicked(prev_slice)
-next_button.on_clicked(next_slice)
-
-plt.show()
\ No newline at end of file
+        raise ValueError(f"Could not load {volume_path} and {label_path}: {e}")
+
+    # Validate data dimensions
+    if volume_data.shape != label_data.shape:
+        raise ValueError("Volume data and label data must have the same shape.")
+
+    # Validate that volume and label data are not empty
+    if volume_data.size == 0 or label_data.size == 0:
+        raise ValueError("Volume data or label data is empty. Please provide valid data.")
+
+    # Modify label data to retain the chosen classes as 1 and put 0 everywhere else
+    return volume_data, remap_label(label_data, label_lookup_table(list(label_values)))
+
+# Class to compute the augmentations of single slices on a background thread, keeping the most recently used ones
+# get() waits for a slice (computing it now if needed); prefetch() queues slices that are likely to be viewed next.
+# Each slice is computed once, whether it was asked for or prefetched
+class AugmentedSliceCache:
+    def __init__(self, volume_data, label_data, cache_size=32, fused=False):
+        self.volume_data = volume_data
+        self.label_data = label_data
+        self.cache_size = cache_size
+        self.fused = fused
+        self.slices = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    # Function to augment one slice, returning the six images and six labels
+    def augment(self, slice_index):
+        augmentations, label_augmentations = process_image_and_label(self.volume_data[:, :, slice_index],
+                                                                     self.label_data[:, :, slice_index], fused=self.fused)
+        # Validate that augmentations match expected output
+        if len(augmentations) != len(label_augmentations):
+            raise ValueError("Mismatch between augmentations and label augmentations.")
+        return augmentations, label_augmentations
+
+    # Function to give the future of a slice, submitting it if it is neither cached nor queued
+    # The least recently used slices beyond cache_size are dropped
+    def future(self, slice_index):
+        with self.lock:
+            future = self.slices.get(slice_index)
+            if future is None:
+                future = self.slices[slice_index] = self.executor.submit(self.augment, slice_index)
+                while len(self.slices) > self.cache_size:
+                    _, evicted = self.slices.popitem(last=False)
+                    evicted.cancel()
+            else:
+                self.slices.move_to_end(slice_index)
+            return future
+
+    def get(self, slice_index):
+        return self.future(slice_index).result()
+
+    # Function to queue the slices around slice_index, nearest first and ahead of the scrolling direction first
+    def prefetch(self, slice_index, direction=1, count=4):
+        depth = self.volume_data.shape[2]
+        for step in range(1, count + 1):
+            for neighbour in (slice_index + direction * step, slice_index - direction * step):
+                if 0 <= neighbour < depth:
+                    self.future(neighbour)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# Class for the interactive viewer showing the six augmentations of a slice and their labels
+# The twelve images are created once and updated in place with set_data, and slices come from an AugmentedSliceCache.
+# The static parts of the figure (axes titles, buttons) are drawn once and kept as a background, so moving to a
+# prefetched slice only redraws the images and the slice number over it. Navigate with the buttons, the arrow keys,
+# Page Up/Down, Home/End or the scroll wheel
+class SliceViewer:
+    def __init__(self, volume_data, label_data, cache_size=32, prefetch=4, fused=False):
+        self.depth = volume_data.shape[2]
+        self.cache = AugmentedSliceCache(volume_data, label_data, cache_size, fused)
+        self.prefetch_count = prefetch
+        self.current_slice = self.depth // 2
+        self.direction = 1
+        label_max = max(int(label_data.max()), 1)
+
+        # Create the figure and the image artists once
+        self.fig, axs = plt.subplots(2, 6, figsize=(24, 10))
+        axs = axs.ravel()[:12]  # Use only 12 axes to plot augmentations and labels
+        plt.subplots_adjust(bottom=0.2)
+        self.title = self.fig.suptitle('CT Scan Viewer', fontsize=16, animated=True)
+        self.background = None
+        augmentations, label_augmentations = self.cache.get(self.current_slice)
+        self.images, self.labels = [], []
+        for i, (aug_image, aug_label, title) in enumerate(zip(augmentations, label_augmentations, AUGMENTATION_TITLES)):
+            self.images.append(axs[i].imshow(aug_image, cmap='gray', animated=True))
+            axs[i].set_title(f'{title} - Image')
+            axs[i].axis('off')
+            # Plot corresponding label in the next available axis, on a fixed color scale
+            # Nearest-neighbour sampling of the label values keeps classes distinct and is several times faster to draw
+            self.labels.append(axs[i + 6].imshow(aug_label, cmap='viridis', vmin=0, vmax=label_max, interpolation='nearest',
+                                                 interpolation_stage='data', animated=True))
+            axs[i + 6].set_title(f'{title} - Label')
+            axs[i + 6].axis('off')
+
+        # Add buttons for navigating slices
+        self.prev_button = widgets.Button(self.fig.add_axes([0.4, 0.01, 0.1, 0.05]), 'Previous')
+        self.next_button = widgets.Button(self.fig.add_axes([0.51, 0.01, 0.1, 0.05]), 'Next')
+        self.prev_button.on_clicked(lambda event: self.move(-1))
+        self.next_button.on_clicked(lambda event: self.move(1))
+        self.fig.canvas.mpl_connect('key_press_event', self.on_key)
+        self.fig.canvas.mpl_connect('scroll_event', self.on_scroll)
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+        self.show_slice(self.current_slice)
+
+    # Function to keep the freshly drawn static figure as the background and draw the slice over it
+    # Runs after every full draw, e.g. when the window is resized
+    def on_draw(self, event):
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_slice()
+
+    # Function to draw the images and slice number over the background
+    def draw_slice(self):
+        for artist in self.images + self.labels + [self.title]:
+            self.fig.draw_artist(artist)
+        self.fig.canvas.blit(self.fig.bbox)
+
+    # Function to display a slice by updating the existing images, then prefetch its neighbours
+    def show_slice(self, slice_index):
+        augmentations, label_augmentations = self.cache.get(slice_index)
+        for image, aug_image in zip(self.images, augmentations):
+            image.set_data(aug_image)
+            # Scale each image to its own range, as imshow does for a new image
+            image.set_clim(aug_image.min(), aug_image.max())
+        for image, aug_label in zip(self.labels, label_augmentations):
+            image.set_data(aug_label)
+        self.title.set_text(f'CT Scan Viewer - slice {slice_index + 1} of {self.depth}')
+        if self.background is None:
+            self.fig.canvas.draw_idle()
+        else:
+            self.fig.canvas.restore_region(self.background)
+            self.draw_slice()
+        self.cache.prefetch(slice_index, self.direction, self.prefetch_count)
+
+    # Function to move by a number of slices, stopping at the first and last slice
+    def move(self, steps):
+        target = min(max(self.current_slice + steps, 0), self.depth - 1)
+        if target == self.current_slice:
+            print("Already at the first slice." if steps < 0 else "Already at the last slice.")
+            return
+        self.direction = 1 if steps > 0 else -1
+        self.current_slice = target
+        self.show_slice(target)
+
+    def on_key(self, event):
+        steps = {'right': 1, 'up': 1, 'left': -1, 'down': -1, 'pageup': PAGE_SLICES, 'pagedown': -PAGE_SLICES,
+                 'home': -self.depth, 'end': self.depth}.get(event.key)
+        if steps:
+            self.move(steps)
+
+    def on_scroll(self, event):
+        self.move(int(event.step) or (1 if event.button == 'up' else -1))
+
+    def show(self):
+        try:
+            plt.show()
+        finally:
+            self.cache.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="View the augmentations of the slices of a CT volume and its label.")
+    parser.add_argument('--volume', default=volume_path, help="NIfTI volume file")
+    parser.add_argument('--label', default=label_path, help="NIfTI label file")
+    parser.add_argument('--label-values', type=int, nargs='+', default=[3], help="Label classes to show (default: 3)")
+    parser.add_argument('--cache-size', type=int, default=32, help="Augmented slices kept in memory (default: 32)")
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help="Slices augmented ahead on each side of the current slice (default: 4)")
+    parser.add_argument('--fused-geometry', action='store_true',
+                        help="Resample rotated and zoomed slices once from the input instead of from the normalized slice")
+    args = parser.parse_args()
+
+    volume_data, label_data = load_volume_and_label(args.volume, args.label, args.label_values)
+    SliceViewer(volume_data, label_data, cache_size=args.cache_size, prefetch=args.prefetch, fused=args.fused_geometry).show()
+
+if __name__ == '__main__':
+    main()
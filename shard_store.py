@@ -0,0 +1,272 @@
+import os
+import json
+import zlib
+import bisect
+import struct
+import functools
+import numpy as np
+from instrumentation import stage, count
+from file_handler2 import LABEL_SOURCES
+
+# Last 16 bytes of every shard: this magic followed by the little-endian offset of the JSON index
+SHARD_MAGIC = b'CTSHARD1'
+SHARD_FOOTER = struct.Struct('<8sQ')
+
+# File extension of shards, one per source volume
+SHARD_EXTENSION = '.shard'
+
+# Names of the six augmentations, in the order process_volume_and_label_batched returns them
+SHARD_AUGMENTATION_NAMES = ['normalized', 'rotated', 'flipped', 'zoomed', 'contrast', 'denoised']
+
+# Byte alignment of the uncompressed image and label arrays, so memory-mapped views start on a cache line
+SHARD_ALIGNMENT = 64
+
+# Function to give the path of the shard of a source volume
+def shard_path(output_dir, prefix):
+    return os.path.join(output_dir, prefix + SHARD_EXTENSION)
+
+# Class to pack augmented images and labels of (H, W, Z) volumes into one chunked shard file
+# Slices are stored slice-major in chunks of chunk_slices. Without compression, each volume's chunks are contiguous, so a
+# reader maps them as one (Z, H, W) array without copying. With compression='zlib', each chunk is compressed on its own,
+# so a reader only decompresses the chunk holding the slice it wants. A volume may share the label of an earlier entry
+# instead of storing its own. The index is written at close, and the shard only appears under its name once complete
+class ShardWriter:
+    def __init__(self, file_path, chunk_slices=16, compression=None, compresslevel=1):
+        if compression not in (None, 'zlib'):
+            raise ValueError(f"Unsupported shard compression {compression!r}; use None or 'zlib'.")
+        if chunk_slices < 1:
+            raise ValueError("chunk_slices must be at least 1.")
+        self.file_path = file_path
+        self.chunk_slices = chunk_slices
+        self.compression = compression
+        self.compresslevel = compresslevel
+        self.file = open(file_path + '.tmp', 'wb')
+        self.end = 0
+        self.entries = []
+        self.written = []
+        self.pending = []
+
+    # Function to add a volume of the given number of slices to the shard, returning its entry number for write_slices
+    # label_dtype may be None for volumes without a label. With label_source, the volume's label is the label of that
+    # earlier entry, which is stored only once; labels given to write_slices for it are then ignored
+    def add_volume(self, prefix, augmentation, slices, slice_shape, image_dtype, label_dtype=None, label_source=None):
+        entry = {'prefix': prefix, 'augmentation': augmentation, 'slices': int(slices), 'slice_shape': [int(n) for n in slice_shape]}
+        for kind, dtype in (('image', image_dtype), ('label', label_dtype)):
+            if dtype is None:
+                entry[kind] = None
+                continue
+            if kind == 'label' and label_source is not None:
+                source = self.entries[label_source]
+                if source['label'] is None or source['slices'] != entry['slices'] or source['slice_shape'] != entry['slice_shape']:
+                    raise ValueError(f"{prefix} {augmentation} cannot share the label of {source['prefix']} {source['augmentation']}.")
+                entry[kind] = {'dtype': source['label']['dtype'], 'shared_with': label_source}
+                continue
+            entry[kind] = {'dtype': np.dtype(dtype).str, 'chunks': []}
+            if self.compression is None:
+                # Reserve the whole array, so the slabs of several volumes can arrive interleaved and still be contiguous
+                offset = -(-self.end // SHARD_ALIGNMENT) * SHARD_ALIGNMENT
+                entry[kind]['offset'] = offset
+                self.end = offset + int(slices) * int(np.prod(slice_shape)) * np.dtype(dtype).itemsize
+        self.entries.append(entry)
+        self.written.append(0)
+        self.pending.append({'image': [], 'label': []})
+        return len(self.entries) - 1
+
+    # Function to append the next slices of a volume, given as (H, W, n) images and labels in slice order
+    def write_slices(self, entry_index, images, labels=None):
+        entry = self.entries[entry_index]
+        start = self.written[entry_index]
+        if start + images.shape[2] > entry['slices']:
+            raise ValueError(f"Too many slices for {entry['prefix']} {entry['augmentation']}: {start + images.shape[2]} > {entry['slices']}.")
+        for kind, data in (('image', images), ('label', labels)):
+            if entry[kind] is None or 'shared_with' in entry[kind]:
+                continue
+            # (H, W, n) slice-major volumes transpose to C-contiguous (n, H, W) arrays without a copy
+            data = np.ascontiguousarray(data.transpose(2, 0, 1), dtype=np.dtype(entry[kind]['dtype']))
+            if self.compression is None:
+                self.file.seek(entry[kind]['offset'] + start * data[0].nbytes)
+                self.file.write(memoryview(data).cast('B'))
+            else:
+                self.pending[entry_index][kind].append(data)
+                self.flush_chunks(entry_index, kind, final=False)
+        self.written[entry_index] = start + images.shape[2]
+
+    # Function to compress and append the complete chunks buffered for one volume (and the partial last one when final)
+    def flush_chunks(self, entry_index, kind, final):
+        pending = self.pending[entry_index][kind]
+        buffered = sum(len(data) for data in pending)
+        if buffered < self.chunk_slices and not (final and buffered):
+            return
+        slices = np.concatenate(pending) if len(pending) > 1 else pending[0]
+        complete = len(slices) if final else len(slices) // self.chunk_slices * self.chunk_slices
+        for chunk_start in range(0, complete, self.chunk_slices):
+            compressed = zlib.compress(memoryview(np.ascontiguousarray(slices[chunk_start:chunk_start + self.chunk_slices])).cast('B'),
+                                       self.compresslevel)
+            self.file.seek(self.end)
+            self.file.write(compressed)
+            self.entries[entry_index][kind]['chunks'].append([self.end, len(compressed)])
+            self.end += len(compressed)
+        self.pending[entry_index][kind] = [slices[complete:]] if complete < len(slices) else []
+
+    # Function to write a whole augmented volume (and label) as one entry
+    def write_volume(self, prefix, augmentation, image_volume, label_volume=None, label_source=None):
+        entry_index = self.add_volume(prefix, augmentation, image_volume.shape[2], image_volume.shape[:2], image_volume.dtype,
+                                      None if label_volume is None else label_volume.dtype, label_source)
+        self.write_slices(entry_index, image_volume, label_volume)
+        return entry_index
+
+    # Function to finish the shard: flush the last chunks, append the index and footer, and move the file into place
+    def close(self):
+        if self.file.closed:
+            return
+        try:
+            for entry_index, entry in enumerate(self.entries):
+                if self.written[entry_index] != entry['slices']:
+                    raise ValueError(f"Only {self.written[entry_index]} of {entry['slices']} slices were written for "
+                                     f"{entry['prefix']} {entry['augmentation']}.")
+                if self.compression is not None:
+                    for kind in ('image', 'label'):
+                        if entry[kind] is not None and 'shared_with' not in entry[kind]:
+                            self.flush_chunks(entry_index, kind, final=True)
+            index = json.dumps({'version': 2, 'chunk_slices': self.chunk_slices, 'compression': self.compression,
+                                'entries': self.entries}).encode()
+            self.file.seek(self.end)
+            self.file.write(index)
+            self.file.write(SHARD_FOOTER.pack(SHARD_MAGIC, self.end))
+            self.file.close()
+        except BaseException:
+            self.file.close()
+            os.remove(self.file_path + '.tmp')
+            raise
+        os.replace(self.file_path + '.tmp', self.file_path)
+        count('bytes_written', os.path.getsize(self.file_path))
+        count('files_written')
+
+    # Function to discard an unfinished shard
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.file_path + '.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+# Function to give the entry whose label augmentation i shares (see file_handler2.LABEL_SOURCES), given the entry
+# numbers of the augmentations already in the shard, or None when augmentation i stores its own label
+def shared_label_entry(i, entries):
+    return entries.get(LABEL_SOURCES[i]) if LABEL_SOURCES[i] != i else None
+
+# Function to write the augmented volumes and labels of one source volume as a shard, named <prefix>.shard
+# Outputs given as None (augmentations that were not computed) are skipped, and labels shared between augmentations
+# are stored once. window_aug optionally maps intensity window names to windowed normalized volumes, stored as
+# 'window_<name>' entries sharing the normalized label
+def save_augmented_shard(volume_aug, label_aug, output_dir, prefix, chunk_slices=16, compression=None, compresslevel=1,
+                         window_aug=None):
+    os.makedirs(output_dir, exist_ok=True)
+    with stage('save'), ShardWriter(shard_path(output_dir, prefix), chunk_slices, compression, compresslevel) as writer:
+        entries = {}
+        for i, (image_volume, label_volume) in enumerate(zip(volume_aug, label_aug)):
+            if image_volume is not None:
+                entries[i] = writer.write_volume(prefix, SHARD_AUGMENTATION_NAMES[i], image_volume, label_volume,
+                                                 shared_label_entry(i, entries) if label_volume is not None else None)
+        write_window_volumes(writer, prefix, window_aug or {}, label_aug[0], entries)
+    return shard_path(output_dir, prefix)
+
+# Function to add the intensity windows of the normalized volume to a shard as 'window_<name>' entries
+# Their label is the normalized label, shared with the normalized entry when it is in the shard (entries maps
+# augmentation indices to entry numbers); windows given as None are skipped
+def write_window_volumes(writer, prefix, window_aug, normalized_label, entries):
+    for name, window_volume in window_aug.items():
+        if window_volume is not None:
+            writer.write_volume(prefix, f'window_{name}', window_volume, normalized_label,
+                                entries.get(0) if normalized_label is not None else None)
+
+# Class to read slices from a shard written by ShardWriter, by global slice number or by volume
+# Uncompressed shards are memory-mapped once and every slice or volume is a read-only view into the mapping;
+# compressed shards decompress one chunk at a time and keep the most recently used chunks
+class ShardReader:
+    def __init__(self, file_path, cached_chunks=8):
+        self.file_path = file_path
+        with open(file_path, 'rb') as f:
+            f.seek(-SHARD_FOOTER.size, os.SEEK_END)
+            magic, index_offset = SHARD_FOOTER.unpack(f.read(SHARD_FOOTER.size))
+            if magic != SHARD_MAGIC:
+                raise ValueError(f"{file_path} is not a shard file.")
+            f.seek(index_offset)
+            index = json.loads(f.read(os.path.getsize(file_path) - SHARD_FOOTER.size - index_offset))
+        self.chunk_slices = index['chunk_slices']
+        self.compression = index['compression']
+        self.entries = index['entries']
+        self.starts = list(np.cumsum([0] + [entry['slices'] for entry in self.entries]))
+        self.mapping = np.memmap(file_path, dtype=np.uint8, mode='r') if self.compression is None else None
+        self.read_chunk = functools.lru_cache(maxsize=cached_chunks)(self.read_chunk)
+
+    # Function to count the slices of every volume in the shard
+    def __len__(self):
+        return int(self.starts[-1])
+
+    # Function to find the entry number and slice within that entry of a global slice number
+    def locate(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(f"Slice {index} is out of range for a shard of {len(self)} slices.")
+        entry_index = bisect.bisect_right(self.starts, index) - 1
+        return entry_index, index - int(self.starts[entry_index])
+
+    # Function to give the entry number holding the images or labels of an entry, following shared labels
+    def stored_entry(self, entry_index, kind):
+        return self.entries[entry_index][kind].get('shared_with', entry_index)
+
+    # Function to decompress one chunk of a volume's images or labels into a (n, H, W) array
+    def read_chunk(self, entry_index, kind, chunk_index):
+        entry = self.entries[entry_index]
+        offset, nbytes = entry[kind]['chunks'][chunk_index]
+        with open(self.file_path, 'rb') as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(nbytes))
+        chunk = np.frombuffer(data, dtype=np.dtype(entry[kind]['dtype'])).reshape([-1] + entry['slice_shape'])
+        return chunk
+
+    # Function to give the (Z, H, W) images or labels of one volume, as a zero-copy view when the shard is uncompressed
+    def volume(self, entry_index, kind='image'):
+        if self.entries[entry_index][kind] is None:
+            return None
+        entry_index = self.stored_entry(entry_index, kind)
+        entry = self.entries[entry_index]
+        dtype = np.dtype(entry[kind]['dtype'])
+        shape = (entry['slices'],) + tuple(entry['slice_shape'])
+        if self.mapping is not None:
+            return np.ndarray(shape, dtype=dtype, buffer=self.mapping, offset=entry[kind]['offset'])
+        return np.concatenate([self.read_chunk(entry_index, kind, i) for i in range(len(entry[kind]['chunks']))])
+
+    # Function to read one slice as (image, label, info), where info names its source volume, augmentation and slice
+    def read_slice(self, index):
+        entry_index, z = self.locate(index)
+        entry = self.entries[entry_index]
+        slices = []
+        for kind in ('image', 'label'):
+            if entry[kind] is None:
+                slices.append(None)
+            elif self.mapping is not None:
+                slices.append(self.volume(entry_index, kind)[z])
+            else:
+                slices.append(self.read_chunk(self.stored_entry(entry_index, kind), kind, z // self.chunk_slices)[z % self.chunk_slices])
+        return slices[0], slices[1], {'prefix': entry['prefix'], 'augmentation': entry['augmentation'], 'slice': z}
+
+    def __getitem__(self, index):
+        return self.read_slice(index)
+
+    def close(self):
+        self.mapping = None
+        self.read_chunk.cache_clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
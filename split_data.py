@@ -1,49 +1,176 @@
 import os
-import numpy as np
-from sklearn.model_selection import train_test_split
+import re
+import json
+import random
+import errno
 import shutil
+import argparse
+from file_handler2 import load_label_manifest
+from lazy_imports import lazy_import
 
-# Assuming 'volumes' and 'labels' are lists containing paths to the augmented volume and label files respectively
+model_selection = lazy_import('sklearn.model_selection')
+
+# Directory holding the augmented volume and label files
 data_dir = "augmented_nifti_volumes2"
 
-# Get the list of volume and label files
-volume_files = sorted([os.path.join(data_dir, f) for f in os.listdir(data_dir) if 'augmented_volume' in f and f.endswith('.nii.gz')])
-label_files = sorted([os.path.join(data_dir, f) for f in os.listdir(data_dir) if 'augmented_label' in f and f.endswith('.nii.gz')])
-
-# Ensure there is a matching label for each volume
-if len(volume_files) != len(label_files):
-    raise ValueError("The number of volume files and label files must be the same.")
-
-# Ensure there are enough samples to split
-if len(volume_files) < 2:
-    raise ValueError("Not enough samples to perform train/validation/test split. Ensure there are at least 2 samples in the dataset.")
-
-# Split the dataset into training (70%), validation (20%), and testing (10%)
-try:
-    vol_train, vol_temp, lbl_train, lbl_temp = train_test_split(volume_files, label_files, test_size=0.3, random_state=42)
-    vol_val, vol_test, lbl_val, lbl_test = train_test_split(vol_temp, lbl_temp, test_size=1/3, random_state=42)
-except Exception as e:
-    raise RuntimeError(f"Error during dataset splitting: {e}")
-
-# Save the split file paths for later use
-splits = {
-    'train': (vol_train, lbl_train),
-    'val': (vol_val, lbl_val),
-    'test': (vol_test, lbl_test)
-}
-
-# Create directories for splits and move files
-for split_name, (volumes, labels) in splits.items():
-    split_dir = f"{data_dir}/{split_name}"
-    os.makedirs(split_dir, exist_ok=True)
-    for volume_path, label_path in zip(volumes, labels):
+# Name of the manifest recording which split every file belongs to, kept in the data directory
+SPLIT_MANIFEST_NAME = 'split_manifest.json'
+
+# Names of the augmented files written by file_handler2.augmented_output_path: <prefix>_augmented_<kind>_<index>.nii[.gz],
+# where intensity windows of the normalized volume have the kind 'window' and the window name as index
+AUGMENTED_FILE_PATTERN = re.compile(r'^(?P<prefix>.+)_augmented_(?P<kind>volume|label|window)_(?P<index>.+?)\.nii(\.gz)?$')
+
+# Function to find the augmented volume and label files of every source volume with one directory scan
+# Returns {prefix: [[volume file name, label file name], ...]} with the pairs in augmentation order, followed by the
+# intensity windows by name. Augmentations sharing a label file with another augmentation, and the windows, are
+# paired with their label through <prefix>_labels.json
+def group_augmented_files(data_dir):
+    groups = {}
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            match = AUGMENTED_FILE_PATTERN.match(entry.name)
+            if match and entry.is_file():
+                files = groups.setdefault(match['prefix'], {})
+                if match['kind'] == 'window':
+                    files.setdefault(('window', match['index']), {})['volume'] = entry.name
+                elif match['index'].isdigit():
+                    files.setdefault(int(match['index']), {})[match['kind']] = entry.name
+
+    # Ensure there is a matching label for each volume
+    pairs = {}
+    for prefix, files in sorted(groups.items()):
+        shared_labels = load_label_manifest(data_dir, prefix)
+        for index, kinds in list(files.items()):
+            if 'label' not in kinds and kinds.get('volume') in shared_labels:
+                kinds['label'] = shared_labels[kinds['volume']]
+            elif isinstance(index, tuple):
+                # Windows not in the label manifest are left over from an earlier run with other windows
+                del files[index]
+        missing = [index for index, kinds in files.items() if len(kinds) != 2]
+        if missing:
+            raise ValueError(f"Augmentations {sorted(missing, key=str)} of {prefix} do not have both a volume and a label file.")
+        pairs[prefix] = [[files[index]['volume'], files[index]['label']] for index in sorted(files, key=lambda index: (
+            isinstance(index, tuple), index))]
+    return pairs
+
+# Function to assign source volumes to the training (70%), validation (20%) and testing (10%) splits
+# Whole source volumes are split, so the augmentations of one scan always land in the same split
+def split_prefixes(prefixes, seed=42):
+    # Ensure there are enough samples to split
+    if len(prefixes) < 3:
+        raise ValueError("Not enough source volumes to perform train/validation/test split. Ensure there are at least 3 in the dataset.")
+    try:
+        if len(prefixes) == 3:
+            # 30% of three volumes leaves one for validation and testing, which train_test_split cannot split further,
+            # so each split gets one volume
+            train, val, test = ([prefix] for prefix in random.Random(seed).sample(sorted(prefixes), 3))
+        else:
+            train, temp = model_selection.train_test_split(sorted(prefixes), test_size=0.3, random_state=seed)
+            val, test = model_selection.train_test_split(temp, test_size=1/3, random_state=seed)
+    except Exception as e:
+        raise RuntimeError(f"Error during dataset splitting: {e}")
+    return {'train': sorted(train), 'val': sorted(val), 'test': sorted(test)}
+
+# Function to load the split manifest of a data directory, or None when it has not been split yet
+def load_split_manifest(data_dir):
+    manifest_path = os.path.join(data_dir, SPLIT_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+# Function to write the split manifest atomically, so a crash never leaves it half written
+def save_split_manifest(data_dir, manifest):
+    manifest_path = os.path.join(data_dir, SPLIT_MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+# Function to give the (volume path, label path) pairs of one split from a manifest
+# Paths point into the split folder when the files were linked or moved there, and into the data directory otherwise
+def split_files(data_dir, manifest, split_name):
+    folder = os.path.join(data_dir, split_name) if manifest['mode'] != 'manifest' else data_dir
+    return [(os.path.join(folder, volume), os.path.join(folder, label))
+            for prefix in manifest['splits'][split_name] for volume, label in manifest['files'][prefix]]
+
+# Function to list the file names of the (volume, label) pairs of one source volume, each once (labels may be shared)
+def prefix_file_names(pairs):
+    return list(dict.fromkeys(name for pair in pairs for name in pair))
+
+# Function to place one file in its split folder without copying its contents
+# 'link' makes a hard link and falls back to a relative symlink where hard links are not possible (another filesystem)
+def place_file(source, destination, mode):
+    if mode == 'move':
+        shutil.move(source, destination)
+        return
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if mode == 'link':
         try:
-            # Move the files to their respective folders
-            shutil.move(volume_path, f"{split_dir}/{os.path.basename(volume_path)}")
-            shutil.move(label_path, f"{split_dir}/{os.path.basename(label_path)}")
-        except FileNotFoundError:
-            print(f"File not found: {volume_path} or {label_path}")
-        except Exception as e:
-            print(f"Error moving files {volume_path} and {label_path}: {e}")
-
-print("Dataset splitting and file organization completed successfully.")
\ No newline at end of file
+            os.link(source, destination)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    os.symlink(os.path.relpath(source, os.path.dirname(destination)), destination)
+
+# Function to split a directory of augmented files by source volume and record the split in a manifest
+# mode is 'link' (hard links, or symlinks across filesystems), 'symlink', 'manifest' (only the manifest, no files touched)
+# or 'move' (the original destructive layout). Re-splitting only adds and removes the links whose split changed
+def split_dataset(data_dir, mode='link', seed=42):
+    previous = load_split_manifest(data_dir)
+    if previous is not None and previous['mode'] == 'move':
+        raise ValueError(f"{data_dir} was split by moving files; move them back before splitting again.")
+    files = group_augmented_files(data_dir)
+    splits = split_prefixes(list(files), seed)
+
+    # Source volumes that stay in the same split with the same files and mode keep their links as they are
+    unchanged = set()
+    if previous is not None and previous['mode'] == mode:
+        unchanged = {prefix for split_name, prefixes in splits.items() for prefix in prefixes
+                     if prefix in previous['splits'].get(split_name, []) and previous['files'].get(prefix) == files[prefix]}
+
+    # Remove the links of a previous split for every other source volume, including volumes that no longer exist
+    if previous is not None and previous['mode'] != 'manifest':
+        for split_name, prefixes in previous['splits'].items():
+            for prefix in prefixes:
+                if prefix in unchanged:
+                    continue
+                for name in prefix_file_names(previous['files'][prefix]):
+                    path = os.path.join(data_dir, split_name, name)
+                    if os.path.lexists(path):
+                        os.remove(path)
+
+    # Link (or move) the files of every other source volume into its split folder
+    if mode != 'manifest':
+        for split_name, prefixes in splits.items():
+            split_dir = os.path.join(data_dir, split_name)
+            os.makedirs(split_dir, exist_ok=True)
+            for prefix in prefixes:
+                if prefix in unchanged:
+                    continue
+                for name in prefix_file_names(files[prefix]):
+                    try:
+                        place_file(os.path.join(data_dir, name), os.path.join(split_dir, name), mode)
+                    except Exception as e:
+                        print(f"Error placing {name} in {split_name}: {e}")
+
+    manifest = {'mode': mode, 'seed': seed, 'splits': splits, 'files': files}
+    save_split_manifest(data_dir, manifest)
+    return manifest
+
+def main():
+    parser = argparse.ArgumentParser(description="Split augmented NIfTI files into train/val/test sets by source volume.")
+    parser.add_argument('--data-dir', default=data_dir, help="Directory containing the augmented volume and label files")
+    parser.add_argument('--mode', default='link', choices=['link', 'symlink', 'manifest', 'move'],
+                        help="How files are placed in the split folders: hard links falling back to symlinks (default), "
+                             "symlinks, no files at all (manifest only), or moved as in earlier versions")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed of the split (default: 42)")
+    args = parser.parse_args()
+
+    manifest = split_dataset(args.data_dir, mode=args.mode, seed=args.seed)
+    counts = ', '.join(f"{split_name} {len(prefixes)}" for split_name, prefixes in manifest['splits'].items())
+    print(f"Dataset splitting completed successfully ({counts} source volumes, see {SPLIT_MANIFEST_NAME}).")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import datetime
+import numpy as np
+import nibabel as nib
+
+# Label values of the CT-ORG organs placed in synthetic label volumes
+SYNTHETIC_ORGANS = {'liver': 1, 'bladder': 2, 'lungs': 3, 'kidneys': 4, 'bone': 5}
+
+# Function to build a synthetic CT volume in Hounsfield units and its CT-ORG style label volume
+# The volume is an int16 (H, W, Z) array with air around an elliptical body containing ellipsoidal organs of
+# different densities plus noise, so compression ratios and pixel statistics resemble a real scan
+def synthetic_ct_volume(shape=(512, 512, 64), seed=0):
+    rows, cols, depth = shape
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[0:rows, 0:cols]
+    y = (y - rows / 2) / (rows / 2)
+    x = (x - cols / 2) / (cols / 2)
+    volume = np.full(shape, -1000, dtype=np.int16)
+    label = np.zeros(shape, dtype=np.uint8)
+    body = (x / 0.85) ** 2 + (y / 0.7) ** 2 <= 1
+
+    # Organ centres and radii as fractions of the slice, with the organ density in HU
+    organs = [('lungs', -0.35, -0.1, 0.25, 0.3, -850), ('lungs', 0.35, -0.1, 0.25, 0.3, -850),
+              ('liver', -0.3, 0.25, 0.3, 0.2, 60), ('kidneys', 0.35, 0.35, 0.1, 0.12, 30),
+              ('bone', 0.0, 0.55, 0.08, 0.08, 700), ('bladder', 0.0, 0.1, 0.12, 0.1, 10)]
+    for z in range(depth):
+        # Organs grow and shrink along the scan so consecutive slices differ
+        phase = np.sin(np.pi * (z + 0.5) / depth)
+        slice_volume = np.where(body, 40, -1000).astype(np.int16)
+        slice_label = np.zeros((rows, cols), dtype=np.uint8)
+        for name, cx, cy, rx, ry, density in organs:
+            organ = ((x - cx) / (rx * phase + 1e-3)) ** 2 + ((y - cy) / (ry * phase + 1e-3)) ** 2 <= 1
+            slice_volume[organ] = density
+            slice_label[organ] = SYNTHETIC_ORGANS[name]
+        noise = rng.normal(0, 12, (rows, cols)).astype(np.int16)
+        volume[:, :, z] = np.where(body, slice_volume + noise, slice_volume)
+        label[:, :, z] = slice_label
+    return volume, label
+
+# Function to write a synthetic volume and label pair as volume-<index>.nii.gz and labels-<index>.nii.gz
+# Returns the two file paths
+def write_synthetic_nifti_pair(output_dir, shape=(512, 512, 64), index=0, seed=0, spacing=(0.8, 0.8, 2.5)):
+    os.makedirs(output_dir, exist_ok=True)
+    volume, label = synthetic_ct_volume(shape, seed)
+    affine = np.diag(list(spacing) + [1.0])
+    volume_path = os.path.join(output_dir, f'volume-{index}.nii.gz')
+    label_path = os.path.join(output_dir, f'labels-{index}.nii.gz')
+    nib.save(nib.Nifti1Image(volume, affine), volume_path)
+    nib.save(nib.Nifti1Image(label, affine), label_path)
+    return volume_path, label_path
+
+# Function to write a synthetic volume as a DICOM series, one CT slice per file, in shuffled file order
+# Pixels are stored as unsigned 12-bit values with RescaleIntercept -1024, as most CT scanners do. Returns the file paths
+def write_synthetic_dicom_series(output_dir, shape=(512, 512, 64), seed=0, spacing=(0.8, 0.8, 2.5)):
+    from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+
+    os.makedirs(output_dir, exist_ok=True)
+    volume, _ = synthetic_ct_volume(shape, seed)
+    study_uid, series_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    now = datetime.datetime.now()
+    file_paths = []
+    for z in np.random.default_rng(seed).permutation(shape[2]):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = CTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        dicom = FileDataset(None, Dataset(), file_meta=file_meta, preamble=b"\0" * 128)
+        dicom.SOPClassUID = CTImageStorage
+        dicom.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        dicom.Modality = 'CT'
+        dicom.PatientName = 'Synthetic^Phantom'
+        dicom.PatientID = f'SYNTHETIC{seed}'
+        dicom.StudyInstanceUID = study_uid
+        dicom.SeriesInstanceUID = series_uid
+        dicom.FrameOfReferenceUID = frame_uid
+        dicom.InstanceCreationDate = now.strftime('%Y%m%d')
+        dicom.InstanceCreationTime = now.strftime('%H%M%S')
+        dicom.InstanceNumber = int(z) + 1
+        dicom.ImagePositionPatient = [0.0, 0.0, float(z * spacing[2])]
+        dicom.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        dicom.PixelSpacing = [float(spacing[0]), float(spacing[1])]
+        dicom.SliceThickness = float(spacing[2])
+        dicom.Rows, dicom.Columns = shape[0], shape[1]
+        dicom.SamplesPerPixel = 1
+        dicom.PhotometricInterpretation = 'MONOCHROME2'
+        dicom.BitsAllocated = 16
+        dicom.BitsStored = 12
+        dicom.HighBit = 11
+        dicom.PixelRepresentation = 0
+        dicom.RescaleIntercept = -1024
+        dicom.RescaleSlope = 1
+        stored = np.clip(volume[:, :, z].astype(np.int32) + 1024, 0, 4095).astype(np.uint16)
+        dicom.PixelData = stored.tobytes()
+        file_path = os.path.join(output_dir, f'{dicom.SOPInstanceUID}.dcm')
+        dicom.save_as(file_path)
+        file_paths.append(file_path)
+    return file_paths
@@ -0,0 +1,40 @@
+import os
+import synthetic_ct
+from batch_runner import run_batch, run_pipelined_batch
+from main2 import run_augmentation_batch
+
+# Function to prepare a task like main2 does, failing for a task whose input cannot be read
+def prepare_or_fail(name, task_args):
+    if name == 'bad':
+        raise FileNotFoundError(f"No such file: {name}")
+    return task_args
+
+# Function to double a task's value, standing in for the work of a task
+def double(value):
+    return 2 * value
+
+# A task whose prepare raises is reported as failed, and the other tasks still run
+def test_run_batch_records_prepare_errors():
+    results, failures = run_batch(double, [('bad', (1,)), ('good', (2,))], num_workers=1, prepare=prepare_or_fail)
+    assert results == {'good': 4}
+    assert failures['bad'].startswith('FileNotFoundError')
+
+def test_run_pipelined_batch_records_prepare_errors():
+    results, failures = run_pipelined_batch([double, double], [('bad', (1,)), ('good', (2,))], prepare=prepare_or_fail)
+    assert results == {'good': 8}
+    assert failures['bad'].startswith('FileNotFoundError')
+
+# An unreadable input is hashed while preparing an incremental run, and fails only its own volume
+def test_incremental_batch_reports_unreadable_input(tmp_path):
+    data_dir, output_dir = tmp_path / 'data', tmp_path / 'out'
+    data_dir.mkdir()
+    for index in (0, 9):
+        synthetic_ct.write_synthetic_nifti_pair(str(data_dir), shape=(64, 64, 2), index=index)
+    os.remove(data_dir / 'volume-9.nii.gz')
+    os.symlink(tmp_path / 'missing.nii.gz', data_dir / 'volume-9.nii.gz')
+    for pipelined in (False, True):
+        results, failures = run_augmentation_batch(str(data_dir), str(output_dir), incremental=True, pipelined=pipelined,
+                                                   label_options={'values': [1]})
+        assert 'volume-0.nii.gz' in results
+        assert list(failures) == ['volume-9.nii.gz']
+        assert failures['volume-9.nii.gz'].startswith('FileNotFoundError')
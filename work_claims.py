@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+import contextlib
+
+# Name of the record written to the output directory once every volume of a claimed run is done
+COMPLETION_MANIFEST_NAME = 'completion_manifest.json'
+
+# Function to write a JSON file atomically under a name unique to this process, so writers on other nodes never collide
+def write_json_atomic(file_path, data):
+    temporary_path = f'{file_path}.{socket.gethostname()}-{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(temporary_path, file_path)
+
+# Function to read a JSON file, or None when it is missing or half written
+def read_json(file_path):
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Function to create a lock file holding owner, failing with FileExistsError when it already exists
+# O_CREAT | O_EXCL is atomic on local filesystems and on NFSv3 and later, so exactly one node creates the file
+def create_lock_file(lock_path, owner):
+    fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(owner, f)
+
+# Function to remove a lock file whose mtime is older than stale_after seconds, returning True when it is gone
+# The lock is renamed away first, so of several nodes breaking it at once only one succeeds; if the renamed file turns
+# out to be a fresh lock taken in the meantime, it is put back. Clock skew between nodes must stay well below stale_after
+def break_stale_lock(lock_path, stale_after, token):
+    try:
+        age = time.time() - os.stat(lock_path).st_mtime
+    except FileNotFoundError:
+        return True
+    if age < stale_after:
+        return False
+    owner = read_json(lock_path) or {}
+    stale_path = f'{lock_path}.stale-{token}'
+    try:
+        os.rename(lock_path, stale_path)
+    except FileNotFoundError:
+        return True
+    if (read_json(stale_path) or {}).get('token') != owner.get('token'):
+        with contextlib.suppress(FileExistsError):
+            os.link(stale_path, lock_path)
+        os.remove(stale_path)
+        return False
+    os.remove(stale_path)
+    print(f"Broke stale lock {lock_path} of {owner.get('host')} (pid {owner.get('pid')}), idle for {age:.0f} s.")
+    return True
+
+# Function to hold an exclusive lock file for the duration of a with block, waiting for other holders
+# Used to serialize read-modify-write updates of files shared between nodes, such as the incremental manifest
+@contextlib.contextmanager
+def file_lock(lock_path, stale_after=300, poll_interval=0.1):
+    token = uuid.uuid4().hex
+    owner = {'host': socket.gethostname(), 'pid': os.getpid(), 'token': token}
+    while True:
+        try:
+            create_lock_file(lock_path, owner)
+            break
+        except FileExistsError:
+            if not break_stale_lock(lock_path, stale_after, token):
+                time.sleep(poll_interval)
+    try:
+        yield
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(lock_path)
+
+# Class for claiming volumes of a batch run through lock files on a filesystem shared by several nodes
+# Any number of processes running the same run_id claim volumes one at a time as they have capacity, so work spreads
+# over nodes without a coordinator. Claims live in <output_dir>/.claims/<run_id>/: <name>.lock while a volume is being
+# processed, refreshed by a heartbeat thread, and <name>.done with its outcome once it is finished. A lock that has not
+# been refreshed for stale_after seconds belongs to a node that died, and the volume is claimed again. Rerunning with
+# the same run_id resumes the run; finished volumes (including failures) are not processed again
+class WorkClaims:
+    def __init__(self, output_dir, run_id='default', stale_after=600, heartbeat_interval=30):
+        self.output_dir = output_dir
+        self.run_id = run_id
+        self.claims_dir = os.path.join(output_dir, '.claims', run_id)
+        self.stale_after = stale_after
+        self.heartbeat_interval = heartbeat_interval
+        self.token = uuid.uuid4().hex
+        self.owner = {'host': socket.gethostname(), 'pid': os.getpid(), 'token': self.token}
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        os.makedirs(self.claims_dir, exist_ok=True)
+        self.heartbeat = threading.Thread(target=self.refresh_claims, daemon=True)
+        self.heartbeat.start()
+
+    def lock_path(self, name):
+        return os.path.join(self.claims_dir, name + '.lock')
+
+    def done_path(self, name):
+        return os.path.join(self.claims_dir, name + '.done')
+
+    # Function to claim a volume, returning False when it is finished or another live process holds it
+    def claim(self, name):
+        if os.path.exists(self.done_path(name)):
+            return False
+        for _ in range(2):
+            try:
+                create_lock_file(self.lock_path(name), dict(self.owner, claimed_at=time.time()))
+            except FileExistsError:
+                if not break_stale_lock(self.lock_path(name), self.stale_after, self.token):
+                    return False
+                continue
+            # The previous holder may have finished the volume between the check above and the claim
+            if os.path.exists(self.done_path(name)):
+                os.remove(self.lock_path(name))
+                return False
+            with self.lock:
+                self.held.add(name)
+            return True
+        return False
+
+    # Function to record the outcome of a claimed volume and release its lock
+    def release(self, name, succeeded, outcome=None):
+        write_json_atomic(self.done_path(name), dict(outcome or {}, succeeded=succeeded, host=self.owner['host'],
+                                                     finished_at=time.time()))
+        with self.lock:
+            self.held.discard(name)
+        if (read_json(self.lock_path(name)) or {}).get('token') == self.token:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.lock_path(name))
+
+    # Function run by the heartbeat thread to refresh the mtime of every held lock
+    def refresh_claims(self):
+        while not self.stopped.wait(self.heartbeat_interval):
+            with self.lock:
+                held = list(self.held)
+            for name in held:
+                try:
+                    os.utime(self.lock_path(name))
+                except FileNotFoundError:
+                    print(f"Lost the claim on {name}; another node took it over as stale.")
+
+    # Function to write the completion manifest once every named volume is done, returning its path (or None)
+    # Every process calls this when it runs out of work; the last one to finish finds all volumes done and writes it
+    def write_completion_manifest(self, names):
+        outcomes = {}
+        for name in names:
+            outcome = read_json(self.done_path(name))
+            if outcome is None:
+                return None
+            outcomes[name] = outcome
+        manifest_path = os.path.join(self.output_dir, COMPLETION_MANIFEST_NAME)
+        write_json_atomic(manifest_path, {'run_id': self.run_id, 'volumes': outcomes,
+                                          'succeeded': sum(1 for outcome in outcomes.values() if outcome['succeeded']),
+                                          'failed': sum(1 for outcome in outcomes.values() if not outcome['succeeded'])})
+        return manifest_path
+
+    # Function to stop the heartbeat and give up the claims of volumes left unfinished, so other nodes take them at once
+    def close(self):
+        self.stopped.set()
+        self.heartbeat.join()
+        for name in list(self.held):
+            if (read_json(self.lock_path(name)) or {}).get('token') == self.token:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.lock_path(name))
+        self.held.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()